@@ -0,0 +1,140 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import sys
+import time
+
+from capture_engine import CaptureJob, DEFAULT_PAGES, run_capture
+from fetch_pool import CHARTS_ORIGIN, DEFAULT_CONCURRENCY, RATE_LIMITER
+from http_cache import cache_from_env
+from latency import DEADLINE
+from route_filter import route_filter_from_env
+
+# Scarico batch su una matrice products × areas × quantiles × days per un base_time.
+# Ogni voce passa per cache → resolver HTTP → browser (vedi capture_engine), con
+# concorrenza limitata, rate limit a token bucket per host e retry per voce.
+# Output strutturato: <out>/<product>/<area>/q<quantile>/<base_time>/day<NN>.png
+# più <out>/<product>/.../<base_time>/index.json con l'esito di ogni voce.
+#
+# Esempio:
+#   python batch_fetch.py --areas Europe,Asia --quantiles 90,99 --days 1-15
+
+PRODUCT_URL = CHARTS_ORIGIN + "/products/{product}?area={area}&base_time={base}&day={day}&quantile={quantile}"
+
+# filtro -> sottostringa richiesta nell'URL del PNG (CaptureJob.match)
+FILTERS = {
+    # PNG /streaming/YYYYMMDD- con la data del base_time (come streamingdate/check_vt)
+    "streaming": lambda base_time: f"/streaming/{base_time[:8]}-",
+    # base_time nell'URL (come strict)
+    "base_time": lambda base_time: base_time,
+    # qualunque PNG grande (come via_network)
+    "any": lambda base_time: None,
+}
+
+
+def parse_list(value: str) -> list[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def parse_days(value: str) -> list[int]:
+    """'1-3,5,10-15' -> [1, 2, 3, 5, 10, ..., 15]"""
+    days = []
+    for part in parse_list(value):
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            days.extend(range(int(lo), int(hi) + 1))
+        else:
+            days.append(int(part))
+    return sorted(set(days))
+
+
+def build_matrix(products, areas, quantiles, days, base_time, out_root, match) -> list[CaptureJob]:
+    jobs = []
+    for product in products:
+        for area in areas:
+            for quantile in quantiles:
+                out_dir = os.path.join(out_root, product, area, f"q{quantile}", base_time)
+                for day in days:
+                    jobs.append(CaptureJob(
+                        day=day,
+                        url=PRODUCT_URL.format(product=product, area=area, base=base_time, day=day, quantile=quantile),
+                        out_png=os.path.join(out_dir, f"day{day:02d}.png"),
+                        match=match,
+                        max_wait_ms=7000,
+                    ))
+    return jobs
+
+
+def run_batch(jobs: list[CaptureJob], pages: int, concurrency: int, retries: int) -> list[dict]:
+    """
+    Esegue la matrice; le voci non salvate vengono ritentate (solo loro) fino a
+    `retries` volte, con backoff esponenziale e jitter tra un giro e l'altro,
+    entro la deadline del run (MAPS_DEADLINE_S).
+    """
+    cache = cache_from_env()
+    route_filter = route_filter_from_env("network")
+    results: list = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    for attempt in range(1, retries + 2):
+        round_jobs = [jobs[i] for i in pending]
+        round_results = run_capture(round_jobs, pages=pages, route_filter=route_filter,
+                                    cache=cache, http_concurrency=concurrency)
+        for i, r in zip(pending, round_results):
+            results[i] = {**r, "attempts": attempt}
+        pending = [i for i in pending if not results[i]["saved"]]
+        if not pending or attempt > retries:
+            break
+        delay = DEADLINE.backoff(attempt, base=2)
+        if delay is None:
+            print(f"[retry] tempo del run esaurito, {len(pending)} voci non ritentate")
+            break
+        print(f"[retry] giro {attempt}: {len(pending)} voci da ritentare tra {delay:.1f}s")
+        time.sleep(delay)
+    return results
+
+
+def write_indexes(jobs: list[CaptureJob], results: list[dict]):
+    by_dir: dict[str, list] = {}
+    for job, r in zip(jobs, results):
+        entry = {k: r[k] for k in ("day", "url", "saved", "src", "size", "cached", "error", "attempts")}
+        entry["file"] = os.path.basename(job.out_png) if r["saved"] else None
+        by_dir.setdefault(os.path.dirname(job.out_png), []).append(entry)
+    for out_dir, entries in by_dir.items():
+        with open(os.path.join(out_dir, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=1)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Scarico batch delle mappe ECMWF su una matrice di parametri.")
+    ap.add_argument("--products", default="efi2web_tp")
+    ap.add_argument("--areas", default="Europe")
+    ap.add_argument("--quantiles", default="99")
+    ap.add_argument("--days", default="1-3", help="es. 1-15 oppure 1,2,5")
+    ap.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+    ap.add_argument("--out", default="maps/batch")
+    ap.add_argument("--filter", choices=sorted(FILTERS), default="streaming")
+    ap.add_argument("--pages", type=int, default=DEFAULT_PAGES, help="pagine browser in parallelo")
+    ap.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="richieste HTTP in parallelo")
+    ap.add_argument("--rate", type=float, default=2.0, help="richieste/secondo per host (0 = illimitato)")
+    ap.add_argument("--burst", type=float, default=4.0)
+    ap.add_argument("--retries", type=int, default=2, help="giri di retry per le voci fallite")
+    args = ap.parse_args(argv)
+
+    RATE_LIMITER.configure(args.rate, args.burst)
+    jobs = build_matrix(
+        parse_list(args.products), parse_list(args.areas), parse_list(args.quantiles),
+        parse_days(args.days), args.base_time, args.out, FILTERS[args.filter](args.base_time),
+    )
+    print(f"[info] base_time={args.base_time}, voci nella matrice: {len(jobs)}")
+    t0 = time.monotonic()
+    results = run_batch(jobs, pages=args.pages, concurrency=args.concurrency, retries=args.retries)
+    write_indexes(jobs, results)
+
+    saved = sum(1 for r in results if r["saved"])
+    print(f"[done] salvate {saved}/{len(jobs)} mappe in {time.monotonic() - t0:.1f}s sotto '{args.out}/'.")
+    sys.exit(0 if saved == len(jobs) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# Stand-in locale di charts.ecmwf.int per i benchmark (vedi bench_strategies.py).
+# Riproduce quello che le strategie leggono dal sito vero:
+#   /products/<product>?area=..&base_time=..&day=..&quantile=..   pagina HTML con testo
+#       "VT: ...", <canvas>, <img> del PNG /streaming/, un PNG piccolo (logo), CSS,
+#       uno script "analytics" e il JSON inline {"src": ...}
+#   /streaming/YYYYMMDD-HHMM/<product>_<area>_<base_time>_d<day>_q<quantile>.png
+#   /opencharts-api/v1/products/<product>/?...                     JSON con il link al PNG
+#   /__stats, /__reset                                             contatori per il benchmark
+# Latenza, jitter, dimensione di pagina e PNG e tasso di errori (503) sono configurabili.
+# HTTP/1.1 keep-alive con Content-Length ed ETag/304 come un server reale.
+#
+# Esempio:
+#   python bench_server.py --port 8765 --latency-ms 80 --png-kb 300
+#   ECMWF_CHARTS_ORIGIN=http://127.0.0.1:8765 python download_maps_from_html.py
+
+STREAMING_HHMM = "0930"
+PRODUCT_RE = re.compile(r"^/products/([\w-]+)/?$")
+API_RE = re.compile(r"^/opencharts-api/v1/products/([\w-]+)/?$")
+STREAMING_RE = re.compile(r"^/streaming/(\d{8})-(\d{4})/[\w.-]+\.png$")
+
+DEFAULTS = {
+    "latency_ms": 0.0,   # ritardo fisso prima di ogni risposta
+    "jitter_ms": 0.0,    # ritardo aggiuntivo casuale uniforme in [0, jitter]
+    "fail_rate": 0.0,    # frazione di richieste che rispondono 503
+    "png_kb": 250,       # dimensione (circa) del PNG della mappa
+    "page_kb": 0,        # riempitivo HTML oltre al contenuto utile
+    "api": True,         # espone l'API JSON (False = solo HTML, come se l'API cambiasse)
+    "seed": 0,
+}
+
+
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    """PNG RGB valido con pixel pseudo-casuali (non comprimibile: la dimensione è quasi w*h*3)."""
+    rnd = random.Random(seed)
+    raw = b"".join(b"\x00" + rnd.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def png_of_size(kb: int, seed: int = 0) -> bytes:
+    width = 512
+    height = max(1, round(kb * 1024 / (width * 3 + 1)))
+    return make_png(width, height, seed)
+
+
+def streaming_path(product: str, area: str, base_time: str, day: str, quantile: str) -> str:
+    return f"/streaming/{base_time[:8]}-{STREAMING_HHMM}/{product}_{area}_{base_time}_d{day}_q{quantile}.png"
+
+
+def vt_text(base_time: str, day: int) -> str:
+    start = datetime.strptime(base_time[:8], "%Y%m%d") + timedelta(days=day - 1)
+    end = start + timedelta(days=1)
+    return f"VT: {start:%a %d %b %Y} 00UTC - {end:%a %d %b %Y} 00UTC"
+
+
+def product_page(product: str, q: dict, page_kb: int) -> bytes:
+    area = q.get("area", "Europe")
+    base_time = q.get("base_time") or datetime.now(timezone.utc).strftime("%Y%m%d0000")
+    day = q.get("day", "1")
+    quantile = q.get("quantile", "99")
+    src = streaming_path(product, area, base_time, day, quantile)
+    state = json.dumps({"product": product, "image": {"src": src}})
+    filler = ("<!-- " + "x" * 1000 + " -->\n") * page_kb
+    html = f"""<!DOCTYPE html>
+<html><head>
+<meta charset="utf-8"><title>{product} - {area} - day {day}</title>
+<link rel="stylesheet" href="/static/style.css">
+<script src="/analytics/collect.js"></script>
+</head><body>
+<header><img src="/static/logo.png" alt="ECMWF"></header>
+{filler}<main>
+<h1>Extreme forecast index - total precipitation</h1>
+<p class="vt">Base time: {base_time} {vt_text(base_time, int(day))}</p>
+<canvas id="chart" width="800" height="600"></canvas>
+<img id="map" src="{src}" alt="map">
+</main>
+<script>window.__STATE__ = {state};</script>
+<script>
+  const img = document.getElementById("map");
+  img.onload = () => document.getElementById("chart").getContext("2d").drawImage(img, 0, 0, 800, 600);
+</script>
+</body></html>
+"""
+    return html.encode("utf-8")
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, options: dict, verbose: bool = False):
+        super().__init__(addr, Handler)
+        self.options = {**DEFAULTS, **options}
+        self.verbose = verbose
+        self.rnd = random.Random(self.options["seed"])
+        self.png = png_of_size(self.options["png_kb"], self.options["seed"])
+        self.logo = png_of_size(4, self.options["seed"] + 1)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def handle_error(self, request, client_address):
+        # client che chiudono la connessione a metà (es. la copia perdente di una richiesta hedged)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        with self.lock:
+            self.stats = {"requests": 0, "bytes_sent": 0, "not_modified": 0, "failed": 0,
+                          "by_kind": {}, "first_png_at": None, "started_at": time.time()}
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def count(self, kind: str, sent: int, status: int):
+        with self.lock:
+            s = self.stats
+            s["requests"] += 1
+            s["bytes_sent"] += sent
+            s["by_kind"][kind] = s["by_kind"].get(kind, 0) + 1
+            if status == 304:
+                s["not_modified"] += 1
+            elif status >= 500:
+                s["failed"] += 1
+            elif kind == "png" and s["first_png_at"] is None:
+                s["first_png_at"] = time.time()
+
+    def delay(self) -> bool:
+        """Applica latenza e jitter; True se questa richiesta deve fallire."""
+        o = self.options
+        with self.lock:
+            extra = self.rnd.uniform(0, o["jitter_ms"]) if o["jitter_ms"] else 0.0
+            fail = self.rnd.random() < o["fail_rate"]
+        time.sleep((o["latency_ms"] + extra) / 1000)
+        return fail
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StandInServer
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def send_body(self, kind: str, body: bytes, ctype: str, status: int = 200, etag: bool = True, head: bool = False):
+        tag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if etag and status == 200 and self.headers.get("If-None-Match") == tag:
+            status, body = 304, b""
+        self.send_response(status)
+        if etag and status in (200, 304):
+            self.send_header("ETag", tag)
+            self.send_header("Cache-Control", "max-age=0, must-revalidate")
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        sent = 0
+        if not head and body:
+            self.wfile.write(body)
+            sent = len(body)
+        self.server.count(kind, sent, status)
+
+    def route(self, head: bool = False):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        q = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+        if path == "/__stats":
+            return self.send_body("control", json.dumps(self.server.snapshot()).encode(), "application/json", etag=False)
+        if path == "/__reset":
+            self.server.reset()
+            return self.send_body("control", b"{}", "application/json", etag=False)
+
+        if self.server.delay():
+            return self.send_body("error", b"Service Unavailable", "text/plain", status=503, etag=False, head=head)
+
+        m = PRODUCT_RE.match(path)
+        if m:
+            body = product_page(m.group(1), q, self.server.options["page_kb"])
+            return self.send_body("page", body, "text/html; charset=utf-8", head=head)
+        if STREAMING_RE.match(path):
+            return self.send_body("png", self.server.png, "image/png", head=head)
+        m = API_RE.match(path)
+        if m and self.server.options["api"]:
+            base_time = q.get("base_time", "")
+            src = streaming_path(m.group(1), q.get("area", "Europe"), base_time, q.get("day", "1"), q.get("quantile", "99"))
+            body = json.dumps({"data": {"link": {"href": src, "type": "image/png"}}}).encode()
+            return self.send_body("api", body, "application/json", head=head)
+        if path == "/static/logo.png":
+            return self.send_body("asset", self.server.logo, "image/png", head=head)
+        if path == "/static/style.css":
+            return self.send_body("asset", b"body{font-family:sans-serif}canvas{border:1px solid #ccc}", "text/css", head=head)
+        if path.startswith("/analytics/"):
+            return self.send_body("analytics", b"/* analytics */", "application/javascript", head=head)
+        return self.send_body("missing", b"Not Found", "text/plain", status=404, etag=False, head=head)
+
+    def do_GET(self):
+        self.route()
+
+    def do_HEAD(self):
+        self.route(head=True)
+
+
+def serve_in_thread(host: str = "127.0.0.1", port: int = 0, verbose: bool = False, **options) -> StandInServer:
+    """Avvia lo stand-in in un thread daemon; port=0 sceglie una porta libera (vedi server.url)."""
+    server = StandInServer((host, port), options, verbose=verbose)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Stand-in locale di charts.ecmwf.int per i benchmark.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency-ms", type=float, default=DEFAULTS["latency_ms"])
+    ap.add_argument("--jitter-ms", type=float, default=DEFAULTS["jitter_ms"])
+    ap.add_argument("--fail-rate", type=float, default=DEFAULTS["fail_rate"], help="frazione di risposte 503")
+    ap.add_argument("--png-kb", type=int, default=DEFAULTS["png_kb"])
+    ap.add_argument("--page-kb", type=int, default=DEFAULTS["page_kb"])
+    ap.add_argument("--no-api", dest="api", action="store_false", help="disattiva l'API JSON")
+    ap.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+    ap.add_argument("--verbose", action="store_true")
+    args = ap.parse_args(argv)
+
+    options = {k: getattr(args, k) for k in DEFAULTS}
+    server = StandInServer((args.host, args.port), options, verbose=args.verbose)
+    print(f"[info] stand-in su {server.url} (PNG {len(server.png)/1024:.0f} KB, pid {os.getpid()})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_server import DEFAULTS, serve_in_thread
+from fetch_pool import PNG_MAGIC
+
+# Benchmark delle strategie di download contro lo stand-in locale (bench_server.py).
+# Ogni strategia gira come processo separato in una cartella temporanea, con
+# ECMWF_CHARTS_ORIGIN puntato allo stand-in e la cache HTTP disattivata. Misure:
+#   wall_s       tempo totale del processo
+#   first_png_s  dall'avvio al primo PNG /streaming/ servito (contatori dello stand-in)
+#   bytes        byte di body inviati dallo stand-in (pagine, PNG, asset)
+#   requests     richieste ricevute dallo stand-in
+#   peak_rss_mb  RSS massimo (wait4: include i figli raccolti, es. il browser)
+#   cpu_s        tempo CPU utente + sistema (idem)
+#   ok           exit code 0 e maps/map_day{1,2,3}.png presenti e con firma PNG
+# Il risultato va in bench/results/<commit>.json; --compare confronta con un run precedente.
+#
+# Esempio:
+#   python bench_strategies.py --repeat 3 --latency-ms 50
+#   python bench_strategies.py --only html,resolver --compare bench/results/abc1234.json
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+DAYS = (1, 2, 3)
+
+# nome -> (script, richiede Playwright)
+STRATEGIES = {
+    "direct": ("download_maps.py", False),
+    "html": ("download_maps_from_html.py", False),
+    "resolver": ("streaming_resolver.py", False),
+    "auto": ("download_maps_auto.py", False),
+    "screenshot": ("download_maps_playwright.py", True),
+    "screenshot_debug": ("download_maps_playwright_debug.py", True),
+    "network": ("download_maps_via_network.py", True),
+    "strict": ("download_maps_via_network_strict.py", True),
+    "streamingdate": ("download_maps_via_network_streamingdate.py", True),
+    "check_vt": ("download_maps_check_vt.py", True),
+}
+METRICS = ("wall_s", "first_png_s", "bytes", "requests", "peak_rss_mb", "cpu_s")
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True)
+        sha = out.stdout.strip() or "nogit"
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=REPO).returncode != 0
+        return f"{sha}-dirty" if dirty else sha
+    except OSError:
+        return "nogit"
+
+
+def have_playwright() -> bool:
+    try:
+        import playwright  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def is_png(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(PNG_MAGIC)) == PNG_MAGIC
+    except OSError:
+        return False
+
+
+def run_once(script: str, server, timeout: float, use_resolver: bool) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = {
+        **os.environ,
+        "PYTHONPATH": REPO + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        "PYTHONUNBUFFERED": "1",
+        "ECMWF_CHARTS_ORIGIN": server.url,
+        "MAPS_CACHE": "0",
+        # confronto tra strategie "pure": il resolver HTTP di capture_engine è una strategia a sé
+        "MAPS_RESOLVER": "1" if use_resolver else "0",
+        "MAPS_TEMPLATES": os.path.join(workdir, "templates.json"),
+    }
+    log_path = os.path.join(workdir, "output.log")
+    server.reset()
+    with open(log_path, "wb") as log_file:
+        t_start = time.time()
+        t0 = time.monotonic()
+        proc = subprocess.Popen([sys.executable, os.path.join(REPO, script)], cwd=workdir, env=env,
+                                stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+        status, usage, timed_out = None, None, False
+        while status is None:
+            pid, st, ru = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                status, usage = st, ru
+                break
+            if time.monotonic() - t0 > timeout:
+                timed_out = True
+                os.killpg(proc.pid, signal.SIGKILL)
+                _, status, usage = os.wait4(proc.pid, 0)
+                break
+            time.sleep(0.01)
+        wall = time.monotonic() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    stats = server.snapshot()
+
+    saved = [d for d in DAYS if is_png(os.path.join(workdir, "maps", f"map_day{d}.png"))]
+    try:
+        # fasi registrate dallo script stesso (run_trace), utili per capire dove va il tempo
+        with open(os.path.join(workdir, "maps", "trace_summary.json"), encoding="utf-8") as f:
+            phases = json.load(f)["phases"]
+    except (OSError, ValueError, KeyError):
+        phases = None
+    with open(log_path, encoding="utf-8", errors="replace") as f:
+        tail = f.read()[-2000:]
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "ok": proc.returncode == 0 and len(saved) == len(DAYS),
+        "exit_code": proc.returncode,
+        "timed_out": timed_out,
+        "saved": saved,
+        "wall_s": round(wall, 3),
+        "first_png_s": round(stats["first_png_at"] - t_start, 3) if stats["first_png_at"] else None,
+        "bytes": stats["bytes_sent"],
+        "requests": stats["requests"],
+        "by_kind": stats["by_kind"],
+        "phases": phases,
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),  # Linux: ru_maxrss in KB
+        "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+        "log_tail": None if proc.returncode == 0 else tail,
+    }
+
+
+def summarize(runs: list[dict]) -> dict:
+    ok_runs = [r for r in runs if r["ok"]] or runs
+    median = {}
+    for m in METRICS:
+        values = [r[m] for r in ok_runs if r[m] is not None]
+        median[m] = round(statistics.median(values), 3) if values else None
+    return {"median": median, "failure_rate": round(sum(not r["ok"] for r in runs) / len(runs), 3), "runs": runs}
+
+
+def compare(current: dict, previous_path: str):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\n[compare] {previous.get('commit')} -> {current['commit']} (rapporto nuovo/vecchio, >1 = peggio)")
+    for name, cur in current["strategies"].items():
+        old = previous.get("strategies", {}).get(name)
+        if not old or "median" not in old or "median" not in cur:
+            continue
+        parts = []
+        for m in METRICS:
+            a, b = old["median"].get(m), cur["median"].get(m)
+            if a and b is not None:
+                parts.append(f"{m} x{b / a:.2f}")
+        print(f"  {name:<17} " + ", ".join(parts)
+              + f", failure {old['failure_rate']:.0%} -> {cur['failure_rate']:.0%}")
+
+
+def print_table(results: dict):
+    print(f"\n{'strategia':<17} {'ok':>5} {'wall s':>8} {'1° PNG s':>9} {'KB':>9} {'req':>5} {'RSS MB':>8} {'CPU s':>7}")
+    for name, r in results.items():
+        if "skipped" in r:
+            print(f"{name:<17} saltata ({r['skipped']})")
+            continue
+        m = r["median"]
+
+        def fmt(v, spec):
+            return format(v, spec) if v is not None else "-"
+        print(f"{name:<17} {1 - r['failure_rate']:>5.0%} {fmt(m['wall_s'], '8.2f')} {fmt(m['first_png_s'], '9.2f')} "
+              f"{fmt(m['bytes'] and m['bytes'] / 1024, '9.0f')} {fmt(m['requests'], '5.0f')} "
+              f"{fmt(m['peak_rss_mb'], '8.1f')} {fmt(m['cpu_s'], '7.2f')}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark delle strategie di download contro uno stand-in locale.")
+    ap.add_argument("--only", help="strategie separate da virgola (default: tutte)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--timeout", type=float, default=300, help="secondi per singolo run")
+    ap.add_argument("--with-resolver", action="store_true", help="lascia attivo il resolver HTTP nelle strategie browser")
+    ap.add_argument("--latency-ms", type=float, default=DEFAULTS["latency_ms"])
+    ap.add_argument("--jitter-ms", type=float, default=DEFAULTS["jitter_ms"])
+    ap.add_argument("--fail-rate", type=float, default=DEFAULTS["fail_rate"])
+    ap.add_argument("--png-kb", type=int, default=DEFAULTS["png_kb"])
+    ap.add_argument("--page-kb", type=int, default=DEFAULTS["page_kb"])
+    ap.add_argument("--no-api", dest="api", action="store_false")
+    ap.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+    ap.add_argument("--out", help="default: bench/results/<commit>.json")
+    ap.add_argument("--compare", help="JSON di un run precedente da confrontare")
+    args = ap.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(STRATEGIES)
+    unknown = [n for n in names if n not in STRATEGIES]
+    if unknown:
+        ap.error(f"strategie sconosciute: {', '.join(unknown)} (disponibili: {', '.join(STRATEGIES)})")
+    options = {k: getattr(args, k) for k in DEFAULTS}
+    server = serve_in_thread(**options)
+    print(f"[info] stand-in su {server.url}, {args.repeat} run per strategia", flush=True)
+
+    browser = have_playwright()
+    results = {}
+    for name in names:
+        script, needs_browser = STRATEGIES[name]
+        if needs_browser and not browser:
+            results[name] = {"skipped": "playwright non installato"}
+            continue
+        runs = []
+        for i in range(args.repeat):
+            r = run_once(script, server, args.timeout, args.with_resolver)
+            runs.append(r)
+            state = "ok" if r["ok"] else f"FAIL (exit {r['exit_code']}, salvati {r['saved']})"
+            print(f"[bench] {name} #{i + 1}: {r['wall_s']:.2f}s, {r['bytes'] / 1024:.0f} KB, {state}", flush=True)
+        results[name] = summarize(runs)
+    server.shutdown()
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "server": options,
+        "repeat": args.repeat,
+        "with_resolver": args.with_resolver,
+        "strategies": results,
+    }
+    out = args.out or os.path.join(REPO, "bench", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print_table(results)
+    print(f"\n[done] risultati in {out}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
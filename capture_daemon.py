@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+from playwright.async_api import async_playwright
+
+from capture_engine import (DAEMON_LINE_LIMIT, DEFAULT_PAGES, VIEWPORT, _new_result, _run_on_page,
+                            job_from_wire, log)
+from http_cache import cache_from_env
+from latency import DEADLINE
+from route_filter import route_filter_from_env
+from run_trace import TRACE
+
+# Daemon di cattura con browser sempre caldo, per runner self-hosted e batch ripetuti.
+# Un solo Chromium avviato con launch_persistent_context su una user-data dir che
+# sopravvive ai run: la cache HTTP su disco del browser tiene gli asset statici del
+# sito (JS, CSS, font), le N pagine restano aperte tra un job e l'altro e i run
+# successivi non pagano né l'avvio del browser né il download degli asset.
+# I job arrivano su un socket Unix, una riga JSON per richiesta:
+#   {"cmd": "capture", "jobs": [{"day", "url", "out_png", "match", ...}]} -> {"results": [...]}
+#   {"cmd": "status"} / {"cmd": "stop"}
+# Gli script lo usano da soli se MAPS_DAEMON punta al socket (vedi capture_engine.capture_all);
+# se il daemon non risponde lanciano il browser come sempre.
+# Nota: il routing di Playwright disattiva la cache HTTP del browser, quindi qui il filtro
+# di route è spento di default (MAPS_ROUTE_FILTER per riattivarlo).
+#
+# Esempio:
+#   python capture_daemon.py serve &
+#   MAPS_DAEMON=.cache/maps/capture.sock python download_maps_via_network.py
+#   python capture_daemon.py stop
+
+DEFAULT_SOCKET = os.environ.get("MAPS_DAEMON") or ".cache/maps/capture.sock"
+DEFAULT_PROFILE = os.environ.get("MAPS_BROWSER_PROFILE", ".cache/maps/chromium-profile")
+
+
+class CaptureDaemon:
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, profile_dir: str = DEFAULT_PROFILE,
+                 pages: int = DEFAULT_PAGES):
+        self.socket_path = socket_path
+        self.profile_dir = profile_dir
+        self.pages = max(1, pages)
+        self.route_filter = route_filter_from_env("off")
+        self.cache = cache_from_env()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.stopping = asyncio.Event()
+        self.stats = {"started_at": time.time(), "requests": 0, "jobs": 0, "saved": 0, "busy": 0}
+
+    async def _page_worker(self, context):
+        page = await context.new_page()
+        while True:
+            job, fut = await self.queue.get()
+            self.stats["busy"] += 1
+            try:
+                if page.is_closed():
+                    # pagina crashata o chiusa dal sito: se ne apre un'altra nello stesso context
+                    page = await context.new_page()
+                result = await _run_on_page(page, job, self.cache)
+            except Exception as e:
+                result = {**_new_result(job), "error": str(e)}
+            finally:
+                self.stats["busy"] -= 1
+            self.stats["jobs"] += 1
+            self.stats["saved"] += bool(result["saved"])
+            if not fut.done():
+                fut.set_result(result)
+
+    async def _capture(self, wires: list[dict]) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for wire in wires:
+            job = job_from_wire(wire)
+            os.makedirs(os.path.dirname(job.out_png) or ".", exist_ok=True)
+            fut = loop.create_future()
+            self.queue.put_nowait((job, fut))
+            futures.append(fut)
+        return list(await asyncio.gather(*futures))
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                reply = {"error": f"richiesta non valida: {e}"}
+            else:
+                self.stats["requests"] += 1
+                cmd = request.get("cmd")
+                if cmd == "capture":
+                    jobs = request.get("jobs", [])
+                    log(f"[daemon] {len(jobs)} job ricevuti (in coda: {self.queue.qsize()})")
+                    # la deadline vale per run, non per la vita del daemon
+                    DEADLINE.reset()
+                    reply = {"results": await self._capture(jobs)}
+                elif cmd == "status":
+                    reply = {**self.stats, "queued": self.queue.qsize(), "pages": self.pages,
+                             "profile": os.path.abspath(self.profile_dir), "pid": os.getpid()}
+                elif cmd == "stop":
+                    reply = {"stopping": True}
+                    self.stopping.set()
+                else:
+                    reply = {"error": f"comando sconosciuto: {cmd}"}
+            writer.write(json.dumps(reply, default=str).encode() + b"\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _claim_socket(self):
+        if not os.path.exists(self.socket_path):
+            os.makedirs(os.path.dirname(self.socket_path) or ".", exist_ok=True)
+            return
+        if request(self.socket_path, {"cmd": "status"}, timeout=2) is not None:
+            raise RuntimeError(f"un daemon è già attivo su {self.socket_path}")
+        os.remove(self.socket_path)  # socket rimasto da un daemon terminato male
+
+    async def serve(self):
+        self._claim_socket()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+        async with async_playwright() as p:
+            t0 = time.monotonic()
+            context = await p.chromium.launch_persistent_context(self.profile_dir, viewport=VIEWPORT)
+            if self.route_filter:
+                await self.route_filter.attach(context)
+            workers = [asyncio.create_task(self._page_worker(context)) for _ in range(self.pages)]
+            server = await asyncio.start_unix_server(self._handle, path=self.socket_path, limit=DAEMON_LINE_LIMIT)
+            log(f"[daemon] pronto su {self.socket_path}: {self.pages} pagine, profilo {self.profile_dir} "
+                f"(avvio {time.monotonic() - t0:.1f}s)")
+            try:
+                await self.stopping.wait()
+            finally:
+                server.close()
+                await server.wait_closed()
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                await context.close()
+                if os.path.exists(self.socket_path):
+                    os.remove(self.socket_path)
+        if self.route_filter:
+            log(self.route_filter.summary())
+        log(f"[daemon] fermato dopo {self.stats['jobs']} job ({self.stats['saved']} salvati).")
+
+
+def request(socket_path: str, payload: dict, timeout: float = 600) -> dict | None:
+    """Client sincrono minimale (status/stop da riga di comando); None se il daemon non risponde."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall(json.dumps(payload).encode() + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data) if data else None
+    except (OSError, ValueError):
+        return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Daemon di cattura Playwright con browser e cache persistenti.")
+    ap.add_argument("cmd", choices=["serve", "status", "stop"])
+    ap.add_argument("--socket", default=DEFAULT_SOCKET)
+    ap.add_argument("--profile", default=DEFAULT_PROFILE, help="user-data dir di Chromium (cache su disco)")
+    ap.add_argument("--pages", type=int, default=DEFAULT_PAGES)
+    ap.add_argument("--trace", action="store_true", help="scrive anche la trace (maps/trace.jsonl)")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "serve":
+        # un daemon vive a lungo: niente trace su file salvo richiesta esplicita
+        TRACE.enabled = args.trace
+        asyncio.run(CaptureDaemon(args.socket, args.profile, args.pages).serve())
+        return
+    reply = request(args.socket, {"cmd": args.cmd}, timeout=10)
+    if reply is None:
+        print(f"[warn] nessun daemon su {args.socket}")
+        sys.exit(1)
+    print(json.dumps(reply, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,580 @@
+from contextlib import nullcontext
+from dataclasses import dataclass, fields
+from typing import Callable
+import asyncio
+import json
+import os
+import threading
+
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+
+from cdp_profile import PROFILE, PageProfiler, write_report
+from chart_export import export_chart, wait_rendered
+from fetch_pool import DEFAULT_CONCURRENCY, RATE_LIMITER, Fetcher, run_all
+from har_replay import HAR_REPLAY, record_options
+from http_cache import HttpCache, slot_from_url
+from latency import DEADLINE, LATENCY, endpoint
+from route_filter import RouteFilter
+from run_trace import TRACE
+import streaming_resolver
+
+# Motore di cattura condiviso dagli script Playwright.
+# Un solo Chromium, N pagine aperte in parallelo (override: MAPS_PAGES): ogni pagina
+# prende i job da una coda comune e ogni job ha il proprio listener e il proprio
+# buffer dei candidati, quindi 3 o 30 giorni/aree costano ~ il tempo del job più lento.
+
+DEFAULT_PAGES = int(os.environ.get("MAPS_PAGES", "4"))
+# prima del browser prova a risolvere l'URL /streaming/ via HTTP (MAPS_RESOLVER=0 per disattivare)
+USE_RESOLVER = os.environ.get("MAPS_RESOLVER", "1") != "0"
+# socket del daemon con browser già caldo (capture_daemon.py); vuoto = browser lanciato dal run
+DAEMON_SOCKET = os.environ.get("MAPS_DAEMON", "")
+DAEMON_LINE_LIMIT = 64 * 1024 * 1024  # una risposta = una riga JSON (contiene anche il testo pagina)
+VIEWPORT = {"width": 1600, "height": 1000}
+MIN_PNG_SIZE = 50_000  # escludi pixel/icone minuscole
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+def looks_like_png(url: str, ctype: str) -> bool:
+    url_l = url.lower()
+    return "image/png" in ctype or url_l.endswith(".png") or ".png?" in url_l
+
+
+def log(msg):
+    print(msg, flush=True)
+    TRACE.log(msg)
+
+
+@dataclass
+class CaptureJob:
+    day: int
+    url: str
+    out_png: str
+    out_html: str | None = None
+    # filtro sulle response PNG: (url, content-type) -> bool
+    accept: Callable[[str, str], bool] = looks_like_png
+    # sottostringa richiesta nell'URL del PNG; a differenza di `accept` è serializzabile
+    # e quindi vale anche per i job mandati al daemon
+    match: str | None = None
+    # callback per i PNG scartati dal filtro (solo log)
+    on_reject: Callable[[str], None] | None = None
+    min_size: int = MIN_PNG_SIZE
+    # legge document.body.innerText (serve per il VT)
+    read_text: bool = False
+    # se nessun PNG passa il filtro salva uno screenshot full-page
+    screenshot_fallback: bool = False
+    # modalità solo screenshot: niente cattura di rete
+    screenshot_only: bool = False
+    # selettore del grafico: gli screenshot esportano solo quell'elemento (canvas.toDataURL
+    # o ritaglio sull'elemento) dopo il segnale di render completato; None = full-page
+    element: str | None = None
+    render_timeout_ms: int = 10_000
+    wait_selector: str | None = None
+    selector_timeout_ms: int = 20_000
+    # tetto del timeout di navigazione; quello effettivo deriva dalle latenze misurate (latency.py)
+    goto_timeout_ms: int = 120_000
+    # tetto massimo di attesa dopo goto: si esce prima appena un PNG passa filtro e soglia
+    max_wait_ms: int = 6000
+    # finestra breve dopo il primo candidato valido, per lasciar arrivare PNG più grandi
+    settle_ms: int = 750
+    # screenshot full-page: attesa massima della rete inattiva prima dello scatto
+    networkidle_ms: int = 6000
+    retries: int = 1
+    log_console: bool = False
+    # profilo CDP della pagina (metriche, waterfall, long task) in result["profile"]
+    profile: bool = PROFILE
+
+    def accepts(self, url: str, ctype: str) -> bool:
+        return (not self.match or self.match in url) and self.accept(url, ctype)
+
+    @property
+    def label(self) -> str:
+        # nei log: con la pipeline lo stesso day gira per più prodotti e aree
+        slot = slot_from_url(self.url)
+        return f"{slot['product']}/{slot['area']} Day {self.day}"
+
+
+# campi che viaggiano verso il daemon (le callable restano nel processo che le ha create)
+WIRE_FIELDS = [f.name for f in fields(CaptureJob) if f.name not in ("accept", "on_reject")]
+
+
+def job_to_wire(job: CaptureJob) -> dict | None:
+    """
+    Job in forma JSON per il daemon; None (il job gira nel browser locale) se usa un
+    filtro `accept` personalizzato o una callback `on_reject`, che il daemon non può chiamare.
+    """
+    if job.accept is not looks_like_png or job.on_reject is not None:
+        return None
+    wire = {k: getattr(job, k) for k in WIRE_FIELDS}
+    # il daemon gira in un'altra cartella: percorsi assoluti
+    for k in ("out_png", "out_html"):
+        if wire[k]:
+            wire[k] = os.path.abspath(wire[k])
+    return wire
+
+
+def job_from_wire(wire: dict) -> CaptureJob:
+    return CaptureJob(**{k: v for k, v in wire.items() if k in WIRE_FIELDS})
+
+
+def _new_result(job: CaptureJob) -> dict:
+    return {
+        "day": job.day, "url": job.url, "out_png": job.out_png,
+        "saved": False, "screenshot": False, "src": None, "size": 0,
+        "text": None, "title": None, "error": None, "cached": False,
+    }
+
+
+async def _screenshot(page, job: CaptureJob) -> str:
+    """Screenshot del job: solo l'elemento del grafico se `job.element`, altrimenti full-page."""
+    if job.element:
+        with TRACE.span("render_wait", day=job.day) as span:
+            span["rendered"] = await wait_rendered(page, job.element, job.render_timeout_ms)
+        if not span["rendered"]:
+            log(f"[warn] {job.label}: render di '{job.element}' non confermato entro il timeout, esporto comunque.")
+        try:
+            with TRACE.span("screenshot", day=job.day, mode="element"):
+                return await export_chart(page, job.element, job.out_png)
+        except Exception as e:
+            log(f"[warn] {job.label}: export di '{job.element}' fallito ({e}), screenshot full-page.")
+    else:
+        # render finale: rete inattiva, al massimo networkidle_ms invece di un'attesa fissa
+        try:
+            with TRACE.span("settle", day=job.day):
+                await page.wait_for_load_state("networkidle", timeout=job.networkidle_ms)
+        except PlaywrightTimeoutError:
+            pass
+    with TRACE.span("screenshot", day=job.day, mode="page"):
+        await page.screenshot(path=job.out_png, full_page=True)
+    return "page"
+
+
+async def _emergency_screenshot(page, job: CaptureJob, result: dict):
+    try:
+        mode = await _screenshot(page, job)
+        result["screenshot"] = True
+        log(f"[ok] {job.label}: screenshot ({mode}) salvato {job.out_png}")
+    except Exception:
+        pass
+
+
+async def _wait_for_candidate(found: asyncio.Event, deadline: float, settle_ms: int):
+    """
+    Attende il primo PNG valido (filtro + soglia) entro la deadline, poi concede
+    una breve finestra di assestamento per candidati più grandi. Senza candidati
+    si arriva alla deadline, che resta solo un limite superiore.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.wait_for(found.wait(), timeout=max(0.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        return
+    await asyncio.sleep(max(0.0, min(settle_ms / 1000, deadline - loop.time())))
+
+
+def _serve_from_cache(jobs: list[CaptureJob], cache: HttpCache,
+                      concurrency: int = DEFAULT_CONCURRENCY, fetcher: Fetcher | None = None) -> dict[int, dict]:
+    """
+    Per i job già catturati in un run precedente (stesso slot product/area/base_time/
+    day/quantile) rivalida il PNG noto con un GET condizionale: su 304 o 200 valido
+    il job è risolto senza browser. I job che leggono il testo pagina restano al browser.
+    """
+    todo = []
+    for i, job in enumerate(jobs):
+        if job.screenshot_only or job.read_text:
+            continue
+        # solo voci PNG: sotto lo stesso slot download_maps_from_html salva anche la pagina;
+        # la firma del file servito su 304 la ricontrolla fetch_to(png=True)
+        hit = cache.find(slot_from_url(job.url), png=True)
+        if hit and job.accepts(hit[0]["url"], (hit[0].get("content_type") or "image/png").lower()):
+            todo.append((i, job, hit[0]["url"]))
+    if not todo:
+        return {}
+
+    def revalidate(item):
+        i, job, src = item
+        # streaming dalla rete (o dalla cache su 304) al file, con controllo firma e soglia
+        size, from_cache = cache.fetch_to(fetcher, slot_from_url(job.url), src, job.out_png,
+                                          png=True, min_size=job.min_size)
+        result = _new_result(job)
+        result.update({"saved": True, "src": src, "size": size, "cached": from_cache})
+        log(f"[cache] {job.label}: PNG {'invariato (304)' if from_cache else 'aggiornato'} senza browser (src={src})")
+        return result
+
+    served = {}
+    with nullcontext(fetcher) if fetcher is not None else Fetcher() as fetcher:
+        for (i, job, _), result, err in run_all(revalidate, todo, concurrency=concurrency):
+            if err:
+                log(f"[warn] {job.label}: rivalidazione cache fallita ({err}), uso il browser.")
+            elif result:
+                served[i] = result
+    return served
+
+
+async def _capture_job(page, job: CaptureJob, cache: HttpCache | None = None) -> dict:
+    result = _new_result(job)
+    # candidato migliore, privato di questo job: in memoria solo i metadati,
+    # il body del vincente corrente sta nel file .part accanto all'output
+    best = {"url": None, "size": 0, "headers": None}
+    found = asyncio.Event()
+    # nome unico per tentativo (come stream_to_file): più job/tentativi sullo stesso out_png
+    # non si scrivono addosso; dopo il finally i listener ancora in volo non scrivono più
+    part = f"{job.out_png}.part{os.getpid()}-{id(found)}"
+    done = False
+
+    async def on_response(resp):
+        try:
+            TRACE.count("responses_seen")
+            headers = resp.headers or {}
+            ctype = headers.get("content-type", "").lower()
+            u = resp.url
+            if not looks_like_png(u, ctype):
+                return
+            TRACE.count("png_responses")
+            if not job.accepts(u, ctype):
+                if job.on_reject:
+                    job.on_reject(u)
+                return
+            # Playwright non dà il body a pezzi: lo si legge solo se il candidato può vincere,
+            # decidendo dal Content-Length o, se manca, dalla dimensione registrata dal browser
+            length = headers.get("content-length", "")
+            if length.isdigit():
+                expected = int(length)
+            else:
+                await resp.finished()
+                expected = (await resp.request.sizes()).get("responseBodySize", 0)
+            if expected < job.min_size or expected <= best["size"] or done:
+                return
+            body = await resp.body()
+            size = len(body) if body else 0
+            TRACE.count("bodies_read")
+            TRACE.count("body_bytes", size)
+            if done:
+                return
+            if size >= job.min_size and size > best["size"] and body.startswith(PNG_MAGIC):
+                with TRACE.span("disk_write", day=job.day, bytes=size, what="candidate"):
+                    with open(part, "wb") as f:
+                        f.write(body)
+                if not found.is_set():
+                    TRACE.event("first_candidate_png", day=job.day, url=u, size=size)
+                best.update({"url": u, "size": size, "headers": headers})
+                found.set()
+                log(f"[net] {job.label}: PNG candidato {u} ({size/1024:.1f} KB)")
+        except Exception as e:
+            log(f"[warn] {job.label}: on_response error: {e}")
+
+    profiler = None
+    if job.profile:
+        profiler = PageProfiler(f"day {job.day}")
+        try:
+            await profiler.attach(page)
+        except Exception as e:
+            log(f"[warn] {job.label}: profilo CDP non disponibile ({e})")
+            profiler = None
+    if not job.screenshot_only:
+        page.on("response", on_response)
+    try:
+        log(f"[step] {job.label}: goto {job.url}")
+        key = endpoint(job.url, "goto")
+        goto_timeout_ms = LATENCY.timeout_for(key, job.goto_timeout_ms / 1000) * 1000
+        # stesso limite per host dei GET HTTP (MAPS_RATE): la navigazione prende un token,
+        # le sottorisorse caricate dalla pagina no
+        await asyncio.to_thread(RATE_LIMITER.acquire, job.url)
+        t0 = asyncio.get_running_loop().time()
+        # goto fino alla prima risposta del documento, poi DOM pronto: due fasi distinte nella trace
+        with TRACE.span("goto", day=job.day, timeout_ms=round(goto_timeout_ms)):
+            await page.goto(job.url, wait_until="commit", timeout=goto_timeout_ms)
+        with TRACE.span("dom_ready", day=job.day):
+            await page.wait_for_load_state("domcontentloaded", timeout=goto_timeout_ms)
+        LATENCY.record(key, asyncio.get_running_loop().time() - t0)
+        deadline = asyncio.get_running_loop().time() + job.max_wait_ms / 1000
+        if job.out_html:
+            with TRACE.span("disk_write", day=job.day, what="html"):
+                html = await page.content()
+                with open(job.out_html, "w", encoding="utf-8") as f:
+                    f.write(html)
+        if job.read_text:
+            with TRACE.span("read_text", day=job.day):
+                result["text"] = await page.evaluate("document.body.innerText || ''")
+                result["title"] = await page.title()
+        if job.wait_selector:
+            try:
+                with TRACE.span("wait_selector", day=job.day, selector=job.wait_selector):
+                    await page.wait_for_selector(job.wait_selector, timeout=job.selector_timeout_ms)
+            except PlaywrightTimeoutError:
+                log(f"[warn] {job.label}: {job.wait_selector} non trovato entro il timeout, continuo comunque.")
+
+        if job.screenshot_only:
+            mode = await _screenshot(page, job)
+            TRACE.count("screenshots")
+            result.update({"saved": True, "screenshot": True})
+            log(f"[ok] {job.label}: screenshot ({mode}) salvato {job.out_png}")
+            return result
+
+        with TRACE.span("wait_candidate", day=job.day):
+            await _wait_for_candidate(found, deadline, job.settle_ms)
+        if best["url"]:
+            os.replace(part, job.out_png)
+            TRACE.event("winning_png", day=job.day, url=best["url"], size=best["size"])
+            result.update({"saved": True, "src": best["url"], "size": best["size"]})
+            log(f"[ok] {job.label}: PNG salvato da network {job.out_png} (src={best['url']})")
+            slot = slot_from_url(job.url)
+            streaming_resolver.learn(slot, best["url"])
+            if cache is not None:
+                cache.put_file(slot, best["url"], job.out_png, best["headers"])
+        elif job.screenshot_fallback:
+            log(f"[warn] {job.label}: nessun PNG tra le risposte di rete; faccio fallback a screenshot.")
+            await _emergency_screenshot(page, job, result)
+    except PlaywrightTimeoutError as e:
+        result["error"] = f"timeout: {e}"
+        log(f"[err] {job.label}: timeout nel caricamento pagina.")
+        if job.screenshot_fallback:
+            await _emergency_screenshot(page, job, result)
+    except Exception as e:
+        result["error"] = str(e)
+        log(f"[err] {job.label}: errore durante la cattura: {e}")
+        if job.screenshot_fallback:
+            await _emergency_screenshot(page, job, result)
+    finally:
+        done = True
+        if not job.screenshot_only:
+            page.remove_listener("response", on_response)
+        if os.path.exists(part):
+            os.remove(part)
+        if profiler:
+            try:
+                result["profile"] = await profiler.finish(page, result["src"])
+            except Exception as e:
+                log(f"[warn] {job.label}: profilo CDP non raccolto ({e})")
+    return result
+
+
+async def _run_job(page, job: CaptureJob, cache: HttpCache | None = None) -> dict:
+    for attempt in range(1, job.retries + 1):
+        with TRACE.span("job", day=job.day, attempt=attempt) as span:
+            result = await _capture_job(page, job, cache)
+            span["saved"] = result["saved"]
+        if result["saved"] or attempt == job.retries:
+            return result
+        delay = DEADLINE.backoff(attempt, base=2)
+        if delay is None:
+            log(f"[err] {job.label}: tentativo {attempt}/{job.retries} fallito, tempo del run esaurito.")
+            return result
+        log(f"[err] {job.label}: tentativo {attempt}/{job.retries} fallito, riprovo tra {delay:.1f}s.")
+        await asyncio.sleep(delay)
+    return result
+
+
+async def _run_on_page(page, job: CaptureJob, cache: HttpCache | None = None) -> dict:
+    """Esegue il job su una pagina già aperta (usata anche dal daemon, con pagine persistenti)."""
+    if job.log_console:
+        handler = lambda m, d=job.label: log(f"[page.console] {d} {m.type.upper()}: {m.text}")
+        page.on("console", handler)
+    try:
+        return await _run_job(page, job, cache)
+    finally:
+        if job.log_console:
+            page.remove_listener("console", handler)
+
+
+async def _worker(context, queue: asyncio.Queue, results: list, cache: HttpCache | None = None):
+    page = await context.new_page()
+    try:
+        while True:
+            try:
+                i, job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results[i] = await _run_on_page(page, job, cache)
+    finally:
+        await page.close()
+
+
+async def _open_context(browser, route_filter: RouteFilter | None, record: bool = True):
+    context = await browser.new_context(viewport=VIEWPORT, **({} if HAR_REPLAY or not record else record_options()))
+    if HAR_REPLAY:
+        log(f"[har] replay da {HAR_REPLAY}")
+        await context.route_from_har(HAR_REPLAY, not_found="abort")
+    if route_filter:
+        # qui il filtro è acceso di default (a differenza di capture_daemon.py): il routing
+        # disattiva la cache HTTP del browser, ma un context nuovo parte comunque a cache vuota,
+        # quindi non si perde nulla e si risparmiano gli asset non necessari
+        await route_filter.attach(context)
+    return context
+
+
+async def capture_all(jobs: list[CaptureJob], pages: int = DEFAULT_PAGES,
+                      route_filter: RouteFilter | None = None,
+                      cache: HttpCache | None = None,
+                      resolver: bool = USE_RESOLVER,
+                      http_concurrency: int = DEFAULT_CONCURRENCY,
+                      daemon: str = DAEMON_SOCKET,
+                      fetcher: Fetcher | None = None,
+                      engine: "CaptureEngine | None" = None, mode: str = "network") -> list[dict]:
+    """
+    Esegue tutti i job in un solo browser con al massimo `pages` pagine aperte.
+    Con `route_filter` le richieste non necessarie vengono abortite a livello di context;
+    con `cache` i job già in cache vengono rivalidati via HTTP e il PNG vincente
+    di ogni cattura viene salvato in cache; con `resolver` si prova prima a scaricare
+    il PNG /streaming/ senza browser; con `daemon` (socket di capture_daemon.py) i job
+    rimasti vanno al browser già caldo. Il browser locale parte solo per quelli ancora aperti.
+    Con MAPS_HAR_REPLAY le risposte arrivano dal HAR registrato (har_replay.py): niente
+    cache, resolver, daemon né filtro di route, tutto resta offline.
+    Con `fetcher` cache e resolver usano quel client HTTP invece di aprirne uno; con
+    `engine` i job vanno alle pagine del browser condiviso (context della modalità `mode`).
+    Restituisce un dict di risultato per job, nello stesso ordine di `jobs`.
+    """
+    for job in jobs:
+        os.makedirs(os.path.dirname(job.out_png) or ".", exist_ok=True)
+    results: list = [None] * len(jobs)
+    if HAR_REPLAY:
+        cache, resolver, daemon, route_filter = None, False, "", None
+    if cache is not None:
+        with TRACE.span("cache_revalidate", jobs=len(jobs)):
+            served = await asyncio.to_thread(_serve_from_cache, jobs, cache, http_concurrency, fetcher)
+        for i, result in served.items():
+            results[i] = result
+    if resolver:
+        pending = [(i, job) for i, job in enumerate(jobs) if results[i] is None]
+        with TRACE.span("resolver", jobs=len(pending)):
+            resolved = await asyncio.to_thread(streaming_resolver.resolve_jobs, pending, cache, http_concurrency,
+                                               fetcher)
+        for i, hit in resolved.items():
+            results[i] = {**_new_result(jobs[i]), "saved": True, "src": hit["src"], "size": hit["size"]}
+    if daemon and any(r is None for r in results):
+        with TRACE.span("daemon"):
+            for i, result in (await _capture_via_daemon(jobs, results, daemon)).items():
+                results[i] = result
+    queue: asyncio.Queue = asyncio.Queue()
+    for i, job in enumerate(jobs):
+        if results[i] is None:
+            queue.put_nowait((i, job))
+    if queue.empty():
+        return results
+    if engine is not None:
+        context = await engine.context(mode, route_filter)
+        n = max(1, min(pages, queue.qsize()))
+        with TRACE.span("browser_jobs", jobs=queue.qsize(), pages=n, shared=True):
+            await asyncio.gather(*(_worker(context, queue, results, cache) for _ in range(n)))
+        return results
+    async with async_playwright() as p:
+        with TRACE.span("browser_launch"):
+            browser = await p.chromium.launch()
+            context = await _open_context(browser, route_filter)
+        try:
+            n = max(1, min(pages, queue.qsize()))
+            with TRACE.span("browser_jobs", jobs=queue.qsize(), pages=n):
+                await asyncio.gather(*(_worker(context, queue, results, cache) for _ in range(n)))
+        finally:
+            with TRACE.span("browser_close"):
+                # il HAR registrato viene scritto alla chiusura del context
+                await context.close()
+                await browser.close()
+    if route_filter:
+        log(route_filter.summary())
+        TRACE.count("route_blocked", route_filter.stats["blocked"])
+        TRACE.count("route_allowed_bytes", route_filter.stats["allowed_bytes"])
+    return results
+
+
+async def _capture_via_daemon(jobs: list[CaptureJob], results: list, socket_path: str) -> dict[int, dict]:
+    """
+    Manda al daemon (capture_daemon.py) i job non ancora risolti e serializzabili.
+    Se il daemon non risponde restituisce {} e i job restano al browser locale.
+    """
+    todo = [(i, job_to_wire(job)) for i, job in enumerate(jobs) if results[i] is None]
+    todo = [(i, wire) for i, wire in todo if wire is not None]
+    if not todo:
+        return {}
+    try:
+        reader, writer = await asyncio.open_unix_connection(socket_path, limit=DAEMON_LINE_LIMIT)
+    except OSError as e:
+        log(f"[warn] daemon non raggiungibile su {socket_path} ({e}), lancio il browser.")
+        return {}
+    try:
+        writer.write(json.dumps({"cmd": "capture", "jobs": [w for _, w in todo]}).encode() + b"\n")
+        await writer.drain()
+        reply = json.loads(await reader.readline() or b"{}")
+    except (OSError, ValueError) as e:
+        log(f"[warn] daemon: risposta non valida ({e}), lancio il browser.")
+        return {}
+    finally:
+        writer.close()
+    if "error" in reply:
+        log(f"[warn] daemon: {reply['error']}, lancio il browser.")
+        return {}
+    served = {}
+    for (i, _), result in zip(todo, reply.get("results", [])):
+        # percorsi come li conosce il chiamante
+        served[i] = {**result, "out_png": jobs[i].out_png}
+    log(f"[daemon] {len(served)} job catturati dal browser già avviato ({socket_path})")
+    return served
+
+
+class CaptureEngine:
+    """
+    Browser condiviso tra chiamate da thread diversi (es. i worker di map_pipeline): un event
+    loop in un thread dedicato, Chromium avviato alla prima cattura e un context per modalità
+    (network, screenshot), aperti fino a close(). Il filtro di route di un context è quello
+    della prima chiamata con quella modalità. La registrazione HAR resta del run one-shot.
+    """
+
+    def __init__(self, pages: int = DEFAULT_PAGES):
+        self.pages = pages
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="capture-engine", daemon=True)
+        self._thread.start()
+        self._lock: asyncio.Lock | None = None
+        self._playwright = None
+        self._browser = None
+        self._contexts: dict[str, tuple] = {}
+
+    async def context(self, mode: str, route_filter: RouteFilter | None):
+        # gira solo nel loop dell'engine: il lock si può creare qui senza altre protezioni
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            if self._browser is None:
+                with TRACE.span("browser_launch", shared=True):
+                    self._playwright = self._playwright or await async_playwright().start()
+                    self._browser = await self._playwright.chromium.launch()
+            if mode not in self._contexts:
+                self._contexts[mode] = (await _open_context(self._browser, route_filter, record=False), route_filter)
+            return self._contexts[mode][0]
+
+    def capture(self, jobs: list[CaptureJob], mode: str = "network", route_filter: RouteFilter | None = None,
+                cache: HttpCache | None = None, resolver: bool = USE_RESOLVER,
+                fetcher: Fetcher | None = None) -> list[dict]:
+        """capture_all sul browser condiviso; bloccante, chiamabile da qualunque thread."""
+        coro = capture_all(jobs, pages=self.pages, route_filter=route_filter, cache=cache, resolver=resolver,
+                           fetcher=fetcher, engine=self, mode=mode)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _close(self):
+        for context, route_filter in self._contexts.values():
+            await context.close()
+            if route_filter:
+                log(route_filter.summary())
+        with TRACE.span("browser_close", shared=True):
+            if self._browser is not None:
+                await self._browser.close()
+            if self._playwright is not None:
+                await self._playwright.stop()
+
+    def close(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+
+
+def run_capture(jobs: list[CaptureJob], pages: int = DEFAULT_PAGES,
+                route_filter: RouteFilter | None = None,
+                cache: HttpCache | None = None, resolver: bool = USE_RESOLVER,
+                http_concurrency: int = DEFAULT_CONCURRENCY, daemon: str = DAEMON_SOCKET) -> list[dict]:
+    results = asyncio.run(capture_all(jobs, pages=pages, route_filter=route_filter, cache=cache,
+                                      resolver=resolver, http_concurrency=http_concurrency, daemon=daemon))
+    profiles = [r["profile"] for r in results if r and r.get("profile")]
+    if profiles:
+        write_report(profiles)
+    return results
@@ -0,0 +1,285 @@
+from urllib.parse import urlsplit
+import json
+import os
+import statistics
+
+# Profilo lato browser via Chrome DevTools Protocol, per capire perché una cattura è lenta.
+# Per ogni pagina (una sessione CDP per job):
+#   - Performance.getMetrics a fine job (TaskDuration, ScriptDuration, LayoutDuration,
+#     JSHeapUsedSize, Nodes, ...)
+#   - waterfall di rete da Network.*: per richiesta attesa in coda, DNS, connect (TLS
+#     compreso), TTFB e download, byte trasferiti, cache del browser
+#   - long task del main thread (> 50 ms) da un PerformanceObserver iniettato prima degli
+#     script della pagina
+#   - percorso critico fino al PNG vincente (o, per gli screenshot, all'immagine più
+#     grande): catena degli initiator documento -> script -> ... -> PNG, con i tempi
+# Il report del run (maps/cdp_report.json) riassume le pagine e aggrega le risorse più
+# lente per URL senza query: è la base per decidere cosa bloccare (route_filter),
+# mettere in cache o anticipare.
+# Attivazione: MAPS_CDP_PROFILE=1 (capture_engine e script di debug). Solo Chromium.
+# I job risolti senza browser (cache, resolver) non hanno profilo: MAPS_RESOLVER=0 per
+# profilare comunque la pagina.
+# Solo libreria standard: lo usano sia capture_engine (API async) sia lo script di debug (sync).
+
+PROFILE = os.environ.get("MAPS_CDP_PROFILE", "0") != "0"
+REPORT_PATH = os.environ.get("MAPS_CDP_REPORT", "maps/cdp_report.json")
+TOP_N = 10
+
+LONG_TASKS_JS = """
+(() => {
+  window.__mapsLongTasks = [];
+  try {
+    new PerformanceObserver((list) => {
+      for (const e of list.getEntries()) {
+        window.__mapsLongTasks.push({
+          start_ms: Math.round(e.startTime), duration_ms: Math.round(e.duration),
+          source: (e.attribution || []).map(a => a.containerSrc || a.containerName || a.name).filter(Boolean).join(" ")
+        });
+      }
+    }).observe({type: "longtask", buffered: true});
+  } catch (e) {}
+})();
+"""
+
+METRICS = ("TaskDuration", "ScriptDuration", "LayoutDuration", "RecalcStyleDuration", "JSHeapUsedSize",
+           "Nodes", "Documents", "Frames", "LayoutCount", "RecalcStyleCount")
+
+
+def _initiator_url(initiator: dict) -> str | None:
+    if initiator.get("url"):
+        return initiator["url"]
+    stack = initiator.get("stack")
+    while stack:
+        for frame in stack.get("callFrames", []):
+            if frame.get("url"):
+                return frame["url"]
+        stack = stack.get("parent")
+    return None
+
+
+def _phase(timing: dict, start: str, end: str) -> float | None:
+    a, b = timing.get(start, -1), timing.get(end, -1)
+    return round(b - a, 1) if a >= 0 and b >= 0 else None
+
+
+class PageProfiler:
+    def __init__(self, label: str):
+        self.label = label
+        self.requests: dict[str, dict] = {}
+        self.session = None
+        self._script_id = None
+
+    # --- eventi CDP (stessi handler per API sync e async) ---
+
+    def _on_request(self, params: dict):
+        rid = params["requestId"]
+        req = self.requests.setdefault(rid, {"start": params["timestamp"]})
+        # su un redirect lo stesso requestId riparte con il nuovo URL: conta dall'inizio della catena
+        req.update({
+            "url": params["request"]["url"],
+            "type": params.get("type", "Other"),
+            "initiator": _initiator_url(params.get("initiator", {})),
+        })
+
+    def _on_response(self, params: dict):
+        req = self.requests.get(params["requestId"])
+        if req is None:
+            return
+        resp = params["response"]
+        req.update({
+            "status": resp.get("status"),
+            "mime": resp.get("mimeType"),
+            "timing": resp.get("timing"),
+            "cached": bool(resp.get("fromDiskCache") or resp.get("fromServiceWorker")),
+            "reused": resp.get("connectionReused"),
+        })
+
+    def _on_finished(self, params: dict):
+        req = self.requests.get(params["requestId"])
+        if req is not None:
+            req.update({"end": params["timestamp"], "bytes": params.get("encodedDataLength", 0)})
+
+    def _on_failed(self, params: dict):
+        req = self.requests.get(params["requestId"])
+        if req is not None:
+            req.update({"end": params["timestamp"], "failed": params.get("errorText", "failed")})
+
+    def _listen(self, session):
+        session.on("Network.requestWillBeSent", self._on_request)
+        session.on("Network.responseReceived", self._on_response)
+        session.on("Network.loadingFinished", self._on_finished)
+        session.on("Network.loadingFailed", self._on_failed)
+
+    # --- API async (capture_engine) ---
+
+    async def attach(self, page):
+        self.session = await page.context.new_cdp_session(page)
+        self._listen(self.session)
+        await self.session.send("Network.enable")
+        await self.session.send("Performance.enable")
+        reply = await self.session.send("Page.addScriptToEvaluateOnNewDocument", {"source": LONG_TASKS_JS})
+        self._script_id = reply.get("identifier")
+
+    async def finish(self, page, target_url: str | None = None) -> dict:
+        metrics = (await self.session.send("Performance.getMetrics")).get("metrics", [])
+        try:
+            long_tasks = await page.evaluate("window.__mapsLongTasks || []")
+        except Exception:
+            long_tasks = []
+        try:
+            if self._script_id:
+                await self.session.send("Page.removeScriptToEvaluateOnNewDocument", {"identifier": self._script_id})
+            await self.session.detach()
+        except Exception:
+            pass
+        return self.summary(metrics, long_tasks, target_url)
+
+    # --- API sync (download_maps_playwright_debug) ---
+
+    def attach_sync(self, page):
+        self.session = page.context.new_cdp_session(page)
+        self._listen(self.session)
+        self.session.send("Network.enable")
+        self.session.send("Performance.enable")
+        self._script_id = self.session.send("Page.addScriptToEvaluateOnNewDocument",
+                                            {"source": LONG_TASKS_JS}).get("identifier")
+
+    def finish_sync(self, page, target_url: str | None = None) -> dict:
+        metrics = self.session.send("Performance.getMetrics").get("metrics", [])
+        try:
+            long_tasks = page.evaluate("window.__mapsLongTasks || []")
+        except Exception:
+            long_tasks = []
+        try:
+            if self._script_id:
+                self.session.send("Page.removeScriptToEvaluateOnNewDocument", {"identifier": self._script_id})
+            self.session.detach()
+        except Exception:
+            pass
+        return self.summary(metrics, long_tasks, target_url)
+
+    # --- report ---
+
+    def waterfall(self) -> list[dict]:
+        reqs = [r for r in self.requests.values() if "url" in r]
+        if not reqs:
+            return []
+        t0 = min(r["start"] for r in reqs)
+        rows = []
+        for r in reqs:
+            timing = r.get("timing") or {}
+            end = r.get("end")
+            row = {
+                "url": r["url"], "type": r["type"], "status": r.get("status"), "mime": r.get("mime"),
+                "initiator": r.get("initiator"), "bytes": r.get("bytes", 0), "cached": r.get("cached", False),
+                "failed": r.get("failed"),
+                "start_ms": round((r["start"] - t0) * 1000, 1),
+                "total_ms": round((end - r["start"]) * 1000, 1) if end else None,
+                "end_ms": round((end - t0) * 1000, 1) if end else None,
+            }
+            if timing:
+                # i campi di timing sono ms relativi a requestTime (secondi, stessa base di timestamp)
+                row.update({
+                    "queued_ms": round((timing["requestTime"] - r["start"]) * 1000
+                                       + max(0.0, timing.get("dnsStart", -1)), 1),
+                    "dns_ms": _phase(timing, "dnsStart", "dnsEnd"),
+                    "connect_ms": _phase(timing, "connectStart", "connectEnd"),
+                    "tls_ms": _phase(timing, "sslStart", "sslEnd"),
+                    "ttfb_ms": _phase(timing, "sendEnd", "receiveHeadersEnd"),
+                    "download_ms": round((end - timing["requestTime"]) * 1000 - timing["receiveHeadersEnd"], 1)
+                    if end else None,
+                    "reused_connection": r.get("reused"),
+                })
+            rows.append(row)
+        return sorted(rows, key=lambda r: r["start_ms"])
+
+    @staticmethod
+    def critical_path(rows: list[dict], target_url: str | None) -> list[dict]:
+        """Catena degli initiator fino a `target_url` (default: l'immagine più grande)."""
+        if not target_url:
+            images = [r for r in rows if (r["mime"] or "").startswith("image/") and r["bytes"]]
+            target_url = max(images, key=lambda r: r["bytes"])["url"] if images else None
+        by_url = {}
+        for r in rows:
+            by_url.setdefault(r["url"], r)  # prima richiesta per URL
+        chain, seen = [], set()
+        url = target_url
+        while url and url in by_url and url not in seen:
+            seen.add(url)
+            r = by_url[url]
+            chain.append({k: r.get(k) for k in ("url", "type", "start_ms", "end_ms", "total_ms", "ttfb_ms", "bytes")})
+            url = r["initiator"]
+        return chain[::-1]
+
+    def summary(self, metrics: list[dict], long_tasks: list[dict], target_url: str | None) -> dict:
+        rows = self.waterfall()
+        values = {m["name"]: m["value"] for m in metrics}
+        done = [r for r in rows if r["total_ms"] is not None]
+        return {
+            "page": self.label,
+            "metrics": {k: round(values[k], 3) for k in METRICS if k in values},
+            "requests": len(rows),
+            "bytes": sum(r["bytes"] for r in rows),
+            "failed": sum(1 for r in rows if r["failed"]),
+            "long_tasks": {
+                "count": len(long_tasks),
+                "total_ms": sum(t["duration_ms"] for t in long_tasks),
+                "top": sorted(long_tasks, key=lambda t: -t["duration_ms"])[:5],
+            },
+            "slowest": sorted(done, key=lambda r: -r["total_ms"])[:TOP_N],
+            "critical_path": self.critical_path(rows, target_url),
+            "waterfall": rows,
+        }
+
+
+def _resource_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}"
+
+
+def build_report(pages: list[dict]) -> dict:
+    """Riassunto del run: per risorsa (URL senza query) tempi mediani/massimi su tutte le pagine."""
+    by_resource: dict[str, dict] = {}
+    for page in pages:
+        for r in page["waterfall"]:
+            if r["total_ms"] is None:
+                continue
+            agg = by_resource.setdefault(_resource_key(r["url"]), {"type": r["type"], "times": [], "bytes": 0,
+                                                                   "cached": 0, "critical": 0})
+            agg["times"].append(r["total_ms"])
+            agg["bytes"] += r["bytes"]
+            agg["cached"] += r["cached"]
+        for step in page["critical_path"]:
+            agg = by_resource.get(_resource_key(step["url"]))
+            if agg:
+                agg["critical"] += 1
+    resources = [
+        {"resource": key, "type": a["type"], "count": len(a["times"]),
+         "median_ms": round(statistics.median(a["times"]), 1), "max_ms": max(a["times"]),
+         "bytes": a["bytes"], "cached": a["cached"], "on_critical_path": a["critical"]}
+        for key, a in by_resource.items()
+    ]
+    resources.sort(key=lambda r: -r["median_ms"] * r["count"])
+    return {
+        "pages": [{k: v for k, v in p.items() if k != "waterfall"} for p in pages],
+        "slowest_resources": resources[:TOP_N * 2],
+        "waterfalls": {p["page"]: p["waterfall"] for p in pages},
+    }
+
+
+def write_report(pages: list[dict], path: str = REPORT_PATH) -> dict:
+    report = build_report(pages)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"[cdp] report di {len(pages)} pagine in {path}; risorse più lente (mediana x volte):", flush=True)
+    for r in report["slowest_resources"][:TOP_N]:
+        critical = " [critico]" if r["on_critical_path"] else ""
+        print(f"[cdp]   {r['median_ms']:8.1f} ms x{r['count']}  {r['bytes']/1024:8.1f} KB  {r['type']:<10} "
+              f"{r['resource']}{critical}", flush=True)
+    for p in report["pages"]:
+        path_ms = p["critical_path"][-1]["end_ms"] if p["critical_path"] else None
+        print(f"[cdp] {p['page']}: {p['requests']} richieste, long task {p['long_tasks']['count']} "
+              f"({p['long_tasks']['total_ms']} ms), percorso critico {len(p['critical_path'])} passi"
+              + (f" fino a {path_ms} ms" if path_ms is not None else ""), flush=True)
+    return report
@@ -0,0 +1,122 @@
+import base64
+import os
+
+# Esportazione del solo elemento grafico della pagina, al posto dello screenshot full-page.
+# Tra gli elementi che corrispondono al selettore si usa il visibile più grande (la mappa).
+#   - <canvas>: canvas.toDataURL("image/png") nella pagina, alla risoluzione nativa del
+#     canvas (senza riscalatura CSS, senza header/menu della pagina)
+#   - canvas "tainted" (immagini cross-origin) o <svg>/altro: screenshot ritagliato sul
+#     bounding box dell'elemento (ElementHandle.screenshot)
+# Prima di esportare si attende un segnale di render completato invece di una pausa fissa:
+# l'elemento esiste, ha dimensioni utili, un canvas non è più vuoto, le immagini della
+# pagina sono caricate e il contenuto non cambia tra due controlli consecutivi.
+# Solo libreria standard: lo usano sia capture_engine (API async) sia lo script di debug (sync).
+
+# override: MAPS_CHART_SELECTOR (vuoto = screenshot full-page come prima)
+CHART_SELECTOR = os.environ.get("MAPS_CHART_SELECTOR", "canvas, svg")
+RENDER_POLL_MS = 250
+MIN_SIDE_PX = 50
+
+# l'elemento visibile più grande tra quelli che corrispondono al selettore: il primo in
+# ordine di documento può essere un'icona SVG dell'header
+LARGEST_JS = """
+(sel) => {
+  let best = null, bestArea = 0;
+  for (const el of document.querySelectorAll(sel)) {
+    const r = el.getBoundingClientRect();
+    const style = getComputedStyle(el);
+    if (style.display === "none" || style.visibility === "hidden") continue;
+    if (r.width * r.height > bestArea) { best = el; bestArea = r.width * r.height; }
+  }
+  return best;
+}
+"""
+
+RENDER_DONE_JS = """
+([sel, minSide]) => {
+  const el = (""" + LARGEST_JS.strip() + """)(sel);
+  if (!el) return false;
+  const r = el.getBoundingClientRect();
+  if (r.width < minSide || r.height < minSide) return false;
+  let sig;
+  if (el.tagName === "CANVAS") {
+    try {
+      const len = el.toDataURL().length;
+      // canvas ancora vuoto: stessa codifica di un canvas bianco delle stesse dimensioni
+      const blank = document.createElement("canvas");
+      blank.width = el.width; blank.height = el.height;
+      if (len === blank.toDataURL().length) return false;
+      sig = el.width + "x" + el.height + ":" + len;
+    } catch (e) { sig = "tainted"; }
+  } else {
+    sig = el.outerHTML.length;
+  }
+  const prev = window.__mapsRenderSig;
+  window.__mapsRenderSig = sig;
+  return prev === sig && Array.from(document.images).every(i => i.complete);
+}
+"""
+
+CANVAS_EXPORT_JS = """
+(el) => {
+  if (el.tagName !== "CANVAS") return null;
+  try { return el.toDataURL("image/png"); } catch (e) { return null; }
+}
+"""
+
+
+def decode_data_url(data_url: str) -> bytes:
+    header, _, payload = data_url.partition(",")
+    if not header.startswith("data:image/png;base64"):
+        raise ValueError(f"data URL inattesa: {header[:40]}")
+    return base64.b64decode(payload)
+
+
+def _write(out_path: str, data: bytes):
+    tmp = f"{out_path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out_path)
+
+
+async def wait_rendered(page, selector: str, timeout_ms: int) -> bool:
+    """True se il render risulta completato entro il timeout."""
+    try:
+        await page.wait_for_function(RENDER_DONE_JS, arg=[selector, MIN_SIDE_PX],
+                                     polling=RENDER_POLL_MS, timeout=timeout_ms)
+        return True
+    except Exception:
+        return False
+
+
+async def export_chart(page, selector: str, out_path: str) -> str:
+    """Salva l'elemento `selector` visibile più grande in `out_path`; restituisce il metodo usato."""
+    el = (await page.evaluate_handle(LARGEST_JS, selector)).as_element()
+    if el is None:
+        raise RuntimeError(f"nessun elemento visibile per {selector!r}")
+    data_url = await el.evaluate(CANVAS_EXPORT_JS)
+    if data_url:
+        _write(out_path, decode_data_url(data_url))
+        return "canvas"
+    await el.screenshot(path=out_path)
+    return "element"
+
+
+def wait_rendered_sync(page, selector: str, timeout_ms: int) -> bool:
+    try:
+        page.wait_for_function(RENDER_DONE_JS, arg=[selector, MIN_SIDE_PX], polling=RENDER_POLL_MS, timeout=timeout_ms)
+        return True
+    except Exception:
+        return False
+
+
+def export_chart_sync(page, selector: str, out_path: str) -> str:
+    el = page.evaluate_handle(LARGEST_JS, selector).as_element()
+    if el is None:
+        raise RuntimeError(f"nessun elemento visibile per {selector!r}")
+    data_url = el.evaluate(CANVAS_EXPORT_JS)
+    if data_url:
+        _write(out_path, decode_data_url(data_url))
+        return "canvas"
+    el.screenshot(path=out_path)
+    return "element"
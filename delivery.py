@@ -0,0 +1,177 @@
+from email.message import EmailMessage
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import argparse
+import os
+import smtplib
+import threading
+import time
+
+from http_cache import copy_atomic
+
+# Destinazioni delle mappe per la pipeline (map_pipeline.py), una mappa per volta o a
+# piccoli lotti:
+#   DirectorySink  copia atomica in una directory (es. cartella condivisa, artifact)
+#   SmtpSink       email con le mappe in allegato; un messaggio ogni `batch` mappe,
+#                  il resto parte a flush()
+# Configurazione SMTP da env: MAPS_SMTP_HOST, MAPS_SMTP_PORT (465 = SSL, altrimenti
+# STARTTLS se il server lo offre), MAPS_SMTP_USER, MAPS_SMTP_PASS, MAPS_SMTP_FROM,
+# MAPS_SMTP_TO (indirizzi separati da virgola).
+# SmtpStandIn è un server SMTP minimo che salva i messaggi come .eml: serve a provare
+# la consegna in locale senza mandare email vere.
+#
+# Esempio:
+#   python delivery.py standin --port 8025 --out maildrop &
+#   MAPS_SMTP_HOST=127.0.0.1 MAPS_SMTP_PORT=8025 python map_pipeline.py --sink smtp
+
+SUBJECT = "Daily ECMWF Maps – {date}"
+BODY = "In allegato le mappe ECMWF (EFI TP 99° quantile): {names}."
+
+
+class DirectorySink:
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    def send(self, items: list[dict]) -> list[str | Exception]:
+        """Destinazione per mappa; le copie fallite restano nella lista come eccezione."""
+        sent = []
+        for item in items:
+            dest = os.path.join(self.out_dir, os.path.basename(item["path"]))
+            try:
+                copy_atomic(item["path"], dest)
+            except OSError as e:
+                sent.append(e)
+                continue
+            sent.append(dest)
+        return sent
+
+    def describe(self) -> str:
+        return f"directory {self.out_dir}"
+
+
+class SmtpSink:
+    def __init__(self, host: str | None = None, port: int | None = None, sender: str | None = None,
+                 recipients: list[str] | None = None, user: str | None = None, password: str | None = None):
+        self.host = host or os.environ.get("MAPS_SMTP_HOST", "127.0.0.1")
+        self.port = port or int(os.environ.get("MAPS_SMTP_PORT", "25"))
+        self.sender = sender or os.environ.get("MAPS_SMTP_FROM", "maps@localhost")
+        self.recipients = recipients or [r.strip() for r in os.environ.get("MAPS_SMTP_TO", "maps@localhost").split(",")
+                                         if r.strip()]
+        self.user = user or os.environ.get("MAPS_SMTP_USER")
+        self.password = password or os.environ.get("MAPS_SMTP_PASS")
+
+    def _message(self, items: list[dict]) -> EmailMessage:
+        msg = EmailMessage()
+        msg["Subject"] = SUBJECT.format(date=time.strftime("%Y-%m-%d"))
+        msg["From"] = self.sender
+        msg["To"] = ", ".join(self.recipients)
+        names = ", ".join(os.path.basename(i["path"]) for i in items)
+        msg.set_content(BODY.format(names=names))
+        for item in items:
+            with open(item["path"], "rb") as f:
+                msg.add_attachment(f.read(), maintype="image", subtype="png", filename=os.path.basename(item["path"]))
+        return msg
+
+    def send(self, items: list[dict]) -> list[str]:
+        """Un messaggio per tutto il lotto: se l'invio fallisce l'eccezione vale per ogni mappa."""
+        msg = self._message(items)
+        if self.port == 465:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=60)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=60)
+        with server:
+            if self.port != 465 and server.has_extn("starttls"):
+                server.starttls()
+            if self.user:
+                server.login(self.user, self.password or "")
+            server.send_message(msg)
+        return [f"mail:{os.path.basename(i['path'])}" for i in items]
+
+    def describe(self) -> str:
+        return f"smtp {self.host}:{self.port} -> {', '.join(self.recipients)}"
+
+
+class _SmtpHandler(StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 maps-standin ESMTP")
+        data = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if data is not None:
+                if line in (b".\r\n", b".\n"):
+                    self.server.store(b"".join(data))
+                    data = None
+                    self.reply("250 OK")
+                else:
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                continue
+            cmd = line.decode(errors="replace").strip().upper()
+            if cmd.startswith(("EHLO", "HELO")):
+                self.reply("250 maps-standin")
+            elif cmd == "DATA":
+                data = []
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif cmd == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # MAIL FROM, RCPT TO, RSET, NOOP: tutto accettato
+                self.reply("250 OK")
+
+
+class SmtpStandIn(ThreadingTCPServer):
+    """Server SMTP locale: ogni messaggio ricevuto finisce in <out_dir>/NNNN.eml."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, out_dir: str):
+        super().__init__(addr, _SmtpHandler)
+        self.out_dir = out_dir
+        self.messages = 0
+        self._lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def store(self, raw: bytes):
+        with self._lock:
+            self.messages += 1
+            path = os.path.join(self.out_dir, f"{self.messages:04d}.eml")
+        with open(path, "wb") as f:
+            f.write(raw)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+def standin_in_thread(out_dir: str, host: str = "127.0.0.1", port: int = 0) -> SmtpStandIn:
+    server = SmtpStandIn((host, port), out_dir)
+    threading.Thread(target=server.serve_forever, name="smtp-standin", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Stand-in SMTP locale per provare la consegna delle mappe.")
+    ap.add_argument("cmd", choices=["standin"])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8025)
+    ap.add_argument("--out", default="maildrop")
+    args = ap.parse_args(argv)
+
+    server = SmtpStandIn((args.host, args.port), args.out)
+    print(f"[info] SMTP stand-in su {args.host}:{server.port}, messaggi in {args.out}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 from datetime import datetime, timezone
-import requests
 import os
+import sys
+
+from fetch_pool import CHARTS_ORIGIN, DEFAULT_CONCURRENCY, Fetcher, run_all, stream_to_file
+from http_cache import cache_from_env, slot_from_url
+from streaming_resolver import MIN_PNG_SIZE
 
 # Calcola base_time in UTC, formato yyyymmddHHMM
 base_time = datetime.now(timezone.utc).strftime("%Y%m%d0000")
@@ -9,19 +13,41 @@ print(f"Base time: {base_time}")
 # Giorni da scaricare
 days = [1, 2, 3]
 urls = [
-    f"https://charts.ecmwf.int/products/efi2web_tp?area=Europe&base_time={base_time}&day={day}&quantile=99"
+    f"{CHARTS_ORIGIN}/products/efi2web_tp?area=Europe&base_time={base_time}&day={day}&quantile=99"
     for day in days
 ]
 
 os.makedirs("maps", exist_ok=True)
 
-for day, url in zip(days, urls):
-    print(f"Scarico giorno {day}...")
-    r = requests.get(url)
-    r.raise_for_status()
-    filepath = f"maps/map_day{day}.png"
-    with open(filepath, "wb") as f:
-        f.write(r.content)
+# Tutti i giorni in parallelo su un unico client keep-alive; con la cache
+# i rerun dello stesso base_time fanno solo GET condizionali (304)
+cache = cache_from_env()
+with Fetcher() as fetcher:
+    def fetch(job):
+        day, url = job
+        print(f"Scarico giorno {day}...")
+        filepath = f"maps/map_day{day}.png"
+        # scrittura in streaming su file temporaneo + rename; png=True: una pagina HTML
+        # o di errore al posto del PNG non viene salvata come mappa
+        if cache is not None:
+            _, from_cache = cache.fetch_to(fetcher, slot_from_url(url), url, filepath, png=True,
+                                           min_size=MIN_PNG_SIZE)
+            if from_cache:
+                print(f"Giorno {day} invariato (304), uso la cache")
+        else:
+            stream_to_file(fetcher, url, filepath, png=True, min_size=MIN_PNG_SIZE)
+        return filepath
+
+    results = run_all(fetch, zip(days, urls), concurrency=DEFAULT_CONCURRENCY)
+
+failed = []
+for (day, _), filepath, err in results:
+    if err:
+        print(f"Giorno {day} non scaricato: {err}")
+        failed.append(day)
+        continue
     print(f"Salvato {filepath}")
 
+if failed:
+    sys.exit(1)
 print("Tutte le mappe scaricate.")
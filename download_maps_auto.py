@@ -0,0 +1,225 @@
+from contextlib import nullcontext
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+from fetch_pool import CHARTS_ORIGIN, DEFAULT_CONCURRENCY, Fetcher, run_all, stream_to_file
+from http_cache import cache_from_env
+from run_trace import TRACE
+
+# Unico entry point al posto degli script a strategia fissa: prova le strategie in
+# cascata, ognuna solo sui lead day che le precedenti non hanno salvato.
+#   direct      GET dell'URL del prodotto, valido solo se risponde un PNG
+#   html        pagina letta a chunk + download del PNG trovato (download_maps_from_html)
+#   network     Playwright, cattura del PNG tra le response (capture_engine)
+#   screenshot  Playwright, export dell'elemento grafico
+# Playwright si importa solo quando la cascata arriva a una strategia browser: se non è
+# installato le strategie browser vengono saltate ed exit code 5 segnala al workflow
+# che serve installarlo e rilanciare.
+# L'ordine si adatta: per ogni strategia si tengono gli ultimi esiti e tempi in
+# .cache/maps/strategy_state.json (override: MAPS_STRATEGY_STATE) e si parte dal costo
+# atteso per mappa salvata più basso (tempo mediano / tasso di successo, con un costo a
+# priori per le strategie senza storia). Una strategia che fallisce da giorni finisce in
+# fondo ma resta nella cascata.
+#
+# Esempio:
+#   python download_maps_auto.py
+#   python download_maps_auto.py --only direct,html      # solo HTTP
+#   python download_maps_auto.py --only network,screenshot --days 2   # solo i day mancanti
+
+PAGE_URL = CHARTS_ORIGIN + "/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
+STATE_PATH = os.environ.get("MAPS_STRATEGY_STATE", ".cache/maps/strategy_state.json")
+MAX_HISTORY = 20
+EXIT_NEEDS_BROWSER = 5
+
+# costo a priori (secondi per run) nell'ordine "dal più economico"
+PRIOR_COST_S = {"direct": 1.0, "html": 3.0, "network": 30.0, "screenshot": 45.0}
+BROWSER_STRATEGIES = {"network", "screenshot"}
+
+
+def out_path(day: int) -> str:
+    return f"maps/map_day{day}.png"
+
+
+def run_direct(base_time: str, days: list[int], fetcher: Fetcher | None = None, engine=None) -> set[int]:
+    def fetch(day):
+        url = PAGE_URL.format(base=base_time, day=day)
+        # png=True: se il sito risponde con la pagina HTML il file non viene scritto.
+        # Niente cache: la voce per questo URL è la pagina HTML salvata dalla strategia html.
+        stream_to_file(fetcher, url, out_path(day), png=True)
+        return True
+
+    with nullcontext(fetcher) if fetcher is not None else Fetcher() as fetcher:
+        results = run_all(fetch, days, concurrency=DEFAULT_CONCURRENCY)
+    return {day for day, ok, err in results if ok and not err}
+
+
+def run_html(base_time: str, days: list[int], fetcher: Fetcher | None = None, engine=None) -> set[int]:
+    from download_maps_from_html import fetch_day
+
+    cache = cache_from_env()
+    with nullcontext(fetcher) if fetcher is not None else Fetcher() as fetcher:
+        results = run_all(lambda d: fetch_day(fetcher, base_time, d, cache), days, concurrency=DEFAULT_CONCURRENCY)
+    return {day for day, ok, err in results if ok and not err}
+
+
+def _run_browser(base_time: str, days: list[int], screenshot: bool, fetcher: Fetcher | None = None,
+                 engine=None) -> set[int]:
+    # import qui: capture_engine importa Playwright
+    from capture_engine import DEFAULT_PAGES, CaptureJob, run_capture
+    from chart_export import CHART_SELECTOR
+    from route_filter import route_filter_from_env
+
+    jobs = [
+        CaptureJob(
+            day=day,
+            url=PAGE_URL.format(base=base_time, day=day),
+            out_png=out_path(day),
+            screenshot_only=screenshot,
+            element=CHART_SELECTOR or None,
+            wait_selector="canvas, svg" if screenshot else None,
+            retries=2 if screenshot else 1,
+        )
+        for day in days
+    ]
+    mode = "screenshot" if screenshot else "network"
+    cache = None if screenshot else cache_from_env()
+    if engine is not None:
+        # browser già avviato dal chiamante (capture_engine.CaptureEngine), condiviso tra i thread
+        results = engine.capture(jobs, mode=mode, route_filter=route_filter_from_env(mode), cache=cache,
+                                 fetcher=fetcher)
+    else:
+        results = run_capture(jobs, pages=DEFAULT_PAGES, route_filter=route_filter_from_env(mode), cache=cache)
+    return {r["day"] for r in results if r["saved"]}
+
+
+STRATEGIES = {
+    "direct": run_direct,
+    "html": run_html,
+    "network": lambda base, days, **shared: _run_browser(base, days, screenshot=False, **shared),
+    "screenshot": lambda base, days, **shared: _run_browser(base, days, screenshot=True, **shared),
+}
+
+
+def playwright_available() -> bool:
+    try:
+        import playwright.async_api  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class StrategyState:
+    """Esiti recenti per strategia: [{"ok": frazione di day salvati, "s": secondi, "at": epoch}]."""
+
+    def __init__(self, path: str = STATE_PATH, scope: str = ""):
+        self.path = path
+        # chiamanti con un profilo di costo diverso (es. map_pipeline, un day per volta)
+        # tengono la storia sotto chiavi proprie, "<scope>/<strategia>"
+        self.scope = scope
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.history = json.load(f)
+        except (OSError, ValueError):
+            self.history = {}
+
+    def _key(self, name: str) -> str:
+        return f"{self.scope}/{name}" if self.scope else name
+
+    def record(self, name: str, ok: float, seconds: float):
+        with self._lock:
+            runs = self.history.setdefault(self._key(name), [])
+            runs.append({"ok": round(ok, 3), "s": round(seconds, 2), "at": int(time.time())})
+            del runs[:-MAX_HISTORY]
+
+    def expected_cost(self, name: str) -> float:
+        runs = self.history.get(self._key(name), [])
+        prior = PRIOR_COST_S.get(name, 60.0)
+        if not runs:
+            return prior
+        # successo stimato con un esito neutro a priori, così un solo fallimento non è definitivo
+        rate = (sum(r["ok"] for r in runs) + 0.5) / (len(runs) + 1)
+        return statistics.median(r["s"] for r in runs) / rate
+
+    def order(self, names: list[str]) -> list[str]:
+        return sorted(names, key=lambda n: (self.expected_cost(n), PRIOR_COST_S.get(n, 60.0)))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.history, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def cascade(base_time: str, days: list[int], names: list[str], state: StrategyState,
+            **shared) -> tuple[set[int], bool]:
+    """
+    Salva quanti più day possibile; restituisce (day salvati, strategie browser saltate).
+    `shared` (fetcher, engine) passa alle strategie client HTTP e browser già aperti.
+    """
+    missing = list(days)
+    skipped_browser = False
+    browser = None
+    for name in state.order(names):
+        if not missing:
+            break
+        if name in BROWSER_STRATEGIES:
+            browser = playwright_available() if browser is None else browser
+            if not browser:
+                print(f"[skip] {name}: Playwright non installato")
+                skipped_browser = True
+                continue
+        print(f"[try] {name} per day {missing} (costo atteso {state.expected_cost(name):.1f}s)", flush=True)
+        t0 = time.monotonic()
+        with TRACE.span("strategy", strategy=name, days=len(missing)) as span:
+            try:
+                saved = STRATEGIES[name](base_time, missing, **shared)
+            except Exception as e:
+                print(f"[err] {name}: {e}")
+                saved = set()
+            span["saved"] = len(saved)
+        elapsed = time.monotonic() - t0
+        state.record(name, len(saved) / len(missing), elapsed)
+        if saved:
+            print(f"[ok] {name}: day {sorted(saved)} in {elapsed:.1f}s")
+        missing = [d for d in missing if d not in saved]
+    return set(days) - set(missing), skipped_browser
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Scarica le mappe provando le strategie dalla più economica.")
+    ap.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+    ap.add_argument("--days", default="1,2,3")
+    ap.add_argument("--only", default=",".join(STRATEGIES), help="strategie ammesse, es. direct,html")
+    ap.add_argument("--state", default=STATE_PATH)
+    args = ap.parse_args(argv)
+
+    days = [int(d) for d in args.days.split(",") if d.strip()]
+    names = [n for n in args.only.split(",") if n in STRATEGIES]
+    print(f"[info] base_time={args.base_time}")
+    os.makedirs("maps", exist_ok=True)
+    state = StrategyState(args.state)
+    saved, skipped_browser = cascade(args.base_time, days, names, state)
+    state.save()
+
+    missing = [d for d in days if d not in saved]
+    # per il workflow: il secondo passaggio (con Playwright) lavora solo sui day mancanti
+    if os.environ.get("GITHUB_OUTPUT"):
+        with open(os.environ["GITHUB_OUTPUT"], "a") as f:
+            f.write(f"base_time={args.base_time}\nmissing={','.join(map(str, missing))}\n")
+    if not missing:
+        print(f"[done] PNG scaricati: {len(saved)}/{len(days)}")
+        sys.exit(0)
+    print(f"[fail] day {missing} non scaricati da nessuna strategia.")
+    sys.exit(EXIT_NEEDS_BROWSER if skipped_browser else 1)
+
+
+if __name__ == "__main__":
+    main()
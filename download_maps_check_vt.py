@@ -1,9 +1,14 @@
 
 from datetime import datetime, timedelta, timezone
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 import os, sys, re
 
-BASE_URL = "https://charts.ecmwf.int/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
+from capture_engine import CaptureJob, DEFAULT_PAGES, run_capture
+from fetch_pool import CHARTS_ORIGIN
+from http_cache import cache_from_env
+from route_filter import route_filter_from_env
+from run_trace import TRACE
+
+BASE_URL = CHARTS_ORIGIN + "/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
 
 MONTHS = {
     "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
@@ -41,79 +46,59 @@ def main():
 
     ensure_dir("maps/map_day1.png")
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch()
-        page = browser.new_page(viewport={"width": 1600, "height": 1000})
-
-        all_ok = True
-
-        for day in days:
-            expected_vt_start = (today + timedelta(days=day-1)).strftime("%Y%m%d")
-            url = BASE_URL.format(base=base_time_for_page, day=day)
-            out_png = f"maps/map_day{day}.png"
-            out_html = f"maps/map_day{day}.html"
-            out_txt = f"maps/map_day{day}.log.txt"
-            ensure_dir(out_png)
-
-            # Cattura PNG da network che contengono /streaming/YYYYMMDD-
-            best = {"buf": None, "url": None, "size": 0}
-            def on_response(resp):
-                try:
-                    ctype = (resp.headers or {}).get("content-type", "").lower()
-                    u = resp.url
-                    if f"/streaming/{today_str}-" in u and ("image/png" in ctype or u.lower().endswith(".png") or ".png?" in u.lower()):
-                        body = resp.body()
-                        size = len(body) if body else 0
-                        if size >= 50_000 and size > best["size"]:
-                            best.update({"buf": body, "url": u, "size": size})
-                            print(f"[net] PNG candidato: {u} ({size/1024:.1f} KB)")
-                except Exception as e:
-                    print(f"[warn] on_response error: {e}")
-
-            page.on("response", on_response)
-
-            try:
-                print(f"[step] Day {day}: {url}")
-                page.goto(url, wait_until="domcontentloaded", timeout=120_000)
-
-                # Testo pagina (non screenshot) per estrarre VT
-                body_text = page.evaluate("document.body.innerText || ''")
-                vt_start = vt_start_from_text(body_text)
-
-                # Salva HTML e log per audit
-                with open(out_html, "w", encoding="utf-8") as f:
-                    f.write(page.content())
-                with open(out_txt, "w", encoding="utf-8") as f:
-                    f.write(f"expected_vt_start={expected_vt_start}\n")
-                    f.write(f"found_vt_start={vt_start}\n")
-                    f.write(f"page_title={page.title()}\n")
-                    f.write(f"url={url}\n")
-
-                if not vt_start:
-                    print(f"[fail] impossibile leggere VT dal testo pagina per day {day}.")
-                    all_ok = False
-                elif vt_start != expected_vt_start:
-                    print(f"[fail] VT mismatch day {day}: atteso {expected_vt_start}, trovato {vt_start}")
-                    all_ok = False
-                else:
-                    print(f"[ok] VT day {day} corrisponde ({vt_start}).")
-
-                # Attendi un po' di traffico e salva PNG
-                page.wait_for_timeout(7000)
-                if best["buf"]:
-                    with open(out_png, "wb") as f:
-                        f.write(best["buf"])
-                    print(f"[ok] PNG salvato: {out_png} (src={best['url']})")
-                else:
-                    print(f"[warn] nessun PNG catturato per day {day}.")
-
-            except TimeoutError:
-                print(f"[err] timeout caricando day {day}")
-                all_ok = False
-            finally:
-                page.remove_listener("response", on_response)
-
-        browser.close()
+    # Cattura PNG da network che contengono /streaming/YYYYMMDD-,
+    # più il testo pagina (non screenshot) per estrarre VT
+    jobs = [
+        CaptureJob(
+            day=day,
+            url=BASE_URL.format(base=base_time_for_page, day=day),
+            out_png=f"maps/map_day{day}.png",
+            out_html=f"maps/map_day{day}.html",
+            match=f"/streaming/{today_str}-",
+            read_text=True,
+            max_wait_ms=7000,
+        )
+        for day in days
+    ]
+    results = run_capture(
+        jobs,
+        pages=DEFAULT_PAGES,
+        route_filter=route_filter_from_env("network"),
+        cache=cache_from_env(),
+    )
+
+    all_ok = True
+
+    for r in results:
+        day = r["day"]
+        expected_vt_start = (today + timedelta(days=day-1)).strftime("%Y%m%d")
+        if r["error"]:
+            print(f"[err] errore caricando day {day}: {r['error']}")
+            all_ok = False
+            continue
+
+        with TRACE.span("vt_extract", day=day) as span:
+            vt_start = vt_start_from_text(r["text"] or "")
+            span.update(expected=expected_vt_start, found=vt_start)
+
+        # Salva log per audit
+        with open(f"maps/map_day{day}.log.txt", "w", encoding="utf-8") as f:
+            f.write(f"expected_vt_start={expected_vt_start}\n")
+            f.write(f"found_vt_start={vt_start}\n")
+            f.write(f"page_title={r['title']}\n")
+            f.write(f"url={r['url']}\n")
+
+        if not vt_start:
+            print(f"[fail] impossibile leggere VT dal testo pagina per day {day}.")
+            all_ok = False
+        elif vt_start != expected_vt_start:
+            print(f"[fail] VT mismatch day {day}: atteso {expected_vt_start}, trovato {vt_start}")
+            all_ok = False
+        else:
+            print(f"[ok] VT day {day} corrisponde ({vt_start}).")
+
+        if not r["saved"]:
+            print(f"[warn] nessun PNG catturato per day {day}.")
 
     if not all_ok:
         print("[exit] Almeno un day non ha VT corrispondente al giorno atteso. Failing (opzione A).")
@@ -1,85 +1,157 @@
 \
 from datetime import datetime, timezone
+import codecs
 import os
 import re
 import time
-import requests
 from urllib.parse import urljoin, urlparse
 
-BASE_PAGE = "https://charts.ecmwf.int/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0 Safari/537.36",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-    "Accept-Language": "en-US,en;q=0.9,it;q=0.8",
-    "Referer": "https://charts.ecmwf.int/",
-    "Connection": "close",
-}
+from fetch_pool import CHARTS_ORIGIN, DEFAULT_CONCURRENCY, Fetcher, iter_chunks, run_all, stream_to_file
+from http_cache import HttpCache, cache_from_env, slot_from_url
+from run_trace import TRACE
 
-IMG_PATTERNS = [
-    re.compile(r'https?://[^\s"\']+?\.png(?:\?[^\s"\']*)?', re.I),
-    # spesso le immagini possono essere in JSON inline tipo "src":"...png"
-    re.compile(r'"src"\s*:\s*"([^"]+?\.png(?:\?[^"]*)?)"', re.I),
-]
+BASE_PAGE = CHARTS_ORIGIN + "/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
 
-def find_first_png(html: str, base_url: str) -> str | None:
-    # prova varie regex
-    for pat in IMG_PATTERNS:
-        m = pat.search(html)
-        if not m:
-            continue
-        url = m.group(1) if m.groups() else m.group(0)
-        # completa le relative
-        if not url.startswith("http"):
-            url = urljoin(base_url, url)
-        return url
-    return None
+# URL .png assoluti oppure, in JSON inline, "src":"...png" (spesso relativi):
+# una sola regex, gruppo "abs" = URL assoluto, "src" = valore JSON
+PNG_URL_RE = re.compile(
+    r'(?P<abs>https?://[^\s"\']+?\.png(?:\?[^\s"\']*)?)|"src"\s*:\s*"(?P<src>[^"]+?\.png(?:\?[^"]*)?)"',
+    re.I,
+)
+# un match che finisce negli ultimi OVERLAP caratteri del buffer potrebbe essere
+# troncato dal confine del chunk: si rimanda al chunk successivo
+OVERLAP = 2048
 
-def is_image_response(resp: requests.Response) -> bool:
-    ctype = resp.headers.get("Content-Type", "")
-    return "image/png" in ctype or resp.content[:8].startswith(b"\x89PNG\r\n\x1a\n")
+def rank_png_url(url: str, base_time: str) -> int:
+    # 0 = /streaming/ con la data del base_time, 1 = base_time nell'URL, 2 = /streaming/ qualsiasi, 3 = altro
+    if f"/streaming/{base_time[:8]}-" in url:
+        return 0
+    if base_time in url:
+        return 1
+    if "/streaming/" in url:
+        return 2
+    return 3
 
-def download_png(img_url: str, out_path: str, max_redirects: int = 3) -> None:
-    session = requests.Session()
-    session.headers.update(HEADERS)
+def scan_png_urls(chunks, base_url: str, base_time: str, stop_early: bool = True, sink=None) -> list[str]:
+    """
+    Scansione incrementale dell'HTML a chunk (bytes): una sola regex combinata,
+    match a cavallo dei chunk gestiti tenendo una coda di OVERLAP caratteri.
+    Restituisce tutti gli URL PNG trovati (relativi completati), ordinati per
+    rank_png_url e poi per posizione. Con stop_early smette di leggere appena trova
+    un candidato di rank 0 (il chiamante può chiudere la connessione).
+    `sink`, se dato, riceve il testo letto (es. file HTML di debug).
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    found: list[str] = []
+    buf = ""
+
+    def consume(final: bool) -> bool:
+        nonlocal buf
+        limit = len(buf) if final else len(buf) - OVERLAP
+        cut = max(0, limit)
+        for m in PNG_URL_RE.finditer(buf):
+            if m.end() > limit:
+                cut = min(cut, m.start())
+                break
+            url = m.group("abs") or m.group("src")
+            # completa le relative
+            if not url.startswith("http"):
+                url = urljoin(base_url, url)
+            if url not in found:
+                found.append(url)
+        buf = buf[cut:]
+        return stop_early and any(rank_png_url(u, base_time) == 0 for u in found)
+
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if sink:
+            sink.write(text)
+        buf += text
+        if consume(final=False):
+            break
+    else:
+        text = decoder.decode(b"", final=True)
+        if sink:
+            sink.write(text)
+        buf += text
+        consume(final=True)
+    return sorted(found, key=lambda u: rank_png_url(u, base_time))
+
+def _file_chunks(path: str, size: int = 64 * 1024):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(size), b"")
+
+def download_png(img_url: str, out_path: str, fetcher: Fetcher | None = None,
+                 cache: HttpCache | None = None, slot: dict | None = None) -> None:
+    # riusa il client condiviso (keep-alive); ne crea uno solo se chiamata isolatamente
+    own = fetcher is None
+    fetcher = fetcher or Fetcher(concurrency=1)
     # alcuni server richiedono referer corretto
     parsed = urlparse(img_url)
-    session.headers["Referer"] = f"{parsed.scheme}://{parsed.netloc}/"
-    # follow con timeout
-    r = session.get(img_url, timeout=60, allow_redirects=True)
-    r.raise_for_status()
-    if not is_image_response(r):
-        raise RuntimeError(f"Not a PNG (content-type={r.headers.get('Content-Type')}) from {img_url}")
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with open(out_path, "wb") as f:
-        f.write(r.content)
+    referer = {"Referer": f"{parsed.scheme}://{parsed.netloc}/"}
+    # il body va in streaming su file: header e firma PNG sono controllati prima di scaricare tutto
+    try:
+        if cache is not None:
+            # GET condizionale: su 304 il PNG arriva dalla cache su disco
+            _, from_cache = cache.fetch_to(fetcher, slot or {}, img_url, out_path, headers=referer, png=True)
+            if from_cache:
+                print(f"[cache] 304, PNG da cache: {img_url}")
+        else:
+            stream_to_file(fetcher, img_url, out_path, headers=referer, png=True)
+    finally:
+        if own:
+            fetcher.close()
+
+def fetch_day(fetcher: Fetcher, base_time: str, day: int, cache: HttpCache | None = None) -> bool:
+    page_url = BASE_PAGE.format(base=base_time, day=day)
+    slot = slot_from_url(page_url)
+    print(f"[step] GET page: {page_url}")
+    html_path = f"maps/map_day{day}.html"
+    with TRACE.span("html_scan", day=day) as span:
+        if cache is not None:
+            # con la cache la pagina si scarica intera (i rerun costano un 304), poi si scansiona il file
+            _, from_cache = cache.fetch_to(fetcher, slot, page_url, html_path)
+            if from_cache:
+                print(f"[cache] 304, pagina da cache (day {day})")
+            candidates = scan_png_urls(_file_chunks(html_path), page_url, base_time)
+        else:
+            # senza cache si legge a chunk e si chiude la connessione appena c'è un buon candidato;
+            # l'HTML letto fin lì viene salvato per debug (artifact)
+            with fetcher.stream(page_url) as resp, open(html_path, "w", encoding="utf-8") as sink:
+                resp.raise_for_status()
+                candidates = scan_png_urls(iter_chunks(resp), page_url, base_time, sink=sink)
+        span["candidates"] = len(candidates)
+    if not candidates:
+        print(f"[warn] Nessun URL .png trovato nell'HTML per day {day}")
+        return False
+    out_path = f"maps/map_day{day}.png"
+    # prova i candidati in ordine di rank finché uno è un PNG valido
+    for img_url in candidates:
+        print(f"[info] PNG trovato: {img_url}")
+        try:
+            download_png(img_url, out_path, fetcher, cache=cache, slot=slot)
+            TRACE.event("winning_png", day=day, url=img_url)
+            print(f"[ok] Salvato {out_path}")
+            return True
+        except Exception as e:
+            print(f"[err] Download PNG fallito (day {day}): {e}")
+    return False
 
 def main():
     base_time = datetime.now(timezone.utc).strftime("%Y%m%d0000")
     print(f"[info] base_time={base_time}")
     days = [1, 2, 3]
+    os.makedirs("maps", exist_ok=True)
+    # pagine e PNG di tutti i giorni in parallelo, stesso pool di connessioni
+    cache = cache_from_env()
+    with Fetcher() as fetcher:
+        results = run_all(lambda d: fetch_day(fetcher, base_time, d, cache), days, concurrency=DEFAULT_CONCURRENCY)
     ok = 0
-    for day in days:
-        page_url = BASE_PAGE.format(base=base_time, day=day)
-        print(f"[step] GET page: {page_url}")
-        resp = requests.get(page_url, headers=HEADERS, timeout=60)
-        resp.raise_for_status()
-        html = resp.text
-        # salva html per debug (artifact)
-        os.makedirs("maps", exist_ok=True)
-        with open(f"maps/map_day{day}.html", "w", encoding="utf-8") as f:
-            f.write(html)
-        img_url = find_first_png(html, page_url)
-        if not img_url:
-            print(f"[warn] Nessun URL .png trovato nell'HTML per day {day}")
-            continue
-        print(f"[info] PNG trovato: {img_url}")
-        out_path = f"maps/map_day{day}.png"
-        try:
-            download_png(img_url, out_path)
-            print(f"[ok] Salvato {out_path}")
+    for day, saved, err in results:
+        if err:
+            print(f"[err] GET pagina fallito (day {day}): {err}")
+        elif saved:
             ok += 1
-        except Exception as e:
-            print(f"[err] Download PNG fallito (day {day}): {e}")
     if ok == 0:
         # fallo fallire per far emergere l'errore nei logs della action
         raise SystemExit(1)
@@ -3,7 +3,12 @@ from datetime import datetime, timezone
 from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 import os, sys, time, traceback
 
-BASE_URL = "https://charts.ecmwf.int/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
+from cdp_profile import PROFILE, PageProfiler, write_report
+from chart_export import CHART_SELECTOR, export_chart_sync, wait_rendered_sync
+from fetch_pool import CHARTS_ORIGIN
+from latency import LATENCY, endpoint
+
+BASE_URL = CHARTS_ORIGIN + "/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
 
 def log(msg): print(msg, flush=True)
 
@@ -18,6 +23,7 @@ def main():
     os.makedirs("maps", exist_ok=True)
 
     ok = 0
+    profiles = []
     with sync_playwright() as p:
         # headless è True di default
         browser = p.chromium.launch()
@@ -27,9 +33,17 @@ def main():
         for day, url in zip(days, urls):
             out_path = f"maps/map_day{day}.png"
             html_dump = f"maps/map_day{day}.html"
+            # MAPS_CDP_PROFILE=1: metriche CDP, waterfall di rete e long task della pagina
+            profiler = PageProfiler(f"day {day}") if PROFILE else None
             try:
+                if profiler:
+                    profiler.attach_sync(page)
                 log(f"[step] Day {day}: goto {url}")
-                page.goto(url, wait_until="domcontentloaded", timeout=120_000)
+                # timeout dalle latenze misurate nei run precedenti (al massimo 120 s)
+                key = endpoint(url, "goto")
+                t0 = time.monotonic()
+                page.goto(url, wait_until="domcontentloaded", timeout=LATENCY.timeout_for(key, 120) * 1000)
+                LATENCY.record(key, time.monotonic() - t0)
                 # Salva HTML per debug (anche quando va bene aiuta)
                 with open(html_dump, "w", encoding="utf-8") as f:
                     f.write(page.content())
@@ -38,10 +52,17 @@ def main():
                     page.wait_for_selector("canvas, svg", timeout=40_000)
                 except PlaywrightTimeoutError:
                     log("[warn] canvas/svg non trovati entro 40s; continuo e provo screenshot comunque.")
-                # piccola attesa per render finale
-                page.wait_for_timeout(3000)
-                page.screenshot(path=out_path, full_page=True)
-                log(f"[ok] salvato {out_path}")
+                if CHART_SELECTOR:
+                    # solo il grafico, appena il render è completo (niente attesa fissa)
+                    if not wait_rendered_sync(page, CHART_SELECTOR, 10_000):
+                        log("[warn] render del grafico non confermato entro 10s; esporto comunque.")
+                    mode = export_chart_sync(page, CHART_SELECTOR, out_path)
+                else:
+                    # piccola attesa per render finale
+                    page.wait_for_timeout(3000)
+                    page.screenshot(path=out_path, full_page=True)
+                    mode = "page"
+                log(f"[ok] salvato {out_path} ({mode})")
                 ok += 1
             except Exception as e:
                 log(f"[err] day {day} failed: {e}")
@@ -54,7 +75,14 @@ def main():
                         log(f"[info] screenshot di emergenza salvato in {out_path}")
                     except Exception as _:
                         pass
+                if profiler and profiler.session:
+                    try:
+                        profiles.append(profiler.finish_sync(page))
+                    except Exception as e:
+                        log(f"[warn] profilo CDP day {day} non raccolto: {e}")
         browser.close()
+    if profiles:
+        write_report(profiles)
 
     # Exit code: 0 se almeno 1 screenshot è riuscito, 1 altrimenti
     if ok == 0:
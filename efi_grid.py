@@ -0,0 +1,317 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+# Dal PNG efi2web_tp a una griglia numerica di classi EFI, interrogabile per punti e box.
+#   1. colore -> classe: lookup table precalcolata su tutto lo spazio RGB quantizzato a
+#      6 bit per canale (2^18 voci, 256 KB). Ogni voce è la classe della legenda col colore
+#      più vicino, 0 (nessun segnale: terra, mare, confini, testo) se nessun colore è entro
+#      LEGEND_TOLERANCE. Decodificare una mappa è un solo indicizzamento NumPy: nessun loop.
+#   2. pixel -> lat/lon: polinomio (affine con 3-5 punti di controllo, quadratico con 6+)
+#      stimato ai minimi quadrati su punti di controllo in coordinate frazionarie
+#      dell'immagine, quindi indipendente dalla risoluzione della cattura. Le griglie
+#      lat/lon per (area, larghezza, altezza) si salvano in .cache/maps e si riusano.
+# Legenda e punti di controllo vanno calibrati su una cattura reale: MAPS_EFI_LEGEND e
+# MAPS_GEOREF (file JSON) sono obbligatori, senza si esce con errore invece di restituire
+# numeri plausibili ma sbagliati. EXAMPLE_LEGEND / EXAMPLE_CONTROL_POINTS mostrano solo il
+# formato (`python efi_grid.py template` li scrive come punto di partenza): i colori sono
+# indicativi e la proiezione del sito non è lat/lon, un polinomio di grado 2 la segue solo
+# a meno di qualche pixel con punti di controllo ben distribuiti.
+# Uscita: griglia uint8 in <png>.efi.npy, che si rilegge in memory map (np.load mmap_mode="r").
+#
+# Esempio:
+#   python efi_grid.py template --out-dir calibration     # poi si correggono i valori
+#   MAPS_EFI_LEGEND=calibration/efi_legend.json MAPS_GEOREF=calibration/efi_georef.json \
+#     python efi_grid.py decode maps/map_day1.png
+#   python efi_grid.py points maps/map_day1.png --sites sites.csv        # name,lat,lon
+#   python efi_grid.py bbox maps/map_day1.png --box 44,48,6,14          # lat0,lat1,lon0,lon1
+
+CACHE_DIR = os.environ.get("MAPS_GRID_CACHE", ".cache/maps")
+LUT_BITS = 6
+LEGEND_TOLERANCE = 40  # distanza RGB massima da un colore della legenda
+
+# solo formato, non calibrati
+# classe -> (EFI minimo, EFI massimo, colore); la classe 0 è riservata a "nessun segnale"
+EXAMPLE_LEGEND = [
+    {"class": 1, "min": 0.5, "max": 0.6, "rgb": [255, 255, 180]},
+    {"class": 2, "min": 0.6, "max": 0.7, "rgb": [255, 230, 100]},
+    {"class": 3, "min": 0.7, "max": 0.8, "rgb": [255, 170, 50]},
+    {"class": 4, "min": 0.8, "max": 0.9, "rgb": [240, 90, 40]},
+    {"class": 5, "min": 0.9, "max": 1.0, "rgb": [190, 30, 60]},
+]
+
+# [x/larghezza, y/altezza, lon, lat] per area
+EXAMPLE_CONTROL_POINTS = {
+    "Europe": [
+        [0.05, 0.05, -25.0, 72.0],
+        [0.95, 0.05, 45.0, 72.0],
+        [0.05, 0.95, -25.0, 30.0],
+        [0.95, 0.95, 45.0, 30.0],
+        [0.50, 0.50, 10.0, 51.0],
+    ],
+}
+
+
+def _calibration(env: str, what: str):
+    path = os.environ.get(env)
+    if not path:
+        raise RuntimeError(f"{what} non calibrata: serve {env} (file JSON, vedi `python efi_grid.py template`)")
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _digest(obj) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _save_npy(path: str, array: np.ndarray):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}-{threading.get_ident()}.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+class Legend:
+    def __init__(self, entries: list[dict] | None = None):
+        self.entries = _calibration("MAPS_EFI_LEGEND", "legenda EFI") if entries is None else entries
+        n = max(e["class"] for e in self.entries) + 1
+        # limiti EFI per classe, indicizzabili con la griglia stessa; NaN per la classe 0
+        self.lo = np.full(n, np.nan, dtype=np.float32)
+        self.hi = np.full(n, np.nan, dtype=np.float32)
+        for e in self.entries:
+            self.lo[e["class"]], self.hi[e["class"]] = e["min"], e["max"]
+        self._lut = None
+
+    def lut(self) -> np.ndarray:
+        """LUT uint8 su 2^(3*LUT_BITS) colori, calcolata una volta e salvata per hash della legenda."""
+        if self._lut is not None:
+            return self._lut
+        path = os.path.join(CACHE_DIR, f"efi_lut_{_digest([self.entries, LUT_BITS, LEGEND_TOLERANCE])}.npy")
+        try:
+            self._lut = np.load(path)
+            return self._lut
+        except (OSError, ValueError):
+            pass
+        levels = 1 << LUT_BITS
+        step = 256 // levels
+        # centro di ogni cella quantizzata, per tutti i colori in una volta: (2^18, 3)
+        axis = np.arange(levels, dtype=np.int32) * step + step // 2
+        r, g, b = np.meshgrid(axis, axis, axis, indexing="ij")
+        colours = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+        palette = np.array([e["rgb"] for e in self.entries], dtype=np.int32)
+        dist2 = ((colours[:, None, :] - palette[None, :, :]) ** 2).sum(axis=-1)
+        nearest = dist2.argmin(axis=1)
+        classes = np.array([e["class"] for e in self.entries], dtype=np.uint8)[nearest]
+        classes[dist2[np.arange(len(nearest)), nearest] > LEGEND_TOLERANCE ** 2] = 0
+        self._lut = classes
+        _save_npy(path, classes)
+        return classes
+
+    def decode(self, rgb: np.ndarray) -> np.ndarray:
+        """(H, W, 3) uint8 -> (H, W) uint8 di classi."""
+        q = rgb.astype(np.uint32) >> (8 - LUT_BITS)
+        index = (q[..., 0] << (2 * LUT_BITS)) | (q[..., 1] << LUT_BITS) | q[..., 2]
+        return self.lut()[index]
+
+
+def _design(u: np.ndarray, v: np.ndarray, degree: int) -> np.ndarray:
+    cols = [np.ones_like(u), u, v]
+    if degree == 2:
+        cols += [u * u, u * v, v * v]
+    return np.stack(cols, axis=-1)
+
+
+class Georef:
+    """Trasformazione pixel <-> lon/lat per un'area, stimata dai punti di controllo."""
+
+    def __init__(self, area: str = "Europe", points: list | None = None):
+        if points is None:
+            points = _calibration("MAPS_GEOREF", "georeferenziazione").get(area)
+        if not points or len(points) < 3:
+            raise ValueError(f"punti di controllo insufficienti per l'area {area!r}")
+        self.area = area
+        self.points = points
+        p = np.asarray(points, dtype=np.float64)
+        self.degree = 2 if len(p) >= 6 else 1
+        fx, fy, lon, lat = p.T
+        # diretta (frazione pixel -> lon/lat) e inversa (lon/lat -> frazione pixel)
+        self.forward = np.linalg.lstsq(_design(fx, fy, self.degree), np.stack([lon, lat], 1), rcond=None)[0]
+        self.inverse = np.linalg.lstsq(_design(lon, lat, self.degree), np.stack([fx, fy], 1), rcond=None)[0]
+
+    def grid(self, width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+        """Griglie float32 (H, W) di lon e lat al centro di ogni pixel, in cache su disco."""
+        path = os.path.join(CACHE_DIR, f"georef_{self.area}_{width}x{height}_{_digest(self.points)}.npy")
+        try:
+            cached = np.load(path, mmap_mode="r")
+            return cached[0], cached[1]
+        except (OSError, ValueError):
+            pass
+        fx = (np.arange(width, dtype=np.float64) + 0.5) / width
+        fy = (np.arange(height, dtype=np.float64) + 0.5) / height
+        u, v = np.meshgrid(fx, fy)
+        lonlat = (_design(u, v, self.degree) @ self.forward).astype(np.float32)
+        stacked = np.moveaxis(lonlat, -1, 0)
+        _save_npy(path, stacked)
+        return stacked[0], stacked[1]
+
+    def to_pixel(self, lat, lon, width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+        """Righe e colonne (int) per array di lat/lon; -1 se il punto cade fuori dall'immagine."""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        frac = _design(lon, lat, self.degree) @ self.inverse
+        cols = np.floor(frac[..., 0] * width).astype(np.int64)
+        rows = np.floor(frac[..., 1] * height).astype(np.int64)
+        outside = (cols < 0) | (cols >= width) | (rows < 0) | (rows >= height)
+        cols[outside] = -1
+        rows[outside] = -1
+        return rows, cols
+
+
+class EfiGrid:
+    def __init__(self, classes: np.ndarray, legend: Legend, georef: Georef):
+        self.classes = classes
+        self.legend = legend
+        self.georef = georef
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.classes.shape
+
+    def points(self, lat, lon) -> list[dict]:
+        """Classe e intervallo EFI per centinaia di siti in una sola passata vettoriale."""
+        h, w = self.shape
+        rows, cols = self.georef.to_pixel(lat, lon, w, h)
+        inside = rows >= 0
+        cls = np.zeros(rows.shape, dtype=np.uint8)
+        cls[inside] = self.classes[rows[inside], cols[inside]]
+        lo, hi = self.legend.lo[cls], self.legend.hi[cls]
+        return [{"class": int(c) if ok else None, "efi_min": None if np.isnan(a) else round(float(a), 3),
+                 "efi_max": None if np.isnan(b) else round(float(b), 3)}
+                for c, ok, a, b in zip(cls, inside, lo, hi)]
+
+    def window(self, lat0: float, lat1: float, lon0: float, lon1: float) -> tuple[tuple[slice, slice], np.ndarray]:
+        """Finestra di pixel che contiene il box e maschera (sulla finestra) dei pixel dentro il box."""
+        h, w = self.shape
+        lons, lats = self.georef.grid(w, h)
+        corners_lat = np.array([lat0, lat0, lat1, lat1, (lat0 + lat1) / 2])
+        corners_lon = np.array([lon0, lon1, lon0, lon1, (lon0 + lon1) / 2])
+        frac = _design(corners_lon, corners_lat, self.georef.degree) @ self.georef.inverse
+        c0, c1 = np.clip([np.floor(frac[:, 0].min() * w) - 1, np.ceil(frac[:, 0].max() * w) + 1], 0, w).astype(int)
+        r0, r1 = np.clip([np.floor(frac[:, 1].min() * h) - 1, np.ceil(frac[:, 1].max() * h) + 1], 0, h).astype(int)
+        win = (slice(r0, r1), slice(c0, c1))
+        win_lat, win_lon = lats[win], lons[win]
+        mask = ((win_lat >= min(lat0, lat1)) & (win_lat <= max(lat0, lat1))
+                & (win_lon >= min(lon0, lon1)) & (win_lon <= max(lon0, lon1)))
+        return win, mask
+
+    def bbox(self, lat0: float, lat1: float, lon0: float, lon1: float) -> dict:
+        """Statistiche delle classi nel box: solo la finestra di pixel che lo contiene viene letta."""
+        win, mask = self.window(lat0, lat1, lon0, lon1)
+        cls = np.asarray(self.classes[win])[mask]
+        if not cls.size:
+            return {"pixels": 0, "signal_fraction": None, "max_class": None, "efi_max": None, "histogram": {}}
+        counts = np.bincount(cls, minlength=len(self.legend.lo))
+        top = int(cls.max())
+        return {
+            "pixels": int(cls.size),
+            "signal_fraction": round(float(1 - counts[0] / cls.size), 4),
+            "max_class": top,
+            "efi_max": None if top == 0 else round(float(self.legend.hi[top]), 3),
+            "histogram": {int(c): int(n) for c, n in enumerate(counts) if n},
+        }
+
+
+def grid_path(png_path: str) -> str:
+    return os.path.splitext(png_path)[0] + ".efi.npy"
+
+
+def decode_png(png_path: str, legend: Legend | None = None, area: str = "Europe", save: bool = True) -> EfiGrid:
+    legend = legend or Legend()
+    with Image.open(png_path) as im:
+        rgb = np.asarray(im.convert("RGB"))
+    classes = legend.decode(rgb)
+    if save:
+        _save_npy(grid_path(png_path), classes)
+    return EfiGrid(classes, legend, Georef(area))
+
+
+def load_grid(png_path: str, legend: Legend | None = None, area: str = "Europe") -> EfiGrid:
+    """Griglia già decodificata in memory map (decodifica al volo se manca o è più vecchia del PNG)."""
+    path = grid_path(png_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(png_path):
+        return EfiGrid(np.load(path, mmap_mode="r"), legend or Legend(), Georef(area))
+    return decode_png(png_path, legend, area)
+
+
+def read_sites(path: str) -> tuple[list[str], np.ndarray, np.ndarray]:
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    return ([r["name"] for r in rows], np.array([float(r["lat"]) for r in rows]),
+            np.array([float(r["lon"]) for r in rows]))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Decodifica le mappe EFI in griglie di classi e le interroga.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p_dec = sub.add_parser("decode", help="PNG -> <png>.efi.npy")
+    p_dec.add_argument("paths", nargs="+")
+    p_pts = sub.add_parser("points", help="classe EFI per i siti di un CSV name,lat,lon")
+    p_pts.add_argument("path")
+    p_pts.add_argument("--sites", required=True)
+    p_box = sub.add_parser("bbox", help="statistiche su un box lat0,lat1,lon0,lon1")
+    p_box.add_argument("path")
+    p_box.add_argument("--box", required=True)
+    p_tpl = sub.add_parser("template", help="scrive legenda e punti di controllo d'esempio da calibrare")
+    p_tpl.add_argument("--out-dir", default="calibration")
+    for p in (p_dec, p_pts, p_box):
+        p.add_argument("--area", default="Europe")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "template":
+        os.makedirs(args.out_dir, exist_ok=True)
+        for name, data in (("efi_legend.json", EXAMPLE_LEGEND), ("efi_georef.json", EXAMPLE_CONTROL_POINTS)):
+            path = os.path.join(args.out_dir, name)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1)
+            print(f"[ok] {path}: valori d'esempio, da verificare su una cattura reale")
+        return
+    try:
+        legend = Legend()
+        Georef(args.area)
+    except RuntimeError as e:
+        print(f"[fail] {e}")
+        sys.exit(2)
+    if args.cmd == "decode":
+        for path in args.paths:
+            if not os.path.exists(path):
+                continue
+            t0 = time.perf_counter()
+            grid = decode_png(path, legend, args.area)
+            signal = float(np.count_nonzero(grid.classes)) / grid.classes.size
+            print(f"[efi] {path} -> {grid_path(path)}: {grid.shape[1]}x{grid.shape[0]}, "
+                  f"segnale su {100*signal:.1f}% dei pixel ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+        return
+    if not os.path.exists(args.path):
+        print(f"[fail] {args.path} non trovato.")
+        sys.exit(1)
+    grid = load_grid(args.path, legend, area=args.area)
+    if args.cmd == "points":
+        names, lat, lon = read_sites(args.sites)
+        out = [{"name": n, "lat": float(a), "lon": float(o), **r}
+               for n, a, o, r in zip(names, lat, lon, grid.points(lat, lon))]
+    else:
+        lat0, lat1, lon0, lon1 = (float(v) for v in args.box.split(","))
+        out = grid.bbox(lat0, lat1, lon0, lon1)
+    print(json.dumps(out, indent=1))
+
+
+if __name__ == "__main__":
+    main()
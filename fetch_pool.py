@@ -0,0 +1,300 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import hashlib
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # httpx (con il pacchetto h2) permette HTTP/2 sulla stessa connessione; è opzionale
+    import httpx
+    import h2  # noqa: F401
+except ImportError:
+    httpx = None
+
+from latency import LATENCY, endpoint
+from run_trace import TRACE
+
+# Fetch concorrente con connessioni keep-alive condivise tra tutte le richieste.
+# Un solo client per run: le pagine e i PNG di tutti i giorni riusano lo stesso
+# pool di connessioni (niente handshake TCP+TLS per ogni GET).
+
+# origine del sito (override: ECMWF_CHARTS_ORIGIN, es. lo stand-in locale di bench_server.py)
+CHARTS_ORIGIN = os.environ.get("ECMWF_CHARTS_ORIGIN", "https://charts.ecmwf.int").rstrip("/")
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9,it;q=0.8",
+    "Referer": f"{CHARTS_ORIGIN}/",
+}
+
+# numero massimo di richieste in volo (override: MAPS_CONCURRENCY)
+DEFAULT_CONCURRENCY = int(os.environ.get("MAPS_CONCURRENCY", "8"))
+# timeout fisso, usato finché non ci sono abbastanza latenze misurate (vedi latency.py)
+DEFAULT_TIMEOUT = 60.0
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+CHUNK_SIZE = 64 * 1024
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """
+    Un token bucket per host, condiviso da tutti i Fetcher del processo.
+    rate = richieste/secondo per host (0 = nessun limite), burst = picco ammesso.
+    """
+
+    def __init__(self, rate: float = 0.0, burst: float = 1.0):
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url: str):
+        if self.rate <= 0:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        bucket.acquire()
+
+
+# override: MAPS_RATE (req/s per host) e MAPS_BURST
+RATE_LIMITER = HostRateLimiter(float(os.environ.get("MAPS_RATE", "0")), float(os.environ.get("MAPS_BURST", "4")))
+
+
+class Fetcher:
+    """
+    Client HTTP condiviso e thread-safe. Usa httpx con HTTP/2 se disponibile
+    (MAPS_HTTP2=0 per disattivarlo), altrimenti una requests.Session con un
+    pool di connessioni grande quanto la concorrenza (più le richieste hedged).
+    Con timeout=None il timeout deriva dalle latenze misurate per l'endpoint; se una
+    richiesta in streaming supera il p95 osservato ne parte una copia e vince la prima
+    risposta (MAPS_HEDGE=0 per disattivare). I GET non in streaming non vengono duplicati:
+    la copia perdente scaricherebbe comunque tutto il body.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, headers: dict | None = None,
+                 http2: bool | None = None, hedge: bool | None = None):
+        self.concurrency = max(1, concurrency)
+        headers = dict(headers or HEADERS)
+        if http2 is None:
+            http2 = os.environ.get("MAPS_HTTP2", "1") != "0"
+        if hedge is None:
+            hedge = os.environ.get("MAPS_HEDGE", "1") != "0"
+        self.hedge = hedge
+        self.http2 = bool(http2 and httpx is not None)
+        # ogni richiesta può avere una copia hedged in volo
+        slots = 2 * self.concurrency if hedge else self.concurrency
+        if self.http2:
+            limits = httpx.Limits(max_connections=slots, max_keepalive_connections=slots)
+            self._client = httpx.Client(http2=True, headers=headers, limits=limits, follow_redirects=True)
+        else:
+            self._client = requests.Session()
+            self._client.headers.update(headers)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=slots)
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="hedge") if hedge else None
+
+    def _open(self, url: str, timeout: float, headers: dict | None, stream: bool):
+        RATE_LIMITER.acquire(url)
+        if self.http2:
+            request = self._client.build_request("GET", url, headers=headers, timeout=timeout)
+            return self._client.send(request, stream=stream)
+        return self._client.get(url, timeout=timeout, headers=headers, allow_redirects=True, stream=stream)
+
+    def _timed(self, key: str, url: str, timeout: float, headers: dict | None, stream: bool):
+        t0 = time.monotonic()
+        r = self._open(url, timeout, headers, stream)
+        LATENCY.record(key, time.monotonic() - t0)
+        return r
+
+    def _hedged(self, key: str, url: str, timeout: float, headers: dict | None, stream: bool, delay: float):
+        # si misura solo il primo tentativo, anche se perde: la latenza del vincitore
+        # sottostimerebbe il p95 e farebbe partire sempre più copie
+        futures = [self._hedge_pool.submit(self._timed, key, url, timeout, headers, stream)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            TRACE.count("hedged_requests")
+            futures.append(self._hedge_pool.submit(self._open, url, timeout, headers, stream))
+        pending, winner, error = set(futures), None, None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is not None:
+                    error = error or f.exception()
+                elif winner is None:
+                    winner = f
+                else:
+                    f.result().close()
+        # la richiesta perdente si chiude appena risponde: un GET sincrono già partito
+        # non si può interrompere prima, ma il suo body non viene letto
+        for f in pending:
+            f.add_done_callback(_close_loser)
+        if winner is None:
+            raise error
+        if winner is not futures[0]:
+            TRACE.count("hedge_wins")
+        return winner.result()
+
+    def _request(self, url: str, timeout: float | None, headers: dict | None, stream: bool):
+        # stream: latenza fino agli header; get: fino al body completo
+        key = endpoint(url, "stream" if stream else "get")
+        if timeout is None:
+            timeout = LATENCY.timeout_for(key, DEFAULT_TIMEOUT)
+        # solo lo streaming si può abbandonare senza scaricare il body (vedi _close_loser)
+        delay = LATENCY.hedge_after(key) if self.hedge and stream else None
+        if delay is None:
+            return self._timed(key, url, timeout, headers, stream)
+        return self._hedged(key, url, timeout, headers, stream, delay)
+
+    def get(self, url: str, timeout: float | None = None, headers: dict | None = None):
+        # requests.Response e httpx.Response espongono entrambi status_code/headers/content/text
+        return self._request(url, timeout, headers, stream=False)
+
+    def head(self, url: str, timeout: float | None = None, headers: dict | None = None):
+        key = endpoint(url, "head")
+        if timeout is None:
+            timeout = LATENCY.timeout_for(key, DEFAULT_TIMEOUT)
+        RATE_LIMITER.acquire(url)
+        t0 = time.monotonic()
+        if self.http2:
+            r = self._client.head(url, timeout=timeout, headers=headers, follow_redirects=True)
+        else:
+            r = self._client.head(url, timeout=timeout, headers=headers, allow_redirects=True)
+        LATENCY.record(key, time.monotonic() - t0)
+        return r
+
+    @contextmanager
+    def stream(self, url: str, timeout: float | None = None, headers: dict | None = None):
+        """GET senza leggere il body: il chiamante lo consuma a pezzi con iter_chunks()."""
+        r = self._request(url, timeout, headers, stream=True)
+        try:
+            yield r
+        finally:
+            r.close()
+
+    def close(self):
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False)
+        self._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _close_loser(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def iter_chunks(resp, chunk_size: int = CHUNK_SIZE):
+    if hasattr(resp, "iter_content"):
+        return resp.iter_content(chunk_size)
+    return resp.iter_bytes(chunk_size)
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stream_to_file(fetcher: Fetcher, url: str, out_path: str, headers: dict | None = None,
+                   timeout: float | None = None, png: bool = False, min_size: int = 0) -> dict:
+    """
+    Scarica `url` direttamente su file a pezzi, senza tenere il body in memoria.
+    Con png=True rifiuta subito le risposte con Content-Length < min_size e quelle
+    il cui primo pezzo non inizia con la firma PNG. Scrive su un file temporaneo
+    rinominato atomicamente in `out_path` solo a download completo e valido.
+    Restituisce {"status", "headers", "size", "sha256"}; su 304 non scrive nulla.
+    """
+    with TRACE.span("http_stream", url=url) as span, fetcher.stream(url, timeout=timeout, headers=headers) as r:
+        info = {"status": r.status_code, "headers": r.headers, "size": 0, "sha256": None}
+        span["status"] = r.status_code
+        if r.status_code == 304:
+            TRACE.count("not_modified")
+            return info
+        r.raise_for_status()
+        length = r.headers.get("Content-Length")
+        if png and length and length.isdigit() and int(length) < min_size:
+            raise RuntimeError(f"PNG troppo piccolo ({length} B < {min_size} B) da {url}")
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        tmp = f"{out_path}.part{os.getpid()}-{threading.get_ident()}"
+        digest = hashlib.sha256()
+        head = b""
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in iter_chunks(r):
+                    if png and len(head) < len(PNG_MAGIC):
+                        head += chunk[:len(PNG_MAGIC)]
+                        if len(head) >= len(PNG_MAGIC) and not head.startswith(PNG_MAGIC):
+                            raise RuntimeError(f"Not a PNG (content-type={r.headers.get('Content-Type')}) from {url}")
+                    f.write(chunk)
+                    digest.update(chunk)
+                    info["size"] += len(chunk)
+            if info["size"] < min_size or (png and not head.startswith(PNG_MAGIC)):
+                raise RuntimeError(f"PNG non valido o troppo piccolo ({info['size']} B) da {url}")
+            os.replace(tmp, out_path)
+            span["bytes"] = info["size"]
+            TRACE.count("http_bytes", info["size"])
+        except BaseException:
+            _remove_quietly(tmp)
+            raise
+    info["sha256"] = digest.hexdigest()
+    return info
+
+
+def run_all(fn, items, concurrency: int = DEFAULT_CONCURRENCY) -> list:
+    """
+    Esegue fn(item) per tutti gli item con al massimo `concurrency` thread.
+    Restituisce [(item, risultato, errore)] nello stesso ordine di `items`:
+    un errore su un item non interrompe gli altri.
+    """
+    items = list(items)
+
+    def safe(item):
+        try:
+            return item, fn(item), None
+        except Exception as e:
+            return item, None, e
+
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as ex:
+        return list(ex.map(safe, items))
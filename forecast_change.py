@@ -0,0 +1,229 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from efi_grid import EfiGrid, Georef, Legend, load_grid
+from fetch_pool import run_all
+from map_archive import DEFAULT_ARCHIVE, DEFAULT_SLOT, MapArchive
+
+# Come è cambiata la previsione tra due run per lo stesso valid time: il day N di oggi
+# e il day N+1 di ieri coprono lo stesso VT (VT = base_time + day - 1, lo stesso che
+# check_vt legge dal testo della pagina e che la data /streaming/ conferma).
+# Le coppie si prendono dall'indice di map_archive: per ogni mappa del base_time
+# richiesto, la mappa dello stesso VT/area/quantile del base_time precedente.
+# Tutto lavora sulle griglie di classi EFI di efi_grid (già in cache come .efi.npy
+# accanto agli oggetti dell'archivio), in NumPy; servono MAPS_EFI_LEGEND e MAPS_GEOREF:
+#   - immagine di overlay: mappa nuova schiarita come sfondo, rosso dove il segnale è
+#     comparso o aumentato, blu dove è sparito o diminuito, grigio dove è invariato
+#   - per regione (box lat/lon, MAPS_REGIONS per cambiarli): frazione di segnale prima e
+#     dopo, classe media e massima, pixel guadagnati/persi, spostamento del baricentro
+# Costo tipico: ~0.2 s per coppia su una cattura 1600x1000 (metà è la scrittura del PNG),
+# coppie in parallelo.
+#
+# Esempio:
+#   python forecast_change.py --base-time 202501160000
+#   python forecast_change.py --vt 20250117            # solo quel VT
+
+DEFAULT_OUT = "maps"
+# nome -> [lat0, lat1, lon0, lon1]
+DEFAULT_REGIONS = {
+    "Iberia": [36.0, 44.0, -10.0, 3.5],
+    "British Isles": [50.0, 59.0, -11.0, 2.0],
+    "France": [42.5, 51.0, -5.0, 8.0],
+    "Alps": [44.0, 48.5, 5.5, 16.5],
+    "Italy": [37.0, 46.5, 7.0, 18.5],
+    "Central Europe": [47.0, 55.0, 6.0, 24.0],
+    "Balkans": [39.0, 47.0, 13.0, 29.0],
+    "Scandinavia": [55.0, 71.0, 5.0, 31.0],
+}
+EARTH_KM_PER_DEG = 111.2
+BG_FADE = 0.35  # quanto resta visibile la mappa nuova sotto i colori del cambiamento
+
+
+def load_regions() -> dict:
+    path = os.environ.get("MAPS_REGIONS")
+    if not path:
+        return DEFAULT_REGIONS
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _palette(max_delta: int) -> np.ndarray:
+    """Colore RGB per delta di classe in [-max_delta, max_delta], indicizzato da delta + max_delta."""
+    steps = np.arange(-max_delta, max_delta + 1)
+    strength = np.abs(steps) / max(1, max_delta)
+    pal = np.zeros((len(steps), 3), dtype=np.float32)
+    # rosso per aumento, blu per diminuzione, più saturo con il salto di classe
+    pal[steps > 0] = np.stack([np.full_like(strength, 230), 160 - 140 * strength, 140 - 120 * strength],
+                              axis=1)[steps > 0]
+    pal[steps < 0] = np.stack([140 - 120 * strength, 170 - 110 * strength, np.full_like(strength, 235)],
+                              axis=1)[steps < 0]
+    return pal
+
+
+def align(old: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    """Riporta `old` sulla griglia `shape` (nearest neighbour) se le catture hanno dimensioni diverse."""
+    if old.shape == shape:
+        return np.asarray(old)
+    rows = (np.arange(shape[0]) * old.shape[0] // shape[0])[:, None]
+    cols = (np.arange(shape[1]) * old.shape[1] // shape[1])[None, :]
+    return np.asarray(old)[rows, cols]
+
+
+def overlay(new_png: str, new: np.ndarray, old: np.ndarray, out_path: str, max_delta: int):
+    with Image.open(new_png) as im:
+        gray = np.asarray(im.convert("L"), dtype=np.float32)
+    if gray.shape != new.shape:
+        gray = np.asarray(Image.fromarray(gray.astype(np.uint8)).resize(new.shape[::-1]), dtype=np.float32)
+    bg = 255 - (255 - gray) * BG_FADE
+    rgb = np.repeat(bg[..., None], 3, axis=-1)
+    delta = new.astype(np.int16) - old.astype(np.int16)
+    changed = delta != 0
+    rgb[changed] = _palette(max_delta)[delta[changed] + max_delta]
+    rgb[~changed & (new > 0)] = 150
+    tmp = f"{out_path}.tmp{os.getpid()}.png"
+    # compressione veloce: è un prodotto di servizio, postprocess.py può ricomprimerlo
+    Image.fromarray(rgb.astype(np.uint8)).save(tmp, compress_level=1)
+    os.replace(tmp, out_path)
+
+
+def _centroid(grid: EfiGrid, classes: np.ndarray, win, mask) -> tuple[float, float] | None:
+    weights = np.where(mask, classes[win], 0).astype(np.float64)
+    total = weights.sum()
+    if not total:
+        return None
+    lons, lats = grid.georef.grid(grid.shape[1], grid.shape[0])
+    return float((lats[win] * weights).sum() / total), float((lons[win] * weights).sum() / total)
+
+
+def region_summary(grid: EfiGrid, new: np.ndarray, old: np.ndarray, regions: dict) -> dict:
+    out = {}
+    for name, (lat0, lat1, lon0, lon1) in regions.items():
+        win, mask = grid.window(lat0, lat1, lon0, lon1)
+        n, o = new[win][mask], old[win][mask]
+        if not n.size:
+            continue
+        row = {
+            "pixels": int(n.size),
+            "signal_before": round(float(np.count_nonzero(o)) / n.size, 4),
+            "signal_after": round(float(np.count_nonzero(n)) / n.size, 4),
+            "mean_class_before": round(float(o.mean()), 3),
+            "mean_class_after": round(float(n.mean()), 3),
+            "max_class_before": int(o.max()),
+            "max_class_after": int(n.max()),
+            "gained_px": int(np.count_nonzero((n > 0) & (o == 0))),
+            "lost_px": int(np.count_nonzero((n == 0) & (o > 0))),
+            "shift_km": None,
+            "shift_bearing_deg": None,
+        }
+        c_old, c_new = _centroid(grid, old, win, mask), _centroid(grid, new, win, mask)
+        if c_old and c_new:
+            dy = (c_new[0] - c_old[0]) * EARTH_KM_PER_DEG
+            dx = (c_new[1] - c_old[1]) * EARTH_KM_PER_DEG * np.cos(np.radians((c_new[0] + c_old[0]) / 2))
+            row["shift_km"] = round(float(np.hypot(dx, dy)), 1)
+            row["shift_bearing_deg"] = round(float(np.degrees(np.arctan2(dx, dy)) % 360), 0)
+        out[name] = row
+    return out
+
+
+def compare_pair(new_row: dict, old_row: dict, out_dir: str, regions: dict, legend: Legend) -> dict:
+    t0 = time.perf_counter()
+    new_grid = load_grid(new_row["path"], legend, new_row["area"])
+    new = np.asarray(new_grid.classes)
+    old = align(load_grid(old_row["path"], legend, old_row["area"]).classes, new.shape)
+    name = (f"change_{new_row['area']}_q{new_row['quantile']}_vt{new_row['vt']}"
+            f"_{new_row['base_time']}_vs_{old_row['base_time']}.png")
+    out_path = os.path.join(out_dir, name)
+    overlay(new_row["path"], new, old, out_path, max_delta=len(legend.lo) - 1)
+    return {
+        "vt": new_row["vt"],
+        "area": new_row["area"],
+        "quantile": new_row["quantile"],
+        "new": {"base_time": new_row["base_time"], "day": new_row["day"], "sha256": new_row["sha256"]},
+        "old": {"base_time": old_row["base_time"], "day": old_row["day"], "sha256": old_row["sha256"]},
+        "identical": new_row["sha256"] == old_row["sha256"],
+        "changed_fraction": round(float(np.count_nonzero(new != old)) / new.size, 4),
+        "overlay": out_path,
+        "regions": region_summary(new_grid, new, old, regions),
+        "ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+
+
+def pairs_for(archive: MapArchive, base_time: str | None, vt: str | None, product: str) -> list[tuple[dict, dict]]:
+    """(mappa nuova, mappa dello stesso VT del run precedente) per il base_time o il VT richiesti."""
+    if vt:
+        where, args = "vt = ?", (vt,)
+    else:
+        where, args = "base_time = ?", (base_time,)
+    keys = archive.db.execute(
+        f"SELECT DISTINCT vt, area, quantile FROM maps WHERE {where} AND product = ?", (*args, product)).fetchall()
+    pairs = []
+    for key in keys:
+        rows = archive.lead_times_for_vt(key["vt"], product=product, area=key["area"], quantile=key["quantile"])
+        # una riga per base_time (la più recente), dal run più nuovo al più vecchio
+        by_base = {}
+        for row in rows:
+            by_base.setdefault(row["base_time"], row)
+        runs = list(by_base.values())
+        if vt:
+            pairs.extend(zip(runs, runs[1:]))
+            continue
+        idx = next((i for i, r in enumerate(runs) if r["base_time"] == base_time), None)
+        if idx is not None and idx + 1 < len(runs):
+            pairs.append((runs[idx], runs[idx + 1]))
+    return pairs
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Mappe di cambiamento tra run consecutivi per lo stesso valid time.")
+    ap.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+    ap.add_argument("--vt", help="YYYYMMDD: tutte le coppie consecutive per quel VT")
+    ap.add_argument("--archive", default=DEFAULT_ARCHIVE)
+    ap.add_argument("--product", default=DEFAULT_SLOT["product"])
+    ap.add_argument("--out-dir", default=DEFAULT_OUT)
+    ap.add_argument("--summary", default="maps/change_summary.json")
+    args = ap.parse_args(argv)
+
+    regions = load_regions()
+    try:
+        legend = Legend()
+        Georef(DEFAULT_SLOT["area"])
+    except RuntimeError as e:
+        # senza calibrazione le griglie di classi e le regioni sarebbero sbagliate
+        print(f"[fail] {e}")
+        sys.exit(2)
+    legend.lut()  # una volta sola, prima dei thread
+    os.makedirs(args.out_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    with MapArchive(args.archive) as archive:
+        pairs = pairs_for(archive, args.base_time, args.vt, args.product)
+    if not pairs:
+        print("[warn] nessuna coppia di run per lo stesso VT in archivio.")
+        sys.exit(1)
+    results = run_all(lambda p: compare_pair(p[0], p[1], args.out_dir, regions, legend), pairs)
+    reports = []
+    for (new_row, old_row), report, err in results:
+        if err:
+            print(f"[err] VT {new_row['vt']} {new_row['area']}: {err}")
+            continue
+        reports.append(report)
+        moved = sorted(((r["gained_px"] + r["lost_px"], name) for name, r in report["regions"].items()), reverse=True)
+        top = ", ".join(f"{name} +{report['regions'][name]['gained_px']}/-{report['regions'][name]['lost_px']}"
+                        for n, name in moved[:3] if n)
+        print(f"[change] VT {report['vt']} {report['area']}: run {report['new']['base_time']} (day {report['new']['day']})"
+              f" vs {report['old']['base_time']} (day {report['old']['day']}), {100*report['changed_fraction']:.1f}%"
+              f" pixel cambiati{': ' + top if top else ''} ({report['ms']} ms)")
+    os.makedirs(os.path.dirname(args.summary) or ".", exist_ok=True)
+    with open(args.summary, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=1)
+    print(f"[done] {len(reports)} coppie in {time.perf_counter() - t0:.2f}s -> {args.summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import argparse
+import base64
+import html
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+
+from fetch_pool import PNG_MAGIC
+from http_cache import slot_from_url
+
+# Registrazione e replay del traffico di cattura (HAR), per rifare filtri, selezione del
+# PNG, controllo VT e post-processing senza rete.
+#   record  MAPS_HAR_RECORD=maps/capture.har.zip: capture_engine registra nel context
+#           Playwright (record_har_path) le pagine prodotto, l'API e i PNG /streaming/
+#           (MAPS_HAR_FILTER per cambiare la regex, "all" per tutto il traffico).
+#           Con .zip i body sono file separati nell'archivio, compressi. Si registra solo
+#           ciò che passa dal browser: MAPS_RESOLVER=0 e MAPS_CACHE=0 per avere tutte le pagine.
+#   replay  MAPS_HAR_REPLAY=<har>: capture_engine serve le risposte dal HAR con
+#           context.route_from_har (il resto viene abortito; niente cache né resolver).
+#           Serve un HAR registrato con MAPS_HAR_FILTER=all, perché la pagina deve
+#           trovare anche JS e CSS.
+#   select  senza browser: per ogni pagina del HAR si applicano ai PNG registrati gli
+#           stessi criteri di on_response (filtro, `match`, soglia, firma, vince il più
+#           grande), opzionalmente il controllo VT sul testo della pagina e il
+#           post-processing. Un run di ieri si rivaluta in meno di un secondo.
+#   serve   stand-in HTTP che risponde con le entry del HAR: con ECMWF_CHARTS_ORIGIN
+#           puntato qui anche le strategie HTTP (html, resolver) girano offline.
+#
+# Esempio:
+#   MAPS_HAR_RECORD=maps/capture.har.zip python download_maps_via_network_strict.py
+#   python har_replay.py select maps/capture.har.zip --match /streaming/20250115- --check-vt
+#   python har_replay.py serve maps/capture.har.zip --port 8766
+
+HAR_RECORD = os.environ.get("MAPS_HAR_RECORD", "")
+HAR_REPLAY = os.environ.get("MAPS_HAR_REPLAY", "")
+HAR_FILTER = os.environ.get("MAPS_HAR_FILTER", r"/(products|streaming|opencharts-api)/")
+
+
+def record_options(path: str = HAR_RECORD, url_filter: str = HAR_FILTER) -> dict:
+    """Argomenti per browser.new_context(); {} se la registrazione è spenta."""
+    if not path:
+        return {}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    options = {"record_har_path": path, "record_har_mode": "minimal"}
+    if url_filter and url_filter != "all":
+        options["record_har_url_filter"] = re.compile(url_filter)
+    return options
+
+
+class HarArchive:
+    """HAR in chiaro (.har) o zip di Playwright (har.har + body allegati)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._zip = None
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            name = next(n for n in self._zip.namelist() if n.endswith(".har"))
+            self.har = json.loads(self._zip.read(name))
+        else:
+            with open(path, encoding="utf-8") as f:
+                self.har = json.load(f)
+        self.entries = self.har["log"]["entries"]
+
+    def close(self):
+        if self._zip:
+            self._zip.close()
+
+    def body(self, entry: dict) -> bytes:
+        content = entry["response"].get("content", {})
+        if content.get("_file") and self._zip:
+            return self._zip.read(content["_file"])
+        text = content.get("text") or ""
+        if content.get("encoding") == "base64":
+            return base64.b64decode(text)
+        return text.encode("utf-8")
+
+    @staticmethod
+    def header(entry: dict, name: str) -> str:
+        name = name.lower()
+        return next((h["value"] for h in entry["response"].get("headers", []) if h["name"].lower() == name), "")
+
+    def pages(self) -> list[dict]:
+        """Per pagina (pageref): URL del documento prodotto ed entry registrate."""
+        groups: dict[str, list[dict]] = {}
+        for entry in self.entries:
+            groups.setdefault(entry.get("pageref") or "", []).append(entry)
+        pages = []
+        for ref, entries in groups.items():
+            doc = next((e for e in entries if "/products/" in e["request"]["url"]
+                        and "html" in e["response"].get("content", {}).get("mimeType", "")), None)
+            if doc is None:
+                continue
+            pages.append({"ref": ref, "url": doc["request"]["url"], "document": doc, "entries": entries})
+        return pages
+
+
+def page_text(markup: bytes) -> str:
+    """Testo visibile (approssimato) dell'HTML registrato, per il controllo VT."""
+    text = re.sub(r"(?is)<(script|style)\b.*?</\1>", " ", markup.decode("utf-8", errors="replace"))
+    return html.unescape(re.sub(r"<[^>]+>", " ", text))
+
+
+def select(archive: HarArchive, out_dir: str, match: str | None = None, check_vt: bool = False) -> list[dict]:
+    # stessi criteri della cattura live (CaptureJob.accepts, MIN_PNG_SIZE)
+    from capture_engine import MIN_PNG_SIZE, CaptureJob
+
+    results = []
+    os.makedirs(out_dir, exist_ok=True)
+    for page in archive.pages():
+        slot = slot_from_url(page["url"])
+        day = int(slot.get("day") or 0)
+        job = CaptureJob(day=day, url=page["url"], out_png=os.path.join(out_dir, f"map_day{day}.png"), match=match)
+        result = {"day": day, "url": page["url"], "saved": False, "src": None, "size": 0, "rejected": 0, "vt": None}
+        best = None
+        for entry in page["entries"]:
+            url = entry["request"]["url"]
+            ctype = archive.header(entry, "content-type").lower() or entry["response"].get("content", {}).get(
+                "mimeType", "")
+            if not (entry["response"].get("status") == 200 and job.accepts(url, ctype)):
+                result["rejected"] += "png" in url.lower()
+                continue
+            body = archive.body(entry)
+            if len(body) >= MIN_PNG_SIZE and body.startswith(PNG_MAGIC) and (best is None or len(body) > best[1]):
+                best = (url, len(body), body)
+        if check_vt:
+            from download_maps_check_vt import vt_start_from_text
+            result["vt"] = vt_start_from_text(page_text(archive.body(page["document"])))
+        if best:
+            with open(job.out_png, "wb") as f:
+                f.write(best[2])
+            result.update({"saved": True, "src": best[0], "size": best[1], "out_png": job.out_png})
+        results.append(result)
+    return sorted(results, key=lambda r: r["day"])
+
+
+class HarServer(ThreadingHTTPServer):
+    """Risponde con l'ultima entry registrata per path+query (o solo path); 404 altrimenti."""
+
+    daemon_threads = True
+
+    def __init__(self, addr, archive: HarArchive):
+        super().__init__(addr, _HarHandler)
+        self.archive = archive
+        self.by_full: dict[str, dict] = {}
+        self.by_path: dict[str, dict] = {}
+        for entry in archive.entries:
+            parts = urlsplit(entry["request"]["url"])
+            self.by_full[f"{parts.path}?{parts.query}"] = entry
+            self.by_path[parts.path] = entry
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _HarHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        entry = self.server.by_full.get(f"{parts.path}?{parts.query}") or self.server.by_path.get(parts.path)
+        if entry is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.archive.body(entry)
+        ctype = HarArchive.header(entry, "content-type") or entry["response"].get("content", {}).get(
+            "mimeType", "application/octet-stream")
+        self.send_response(entry["response"].get("status") or 200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_in_thread(archive: HarArchive, host: str = "127.0.0.1", port: int = 0) -> HarServer:
+    server = HarServer((host, port), archive)
+    threading.Thread(target=server.serve_forever, name="har-server", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay offline del traffico di cattura registrato in HAR.")
+    ap.add_argument("cmd", choices=["select", "serve"])
+    ap.add_argument("har")
+    ap.add_argument("--out-dir", default="replay")
+    ap.add_argument("--match", help="sottostringa richiesta nell'URL del PNG (come CaptureJob.match)")
+    ap.add_argument("--check-vt", action="store_true", help="estrae il VT dal testo della pagina registrata")
+    ap.add_argument("--postprocess", action="store_true", help="post-processing dei PNG selezionati")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8766)
+    args = ap.parse_args(argv)
+
+    archive = HarArchive(args.har)
+    if args.cmd == "serve":
+        server = HarServer((args.host, args.port), archive)
+        print(f"[info] replay di {len(archive.entries)} entry su {server.url}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    t0 = time.perf_counter()
+    results = select(archive, args.out_dir, args.match, args.check_vt)
+    archive.close()
+    for r in results:
+        vt = f", VT {r['vt']}" if args.check_vt else ""
+        if r["saved"]:
+            print(f"[ok] day {r['day']}: {r['out_png']} da {r['src']} ({r['size']/1024:.1f} KB{vt})")
+        else:
+            print(f"[miss] day {r['day']}: nessun PNG valido tra quelli registrati ({r['rejected']} scartati{vt})")
+    saved = [r["out_png"] for r in results if r["saved"]]
+    if args.postprocess and saved:
+        from postprocess import run
+        run(saved, workers=1)
+    print(f"[done] {len(saved)}/{len(results)} pagine in {time.perf_counter() - t0:.2f}s, senza rete.")
+    if not saved:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
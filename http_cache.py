@@ -0,0 +1,295 @@
+from urllib.parse import parse_qs, urlparse
+import atexit
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+from fetch_pool import PNG_MAGIC, stream_to_file
+
+# Cache su disco per pagine e PNG, con GET condizionali.
+# Chiave = (product, area, base_time, day, quantile, URL sorgente); per ogni voce
+# si salvano il body, ETag/Last-Modified e lo sha256 del contenuto. Un rerun dello
+# stesso base_time invia If-None-Match/If-Modified-Since e, su 304, serve il file
+# dal disco. Eviction una volta per run, a fine processo: per età dall'ultima conferma
+# del server, 200 o 304 (MAPS_CACHE_MAX_AGE_DAYS), e per dimensione totale
+# (MAPS_CACHE_MAX_MB), dalle voci usate meno di recente. Gli altri file della
+# directory (template, latenze, stato delle strategie) non vengono toccati.
+
+DEFAULT_CACHE_DIR = os.environ.get("MAPS_CACHE_DIR", ".cache/maps")
+DEFAULT_MAX_BYTES = int(float(os.environ.get("MAPS_CACHE_MAX_MB", "500")) * 1024 * 1024)
+DEFAULT_MAX_AGE = float(os.environ.get("MAPS_CACHE_MAX_AGE_DAYS", "14")) * 86400
+
+SLOT_FIELDS = ("product", "area", "base_time", "day", "quantile")
+# voci di cache: <sha256>.json + <sha256>.bin
+ENTRY_RE = re.compile(r"^[0-9a-f]{64}\.json$")
+
+
+def slot_from_url(page_url: str) -> dict:
+    """
+    Ricava (product, area, base_time, day, quantile) dall'URL della pagina prodotto,
+    es. .../products/efi2web_tp?area=Europe&base_time=...&day=1&quantile=99
+    """
+    parsed = urlparse(page_url)
+    q = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+    product = parsed.path.rstrip("/").rsplit("/", 1)[-1]
+    return {"product": product, **{k: q.get(k, "") for k in SLOT_FIELDS[1:]}}
+
+
+def _tmp_name(path: str) -> str:
+    # unico per processo e thread (come stream_to_file): run_all e i worker della pipeline
+    # possono scrivere la stessa destinazione in parallelo
+    return f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = _tmp_name(path)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def copy_atomic(src: str, dst: str):
+    # copia a blocchi su file temporaneo + rename: chi legge dst non vede mai un file a metà
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp = _tmp_name(dst)
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _starts_with(path: str, magic: bytes) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(magic)) == magic
+
+
+def _validated_at(meta: dict) -> float:
+    # le voci scritte prima di validated_at hanno solo stored_at
+    return meta.get("validated_at", meta["stored_at"])
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HttpCache:
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: float = DEFAULT_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(slot: dict, url: str) -> str:
+        raw = "|".join(str(slot.get(k, "")) for k in SLOT_FIELDS) + "|" + url
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        return os.path.join(self.root, key + ".bin"), os.path.join(self.root, key + ".json")
+
+    def _load_meta(self, meta_path: str) -> dict | None:
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_meta(self, key: str, meta: dict):
+        _write_atomic(self._paths(key)[1], json.dumps(meta).encode())
+
+    def get(self, slot: dict, url: str) -> tuple[dict, str] | None:
+        key = self.key(slot, url)
+        body_path, meta_path = self._paths(key)
+        meta = self._load_meta(meta_path)
+        if not meta or not os.path.exists(body_path):
+            return None
+        if time.time() - _validated_at(meta) > self.max_age:
+            return None
+        return meta, body_path
+
+    def find(self, slot: dict, png: bool = False) -> tuple[dict, str] | None:
+        """
+        Voce più recente per lo slot, qualunque sia l'URL sorgente (es. PNG catturato dal browser).
+        Con png=True solo le voci il cui body è un PNG: sotto lo stesso slot c'è anche la pagina HTML.
+        """
+        best = None
+        for name in os.listdir(self.root):
+            if not ENTRY_RE.match(name):
+                continue
+            meta = self._load_meta(os.path.join(self.root, name))
+            if not meta or any(str(meta.get(k)) != str(slot.get(k)) for k in SLOT_FIELDS):
+                continue
+            if png and not meta.get("is_png"):
+                continue
+            if best is None or meta["stored_at"] > best["stored_at"]:
+                best = meta
+        if best is None:
+            return None
+        return self.get(slot, best["url"])
+
+    def read(self, slot: dict, url: str) -> bytes | None:
+        hit = self.get(slot, url)
+        if not hit:
+            return None
+        with open(hit[1], "rb") as f:
+            return f.read()
+
+    def _meta(self, slot: dict, url: str, headers, sha256: str, size: int, is_png: bool) -> dict:
+        headers = headers or {}
+        now = time.time()
+        return {
+            **{k: str(slot.get(k, "")) for k in SLOT_FIELDS},
+            "url": url,
+            "content_type": headers.get("Content-Type") or headers.get("content-type"),
+            "is_png": is_png,
+            "etag": headers.get("ETag") or headers.get("etag"),
+            "last_modified": headers.get("Last-Modified") or headers.get("last-modified"),
+            "sha256": sha256,
+            "size": size,
+            "stored_at": now,
+            # ultima conferma dal server (200 o 304): l'età per get() ed evict() parte da qui
+            "validated_at": now,
+            "accessed_at": now,
+        }
+
+    def put(self, slot: dict, url: str, body: bytes, headers=None) -> dict:
+        key = self.key(slot, url)
+        meta = self._meta(slot, url, headers, hashlib.sha256(body).hexdigest(), len(body),
+                          body.startswith(PNG_MAGIC))
+        _write_atomic(self._paths(key)[0], body)
+        self._save_meta(key, meta)
+        self._evict_later()
+        return meta
+
+    def put_file(self, slot: dict, url: str, path: str, headers=None) -> dict:
+        """Come put() ma copia da un file già su disco (niente body in memoria)."""
+        key = self.key(slot, url)
+        meta = self._meta(slot, url, headers, file_sha256(path), os.path.getsize(path),
+                          _starts_with(path, PNG_MAGIC))
+        copy_atomic(path, self._paths(key)[0])
+        self._save_meta(key, meta)
+        self._evict_later()
+        return meta
+
+    def conditional_headers(self, meta: dict) -> dict:
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def fetch(self, fetcher, slot: dict, url: str, timeout: float | None = None,
+              headers: dict | None = None) -> tuple[bytes, bool]:
+        """
+        GET condizionale via `fetcher` (fetch_pool.Fetcher). Restituisce (body, from_cache):
+        su 304 il body arriva dal disco, su 200 la voce viene aggiornata.
+        """
+        hit = self.get(slot, url)
+        req_headers = dict(headers or {})
+        if hit:
+            req_headers.update(self.conditional_headers(hit[0]))
+        r = fetcher.get(url, timeout=timeout, headers=req_headers)
+        if r.status_code == 304 and hit:
+            meta, body_path = hit
+            meta["accessed_at"] = meta["validated_at"] = time.time()
+            self._save_meta(self.key(slot, url), meta)
+            with open(body_path, "rb") as f:
+                return f.read(), True
+        r.raise_for_status()
+        body = r.content
+        self.put(slot, url, body, r.headers)
+        return body, False
+
+    def fetch_to(self, fetcher, slot: dict, url: str, out_path: str, timeout: float | None = None,
+                 headers: dict | None = None, png: bool = False, min_size: int = 0) -> tuple[int, bool]:
+        """
+        Versione in streaming di fetch(): il body va dalla rete al file di cache
+        e da lì a `out_path`, senza passare per la memoria. Restituisce (size, from_cache).
+        """
+        key = self.key(slot, url)
+        hit = self.get(slot, url)
+        req_headers = dict(headers or {})
+        if hit:
+            req_headers.update(self.conditional_headers(hit[0]))
+        info = stream_to_file(fetcher, url, self._paths(key)[0], headers=req_headers,
+                              timeout=timeout, png=png, min_size=min_size)
+        if info["status"] == 304 and hit:
+            meta = hit[0]
+            # la stessa voce può essere stata scritta da chi voleva la pagina HTML
+            if png and not _starts_with(hit[1], PNG_MAGIC):
+                raise RuntimeError(f"Not a PNG (voce in cache) per {url}")
+            meta["accessed_at"] = meta["validated_at"] = time.time()
+            from_cache = True
+        elif info["status"] == 304:
+            raise RuntimeError(f"304 senza voce in cache per {url}")
+        else:
+            meta = self._meta(slot, url, info["headers"], info["sha256"], info["size"],
+                              _starts_with(self._paths(key)[0], PNG_MAGIC))
+            from_cache = False
+        self._save_meta(key, meta)
+        copy_atomic(self._paths(key)[0], out_path)
+        self._evict_later()
+        return meta["size"], from_cache
+
+    def _evict_later(self):
+        # una sola eviction per directory a fine processo: evict() rilegge tutte le voci
+        # e farlo a ogni scrittura costava O(voci) letture per put/fetch_to
+        with _EVICT_LOCK:
+            _EVICT_AT_EXIT.setdefault(os.path.abspath(self.root), self)
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if not ENTRY_RE.match(name):
+                continue
+            key = name[:-5]
+            body_path, meta_path = self._paths(key)
+            meta = self._load_meta(meta_path)
+            if not meta or not os.path.exists(body_path) or now - _validated_at(meta) > self.max_age:
+                self._remove(key)
+                continue
+            entries.append((meta.get("accessed_at", meta["stored_at"]), key, meta["size"]))
+            total += meta["size"]
+        # LRU: rimuove le voci meno usate finché si sta sotto il limite
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+
+    def _remove(self, key: str):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_EVICT_AT_EXIT: dict[str, HttpCache] = {}
+_EVICT_LOCK = threading.Lock()
+
+
+@atexit.register
+def _evict_at_exit():
+    for cache in _EVICT_AT_EXIT.values():
+        try:
+            cache.evict()
+        except OSError:
+            pass
+
+
+def cache_from_env() -> HttpCache | None:
+    # MAPS_CACHE=0 disattiva la cache
+    if os.environ.get("MAPS_CACHE", "1") == "0":
+        return None
+    return HttpCache()
@@ -0,0 +1,125 @@
+from urllib.parse import urlparse
+import atexit
+import json
+import os
+import random
+import re
+import threading
+import time
+
+# Latenze per endpoint, persistite tra i run, per timeout adattivi e richieste "hedged".
+# Endpoint = tipo + host + primo segmento del path (es. "http charts.ecmwf.int/streaming",
+# "goto charts.ecmwf.int/products"): le date e i parametri nell'URL non frammentano
+# le statistiche. Per ogni endpoint si tengono gli ultimi MAX_SAMPLES tempi (ms) in
+# .cache/maps/latency.json (override: MAPS_LATENCY_FILE), salvati a fine processo.
+#   timeout = p99 * TIMEOUT_FACTOR, tra un minimo e il timeout fisso di prima,
+#             e mai oltre il tempo rimasto alla deadline del run
+#   hedge   = dopo il p95 parte una seconda richiesta identica; vince la prima che arriva
+# Con meno di MIN_SAMPLES campioni si usano i valori fissi.
+# Retry: backoff esponenziale con jitter pieno, dentro la deadline totale del run
+# (MAPS_DEADLINE_S, default 20 minuti).
+
+LATENCY_PATH = os.environ.get("MAPS_LATENCY_FILE", ".cache/maps/latency.json")
+RUN_DEADLINE_S = float(os.environ.get("MAPS_DEADLINE_S", "1200"))
+MAX_SAMPLES = 200
+MIN_SAMPLES = 20
+TIMEOUT_FACTOR = 4.0
+MIN_TIMEOUT_S = 5.0
+MIN_HEDGE_S = 0.05
+
+
+def endpoint(url: str, kind: str = "http") -> str:
+    parsed = urlparse(url)
+    first = re.split(r"[/?]", parsed.path.lstrip("/"), maxsplit=1)[0]
+    return f"{kind} {parsed.netloc}/{first}"
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    if not ordered:
+        raise ValueError("nessun campione")
+    k = (len(ordered) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class RunDeadline:
+    """Deadline totale del run: limita timeout e attese tra un retry e l'altro."""
+
+    def __init__(self, seconds: float = RUN_DEADLINE_S):
+        self.reset(seconds)
+
+    def reset(self, seconds: float = RUN_DEADLINE_S):
+        """Riparte da adesso: i processi che vivono più di un run (capture_daemon) la resettano per richiesta."""
+        self.end = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.end - time.monotonic())
+
+    def backoff(self, attempt: int, base: float = 1.0, cap: float = 30.0) -> float | None:
+        """
+        Attesa prima del retry n. `attempt` (1, 2, ...): uniforme in [0, min(cap, base*2^attempt)]
+        (full jitter, i retry di job diversi non si sincronizzano). None se dopo l'attesa
+        non resterebbe tempo per un altro tentativo.
+        """
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        if delay + MIN_TIMEOUT_S > self.remaining():
+            return None
+        return delay
+
+
+class LatencyStats:
+    def __init__(self, path: str = LATENCY_PATH):
+        self.path = path
+        self.samples: dict[str, list[float]] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.samples = {k: list(v)[-MAX_SAMPLES:] for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            values = self.samples.setdefault(key, [])
+            values.append(round(seconds * 1000, 1))
+            del values[:-MAX_SAMPLES]
+            self._dirty = True
+
+    def quantile(self, key: str, q: float) -> float | None:
+        """Quantile in secondi, None se i campioni sono troppo pochi."""
+        with self._lock:
+            values = sorted(self.samples.get(key, ()))
+        if len(values) < MIN_SAMPLES:
+            return None
+        return percentile(values, q) / 1000
+
+    def timeout_for(self, key: str, default: float) -> float:
+        """Timeout adattivo (secondi): p99 * TIMEOUT_FACTOR, tra MIN_TIMEOUT_S e `default`."""
+        p99 = self.quantile(key, 0.99)
+        timeout = default if p99 is None else max(MIN_TIMEOUT_S, min(default, p99 * TIMEOUT_FACTOR))
+        return max(MIN_TIMEOUT_S, min(timeout, DEADLINE.remaining()))
+
+    def hedge_after(self, key: str) -> float | None:
+        p95 = self.quantile(key, 0.95)
+        return None if p95 is None else max(MIN_HEDGE_S, p95)
+
+    def save(self):
+        if not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self.samples)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.tmp{os.getpid()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+
+DEADLINE = RunDeadline()
+LATENCY = LatencyStats()
+atexit.register(LATENCY.save)
@@ -0,0 +1,272 @@
+from datetime import datetime, timedelta, timezone
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+from fetch_pool import CHARTS_ORIGIN, DEFAULT_CONCURRENCY, RATE_LIMITER, Fetcher, run_all
+from http_cache import copy_atomic, file_sha256
+import streaming_resolver
+
+# Archivio storico delle mappe, indirizzato per contenuto:
+#   <archive>/objects/ab/abcdef....png   un file per sha256 (stessa mappa = zero byte in più)
+#   <archive>/index.sqlite               una riga per (product, area, base_time, day, quantile, sha256)
+#                                        con VT, dimensione, URL sorgente e tempi di fetch
+# Interrogazioni tipiche: ultima mappa per un VT, tutti i lead time per un VT.
+# `backfill` scarica in parallelo (via HTTP, senza browser) i base_time passati mancanti.
+# Sostituisce il layout vt<YYYYMMDD>/<base_time>_day<N>.png della prima versione di
+# stale_check.py: import_legacy() lo migra (lo chiama stale_check a ogni avvio).
+# Override: MAPS_ARCHIVE (default "archive").
+#
+# Esempi:
+#   python map_archive.py add maps/map_day*.png --base-time 202501150000
+#   python map_archive.py latest --vt 20250117
+#   python map_archive.py leads --vt 20250117
+#   python map_archive.py backfill --from 20250101 --to 20250114 --days 1-3
+
+DEFAULT_ARCHIVE = os.environ.get("MAPS_ARCHIVE", "archive")
+PAGE_URL = CHARTS_ORIGIN + "/products/{product}?area={area}&base_time={base}&day={day}&quantile={quantile}"
+DEFAULT_SLOT = {"product": "efi2web_tp", "area": "Europe", "quantile": "99"}
+MAP_NAME_RE = re.compile(r"day(\d+)\.png$")
+LEGACY_NAME_RE = re.compile(r"(\d{12})_day(\d+)\.png$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (
+    id INTEGER PRIMARY KEY,
+    product TEXT NOT NULL,
+    area TEXT NOT NULL,
+    base_time TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    quantile TEXT NOT NULL,
+    vt TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    src TEXT,
+    fetched_at REAL NOT NULL,
+    fetch_ms REAL,
+    UNIQUE (product, area, base_time, day, quantile, sha256)
+);
+CREATE INDEX IF NOT EXISTS maps_by_vt ON maps (vt, product, area, quantile, base_time);
+CREATE INDEX IF NOT EXISTS maps_by_sha ON maps (sha256);
+"""
+
+
+def vt_for(base_time: str, day: int) -> str:
+    base = datetime.strptime(base_time[:8], "%Y%m%d")
+    return (base + timedelta(days=int(day) - 1)).strftime("%Y%m%d")
+
+
+class MapArchive:
+    def __init__(self, root: str = DEFAULT_ARCHIVE):
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "index.sqlite"))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "objects", sha256[:2], f"{sha256}.png")
+
+    def add(self, path: str, slot: dict, src: str | None = None, fetch_ms: float | None = None) -> dict:
+        """
+        Archivia `path` per lo slot (product, area, base_time, day, quantile).
+        Restituisce {"sha256", "path", "new_object", "new_row"}: un file già visto non
+        occupa altro spazio, uno slot già registrato con lo stesso contenuto non aggiunge righe.
+        """
+        sha = file_sha256(path)
+        obj = self.object_path(sha)
+        new_object = not os.path.exists(obj)
+        if new_object:
+            copy_atomic(path, obj)
+        with self.db:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO maps (product, area, base_time, day, quantile, vt, sha256, size, src, "
+                "fetched_at, fetch_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (slot["product"], slot["area"], slot["base_time"], int(slot["day"]), str(slot["quantile"]),
+                 vt_for(slot["base_time"], slot["day"]), sha, os.path.getsize(obj), src, time.time(), fetch_ms),
+            )
+        return {"sha256": sha, "path": obj, "new_object": new_object, "new_row": cur.rowcount > 0}
+
+    def _rows(self, sql: str, args: tuple) -> list[dict]:
+        return [{**dict(r), "path": self.object_path(r["sha256"])} for r in self.db.execute(sql, args)]
+
+    def lead_times_for_vt(self, vt: str, product: str = DEFAULT_SLOT["product"], area: str = DEFAULT_SLOT["area"],
+                          quantile: str = DEFAULT_SLOT["quantile"]) -> list[dict]:
+        """Tutte le mappe valide per `vt`, dalla più recente (lead time più corto) alla più vecchia."""
+        return self._rows(
+            "SELECT * FROM maps WHERE vt = ? AND product = ? AND area = ? AND quantile = ? "
+            "ORDER BY base_time DESC, fetched_at DESC",
+            (vt, product, area, str(quantile)),
+        )
+
+    def latest_for_vt(self, vt: str, **slot) -> dict | None:
+        rows = self.lead_times_for_vt(vt, **slot)
+        return rows[0] if rows else None
+
+    def has(self, slot: dict) -> bool:
+        row = self.db.execute(
+            "SELECT 1 FROM maps WHERE product = ? AND area = ? AND base_time = ? AND day = ? AND quantile = ? LIMIT 1",
+            (slot["product"], slot["area"], slot["base_time"], int(slot["day"]), str(slot["quantile"])),
+        ).fetchone()
+        return row is not None
+
+    def find_sha(self, sha256: str) -> list[dict]:
+        return self._rows("SELECT * FROM maps WHERE sha256 = ? ORDER BY base_time DESC", (sha256,))
+
+    def stats(self) -> dict:
+        rows, objects, base_times = self.db.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT sha256), COUNT(DISTINCT base_time) FROM maps").fetchone()
+        size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM maps)").fetchone()[0]
+        return {"rows": rows, "objects": objects, "base_times": base_times, "bytes": size}
+
+    def import_legacy(self, slot: dict = DEFAULT_SLOT) -> int:
+        """Importa (e rimuove) il vecchio layout <archive>/vt<YYYYMMDD>/<base_time>_day<N>.png."""
+        n = 0
+        for path in sorted(glob.glob(os.path.join(self.root, "vt*", "*.png"))):
+            m = LEGACY_NAME_RE.search(path)
+            if not m:
+                continue
+            self.add(path, {**slot, "base_time": m.group(1), "day": int(m.group(2))})
+            os.remove(path)
+            n += 1
+        for d in glob.glob(os.path.join(self.root, "vt*")):
+            if os.path.isdir(d) and not os.listdir(d):
+                os.rmdir(d)
+        return n
+
+
+def base_times_between(start: str, end: str) -> list[str]:
+    day = datetime.strptime(start, "%Y%m%d")
+    last = datetime.strptime(end, "%Y%m%d")
+    out = []
+    while day <= last:
+        out.append(day.strftime("%Y%m%d0000"))
+        day += timedelta(days=1)
+    return out
+
+
+def backfill(archive: MapArchive, slots: list[dict], concurrency: int = DEFAULT_CONCURRENCY) -> dict:
+    """
+    Scarica via HTTP (API/template di streaming_resolver) gli slot non ancora in archivio.
+    I download vanno in parallelo; l'indice SQLite si aggiorna solo da questo thread.
+    """
+    todo = [s for s in slots if not archive.has(s)]
+    templates = streaming_resolver.load_templates()
+
+    def fetch(slot):
+        page = PAGE_URL.format(base=slot["base_time"], **{k: slot[k] for k in ("product", "area", "day", "quantile")})
+        out = os.path.join(tmp_dir, f"{slot['product']}_{slot['area']}_{slot['base_time']}_{slot['day']}.png")
+        t0 = time.monotonic()
+        hit = streaming_resolver.resolve(fetcher, page, out, templates=templates)
+        if not hit:
+            return None
+        return {"path": out, "src": hit[0], "fetch_ms": round((time.monotonic() - t0) * 1000, 1)}
+
+    report = {"requested": len(slots), "already": len(slots) - len(todo), "added": 0, "deduplicated": 0, "missing": []}
+    # la directory temporanea sparisce anche se add() solleva a metà backfill
+    with tempfile.TemporaryDirectory(prefix="backfill-") as tmp_dir, Fetcher(concurrency=concurrency) as fetcher:
+        for slot, hit, err in run_all(fetch, todo, concurrency=concurrency):
+            if not hit:
+                report["missing"].append({**slot, "error": str(err) if err else None})
+                continue
+            added = archive.add(hit["path"], slot, src=hit["src"], fetch_ms=hit["fetch_ms"])
+            os.remove(hit["path"])
+            report["added"] += 1
+            report["deduplicated"] += not added["new_object"]
+    return report
+
+
+def parse_days(value: str) -> list[int]:
+    days = []
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            days.extend(range(int(lo), int(hi) + 1))
+        elif part:
+            days.append(int(part))
+    return sorted(set(days))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Archivio delle mappe per contenuto, con indice SQLite.")
+    ap.add_argument("--archive", default=DEFAULT_ARCHIVE)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p_add = sub.add_parser("add", help="archivia mappe già scaricate (lead day da ...dayN.png)")
+    p_add.add_argument("paths", nargs="+")
+    p_add.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+
+    for name in ("latest", "leads"):
+        p = sub.add_parser(name, help="ultima mappa per un VT" if name == "latest" else "tutti i lead time per un VT")
+        p.add_argument("--vt", required=True, help="YYYYMMDD")
+
+    p_back = sub.add_parser("backfill", help="scarica in parallelo i base_time passati mancanti")
+    p_back.add_argument("--from", dest="start", required=True, help="YYYYMMDD")
+    p_back.add_argument("--to", dest="end", default=datetime.now(timezone.utc).strftime("%Y%m%d"))
+    p_back.add_argument("--days", default="1-3")
+    p_back.add_argument("--areas", default=DEFAULT_SLOT["area"])
+    p_back.add_argument("--quantiles", default=DEFAULT_SLOT["quantile"])
+    p_back.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    p_back.add_argument("--rate", type=float, default=2.0, help="richieste/secondo per host (0 = illimitato)")
+
+    sub.add_parser("stats")
+    for name, p in sub.choices.items():
+        p.add_argument("--product", default=DEFAULT_SLOT["product"])
+        if name != "backfill":
+            p.add_argument("--area", default=DEFAULT_SLOT["area"])
+            p.add_argument("--quantile", default=DEFAULT_SLOT["quantile"])
+    args = ap.parse_args(argv)
+
+    with MapArchive(args.archive) as archive:
+        if args.cmd == "add":
+            for path in args.paths:
+                m = MAP_NAME_RE.search(path)
+                if not m or not os.path.exists(path):
+                    continue
+                slot = {"product": args.product, "area": args.area, "quantile": args.quantile,
+                        "base_time": args.base_time, "day": int(m.group(1))}
+                r = archive.add(path, slot)
+                state = "nuova" if r["new_object"] else "già presente (0 byte in più)"
+                print(f"[archive] {path}: {state}, sha256 {r['sha256'][:12]}")
+        elif args.cmd in ("latest", "leads"):
+            slot = {"product": args.product, "area": args.area, "quantile": args.quantile}
+            rows = archive.lead_times_for_vt(args.vt, **slot)
+            print(json.dumps(rows[:1] if args.cmd == "latest" else rows, indent=1))
+            if not rows:
+                sys.exit(1)
+        elif args.cmd == "backfill":
+            RATE_LIMITER.configure(args.rate, 4)
+            slots = [{"product": args.product, "area": area, "quantile": q, "base_time": bt, "day": d}
+                     for bt in base_times_between(args.start, args.end)
+                     for area in args.areas.split(",") for q in args.quantiles.split(",")
+                     for d in parse_days(args.days)]
+            report = backfill(archive, slots, args.concurrency)
+            print(f"[backfill] richieste {report['requested']}, già in archivio {report['already']}, "
+                  f"aggiunte {report['added']} (di cui identiche a mappe già viste {report['deduplicated']}), "
+                  f"non trovate {len(report['missing'])}")
+            for miss in report["missing"]:
+                print(f"[miss] {miss['area']} q{miss['quantile']} {miss['base_time']} day {miss['day']}"
+                      + (f": {miss['error']}" if miss["error"] else ""))
+        else:
+            print(json.dumps(archive.stats(), indent=1))
+
+
+if __name__ == "__main__":
+    main()
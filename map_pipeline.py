@@ -0,0 +1,275 @@
+from datetime import datetime, timezone
+from queue import Queue
+import argparse
+import os
+import sys
+import threading
+import time
+
+from delivery import DirectorySink, SmtpSink
+from download_maps_auto import (BROWSER_STRATEGIES, STRATEGIES, StrategyState, cascade, out_path,
+                                playwright_available)
+from fetch_pool import PNG_MAGIC, Fetcher
+from run_trace import TRACE
+
+# Pipeline a stadi per le mappe: fetch -> validate -> postprocess -> deliver.
+# Ogni stadio ha il proprio pool di thread e legge da una coda limitata (backpressure:
+# se la consegna rallenta, il fetch si ferma invece di accumulare file). Una mappa passa
+# allo stadio successivo appena è pronta: il day più lento non trattiene gli altri e la
+# prima email/copia parte mentre gli altri day sono ancora in download.
+#   fetch        cascata di download_maps_auto su un solo day (ordine appreso dallo stato,
+#                storia "pipeline/<strategia>"), con un Fetcher e un browser condivisi
+#   validate     firma PNG, poi stale_check contro l'archivio: una mappa di un base_time
+#                precedente ripubblicata per questo VT viene scartata; le nuove si archiviano
+#   postprocess  crop + palette + ricompressione (postprocess.process_one)
+#   deliver      DirectorySink o SmtpSink (delivery.py), per mappa (--batch 1) o a lotti
+#
+# Esempio:
+#   python map_pipeline.py --sink dir --out-dir delivered
+#   MAPS_SMTP_HOST=127.0.0.1 MAPS_SMTP_PORT=8025 python map_pipeline.py --sink smtp --batch 2
+
+QUEUE_SIZE = int(os.environ.get("MAPS_QUEUE_SIZE", "2"))
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name: str, fn, workers: int = 1, queue_size: int = QUEUE_SIZE, close=None):
+        """
+        `fn(item)` restituisce l'item (o una lista di item, anche vuota, per gli stadi che
+        raggruppano) da passare avanti; None scarta l'item, un'eccezione lo registra come errore.
+        Nelle liste gli item con "error" vengono scartati uno per uno.
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue: Queue = Queue(maxsize=max(1, queue_size))
+        # chiamata dall'ultimo worker che termina (es. flush dei lotti in consegna)
+        self.close = close
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage]):
+        self.stages = stages
+        self.finished: list[dict] = []
+        self.dropped: list[dict] = []
+        self._lock = threading.Lock()
+        self._t0 = 0.0
+
+    def _forward(self, index: int, item):
+        if index + 1 < len(self.stages):
+            self.stages[index + 1].queue.put(item)
+        elif item is not _DONE:
+            with self._lock:
+                self.finished.append(item)
+
+    def _drop(self, stage: Stage, item: dict, error):
+        print(f"[{stage.name}] day {item.get('day')} scartato: {error}", flush=True)
+        with self._lock:
+            self.dropped.append({**item, "stage": stage.name, "error": error})
+
+    def _emit(self, index: int, out, t0: float):
+        for item in out if isinstance(out, list) else [out]:
+            # negli stadi a lotti un item può fallire da solo: arriva con "error"
+            if item.get("error"):
+                self._drop(self.stages[index], item, item["error"])
+                continue
+            item.setdefault("timings", {})[self.stages[index].name] = round(time.monotonic() - t0, 3)
+            item.setdefault("ready_at", {})[self.stages[index].name] = round(time.monotonic() - self._t0, 3)
+            self._forward(index, item)
+
+    def _worker(self, index: int, alive: list[int]):
+        stage = self.stages[index]
+        while True:
+            item = stage.queue.get()
+            if item is _DONE:
+                break
+            t0 = time.monotonic()
+            try:
+                with TRACE.span(f"stage_{stage.name}", day=item.get("day")):
+                    out = stage.fn(item)
+            except Exception as e:
+                out, error = None, str(e)
+            else:
+                error = item.get("reason") if out is None else None
+            if out is None:
+                self._drop(stage, item, error)
+                continue
+            self._emit(index, out, t0)
+        with self._lock:
+            alive[index] -= 1
+            last = alive[index] == 0
+        if last:
+            if stage.close:
+                try:
+                    self._emit(index, stage.close() or [], time.monotonic())
+                except Exception as e:
+                    print(f"[{stage.name}] chiusura fallita: {e}", flush=True)
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].workers):
+                    self.stages[index + 1].queue.put(_DONE)
+
+    def run(self, items: list[dict]) -> list[dict]:
+        self._t0 = time.monotonic()
+        alive = [s.workers for s in self.stages]
+        threads = [threading.Thread(target=self._worker, args=(i, alive), name=f"{s.name}-{n}", daemon=True)
+                   for i, s in enumerate(self.stages) for n in range(s.workers)]
+        for t in threads:
+            t.start()
+        first = self.stages[0]
+        for item in items:
+            first.queue.put(item)  # bloccante se il primo stadio è indietro
+        for _ in range(first.workers):
+            first.queue.put(_DONE)
+        for t in threads:
+            t.join()
+        return self.finished
+
+
+def fetch_stage(names: list[str], state: StrategyState, fetcher: Fetcher, engine=None):
+    # un client HTTP e (se serve) un browser per tutta la pipeline: i worker si dividono
+    # il pool keep-alive e le pagine dello stesso Chromium, un day per job
+    def fetch(item):
+        saved, _ = cascade(item["base_time"], [item["day"]], names, state, fetcher=fetcher, engine=engine)
+        if item["day"] not in saved:
+            item["reason"] = "nessuna strategia ha salvato il PNG"
+            return None
+        item["path"] = out_path(item["day"])
+        return item
+    return fetch
+
+
+def validate_stage(archive_dir: str | None):
+    local = threading.local()
+
+    def validate(item):
+        with open(item["path"], "rb") as f:
+            if f.read(len(PNG_MAGIC)) != PNG_MAGIC:
+                item["reason"] = "il file non è un PNG"
+                return None
+        if not archive_dir:
+            return item
+        # import qui: stale_check richiede NumPy; una connessione SQLite per thread
+        from map_archive import DEFAULT_SLOT, MapArchive
+        from stale_check import check_map
+        if not hasattr(local, "archive"):
+            local.archive = MapArchive(archive_dir)
+        slot = {**DEFAULT_SLOT, "base_time": item["base_time"], "day": item["day"]}
+        report = check_map(item["path"], slot, local.archive)
+        item["status"] = report["status"]
+        if report["status"] == "stale":
+            item["reason"] = f"uguale alla mappa di un run precedente ({report['match']})"
+            return None
+        if report["status"] == "fresh":
+            local.archive.add(item["path"], slot)
+        return item
+    return validate
+
+
+def postprocess_stage(item):
+    from postprocess import Image, process_one
+    if Image is None:
+        return item
+    r = process_one({"path": item["path"], "out": item["path"], "crop": "auto", "box": None, "lossy": False})
+    item["bytes"] = r["after"]
+    return item
+
+
+class DeliverStage:
+    """Consegna per mappa (batch=1) o a lotti; il lotto incompleto parte alla chiusura dello stadio."""
+
+    def __init__(self, sink, batch: int = 1):
+        self.sink = sink
+        self.batch = max(1, batch)
+        self.pending: list[dict] = []
+        self._lock = threading.Lock()
+
+    def _send(self, items: list[dict]) -> list[dict]:
+        # esito per mappa: un errore del sink non fa sparire il resto del lotto
+        try:
+            sent = self.sink.send(items)
+        except Exception as e:
+            sent = [e] * len(items)
+        for item, dest in zip(items, sent):
+            if isinstance(dest, Exception):
+                item["error"] = f"consegna fallita: {dest}"
+            else:
+                item["delivered"] = dest
+        days = ", ".join(str(i["day"]) for i in items if "delivered" in i)
+        if days:
+            print(f"[deliver] day {days} -> {self.sink.describe()}", flush=True)
+        return items
+
+    def __call__(self, item) -> list[dict]:
+        with self._lock:
+            self.pending.append(item)
+            if len(self.pending) < self.batch:
+                return []
+            ready, self.pending = self.pending, []
+        return self._send(ready)
+
+    def close(self) -> list[dict]:
+        with self._lock:
+            ready, self.pending = self.pending, []
+        return self._send(ready) if ready else []
+
+
+def build(args) -> tuple[Pipeline, StrategyState, list]:
+    """Pipeline, stato delle strategie e risorse condivise da chiudere a fine run."""
+    names = [n for n in args.strategies.split(",") if n in STRATEGIES]
+    # tempi per un solo day: storia separata da quella di download_maps_auto (più day per run)
+    state = StrategyState(scope="pipeline")
+    fetcher = Fetcher()
+    engine = None
+    if BROWSER_STRATEGIES & set(names) and playwright_available():
+        # import qui: capture_engine importa Playwright; Chromium parte solo alla prima cattura
+        from capture_engine import CaptureEngine
+        engine = CaptureEngine()
+    sink = SmtpSink() if args.sink == "smtp" else DirectorySink(args.out_dir)
+    deliver = DeliverStage(sink, args.batch)
+    stages = [
+        Stage("fetch", fetch_stage(names, state, fetcher, engine), workers=args.fetch_workers),
+        Stage("validate", validate_stage(None if args.no_archive else args.archive), workers=1),
+        Stage("postprocess", postprocess_stage, workers=args.post_workers),
+        # con i lotti un solo worker, così l'ordine di riempimento è quello di arrivo
+        Stage("deliver", deliver, workers=1 if args.batch > 1 else args.deliver_workers, close=deliver.close),
+    ]
+    return Pipeline(stages), state, [r for r in (engine, fetcher) if r is not None]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Pipeline fetch -> validate -> postprocess -> deliver con code limitate.")
+    ap.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+    ap.add_argument("--days", default="1,2,3")
+    ap.add_argument("--strategies", default=",".join(STRATEGIES))
+    ap.add_argument("--sink", choices=["dir", "smtp"], default="dir")
+    ap.add_argument("--out-dir", default="delivered")
+    ap.add_argument("--batch", type=int, default=1, help="mappe per invio (1 = appena pronta)")
+    ap.add_argument("--archive", default=os.environ.get("MAPS_ARCHIVE", "archive"))
+    ap.add_argument("--no-archive", action="store_true", help="salta il controllo mappe ripubblicate")
+    ap.add_argument("--fetch-workers", type=int, default=3)
+    ap.add_argument("--post-workers", type=int, default=2)
+    ap.add_argument("--deliver-workers", type=int, default=1)
+    args = ap.parse_args(argv)
+
+    days = [int(d) for d in args.days.split(",") if d.strip()]
+    print(f"[info] base_time={args.base_time}")
+    os.makedirs("maps", exist_ok=True)
+    pipeline, state, shared = build(args)
+    try:
+        finished = pipeline.run([{"day": d, "base_time": args.base_time} for d in days])
+    finally:
+        for resource in shared:
+            resource.close()
+    state.save()
+    delivered = {i["day"] for i in finished}
+    for item in sorted(finished, key=lambda i: i["day"]):
+        stages = ", ".join(f"{k} {v:.2f}s" for k, v in item["timings"].items())
+        print(f"[done] day {item['day']}: pronto dopo {item['ready_at']['deliver']:.2f}s ({stages})")
+    missing = [d for d in days if d not in delivered]
+    if missing:
+        print(f"[fail] day {missing} non consegnati.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+
+try:
+    from PIL import Image, ImageChops, ImageDraw
+except ImportError:
+    Image = None
+
+# Post-processing delle mappe prima dell'invio, su un pool di processi (MAPS_WORKERS):
+#   - crop all'area della mappa (bordo uniforme o box esplicito), utile sugli screenshot
+#   - quantizzazione a palette, senza perdita se l'immagine ha <= 256 colori
+#   - ricompressione PNG lossless (optimize + compress_level 9)
+#   - opzionale: un unico contact sheet con tutti i lead day
+# Un file viene sostituito solo se è stato ritagliato o se il risultato è più piccolo.
+
+DEFAULT_WORKERS = int(os.environ.get("MAPS_WORKERS", "0")) or None  # None = os.cpu_count()
+BG_TOLERANCE = 12  # differenza massima dal colore di sfondo considerata "bordo"
+
+
+def crop_box_auto(img) -> tuple[int, int, int, int] | None:
+    """Box del contenuto: tutto ciò che differisce dal colore dell'angolo in alto a sinistra."""
+    rgb = img.convert("RGB")
+    bg = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+    diff = ImageChops.difference(rgb, bg).convert("L").point(lambda v: 255 if v > BG_TOLERANCE else 0)
+    box = diff.getbbox()
+    if not box or box == (0, 0, *rgb.size):
+        return None
+    return box
+
+
+def to_palette(img, colors: int = 256, lossy: bool = False):
+    """
+    Converte in modalità P. Se i colori distinti sono <= `colors` la palette li contiene
+    tutti e la conversione è esatta; altrimenti quantizza solo con lossy=True.
+    """
+    if img.mode == "RGBA":
+        if img.getextrema()[3][0] < 255:
+            return img  # trasparenza reale: resta RGBA, solo ricompressione
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "P", "L"):
+        img = img.convert("RGB")
+    if img.mode in ("P", "L"):
+        return img
+    counts = img.getcolors(colors)
+    if counts is None:
+        if not lossy:
+            return img
+        return img.quantize(colors=colors, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    palette = [c for _, rgb in counts for c in rgb]
+    pal_img = Image.new("P", (1, 1))
+    pal_img.putpalette(palette + [0] * (768 - len(palette)))
+    return img.quantize(palette=pal_img, dither=Image.Dither.NONE)
+
+
+def process_one(task: dict) -> dict:
+    path, out = task["path"], task["out"]
+    before = os.path.getsize(path)
+    with Image.open(path) as src:
+        img = src.copy()
+    box = None
+    if task["crop"] == "auto":
+        box = crop_box_auto(img)
+    elif task["crop"] == "box":
+        box = task["box"]
+    if box:
+        img = img.crop(box)
+    img = to_palette(img, lossy=task["lossy"])
+    tmp = f"{out}.tmp{os.getpid()}.png"
+    img.save(tmp, format="PNG", optimize=True, compress_level=9)
+    after = os.path.getsize(tmp)
+    if after < before or out != path or box:
+        os.replace(tmp, out)
+    else:
+        os.remove(tmp)
+        after = before
+    return {"path": path, "out": out, "before": before, "after": after, "box": box, "mode": img.mode}
+
+
+def contact_sheet(paths: list[str], out_path: str, width: int = 800, columns: int = 3, pad: int = 8):
+    """Affianca le mappe (ridotte a `width` px) in una griglia con l'etichetta del file."""
+    thumbs = []
+    for p in paths:
+        with Image.open(p) as im:
+            im = im.convert("RGB")
+            h = round(im.height * width / im.width)
+            thumbs.append((os.path.splitext(os.path.basename(p))[0], im.resize((width, h), Image.LANCZOS)))
+    if not thumbs:
+        return None
+    columns = max(1, min(columns, len(thumbs)))
+    rows = (len(thumbs) + columns - 1) // columns
+    label_h = 18
+    cell_h = max(t.height for _, t in thumbs) + label_h
+    sheet = Image.new("RGB", (columns * (width + pad) + pad, rows * (cell_h + pad) + pad), "white")
+    draw = ImageDraw.Draw(sheet)
+    for i, (label, thumb) in enumerate(thumbs):
+        x = pad + (i % columns) * (width + pad)
+        y = pad + (i // columns) * (cell_h + pad)
+        draw.text((x, y + 2), label, fill="black")
+        sheet.paste(thumb, (x, y + label_h))
+    to_palette(sheet, lossy=True).save(out_path, format="PNG", optimize=True)
+    return out_path
+
+
+def parse_box(value: str) -> tuple[int, int, int, int]:
+    x0, y0, x1, y1 = (int(v) for v in value.split(","))
+    return x0, y0, x1, y1
+
+
+def run(paths: list[str], out_dir: str | None = None, crop: str = "auto", box=None, lossy: bool = False,
+        sheet: str | None = None, workers: int | None = DEFAULT_WORKERS) -> list[dict]:
+    tasks = []
+    for p in paths:
+        out = os.path.join(out_dir, os.path.basename(p)) if out_dir else p
+        tasks.append({"path": p, "out": out, "crop": crop, "box": box, "lossy": lossy})
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(process_one, tasks))
+    for r in results:
+        saved = 100 * (1 - r["after"] / r["before"]) if r["before"] else 0
+        print(f"[post] {r['out']}: {r['before']/1024:.1f} KB -> {r['after']/1024:.1f} KB "
+              f"(-{saved:.0f}%, {r['mode']}, crop={r['box']})")
+    if sheet:
+        contact_sheet([r["out"] for r in results], sheet)
+        print(f"[post] contact sheet: {sheet} ({os.path.getsize(sheet)/1024:.1f} KB)")
+    return results
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Crop, palette e ricompressione delle mappe PNG, in parallelo.")
+    ap.add_argument("paths", nargs="+")
+    ap.add_argument("--out-dir", help="default: sovrascrive i file in ingresso")
+    ap.add_argument("--crop", choices=["auto", "box", "none"], default="auto")
+    ap.add_argument("--box", type=parse_box, help="x0,y0,x1,y1 (con --crop box)")
+    ap.add_argument("--lossy", action="store_true", help="quantizza a 256 colori anche quando non è esatto")
+    ap.add_argument("--contact-sheet", dest="sheet")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    args = ap.parse_args(argv)
+    if Image is None:
+        print("[warn] Pillow non installato: post-processing saltato.")
+        return
+    paths = [p for p in args.paths if os.path.exists(p)]
+    if not paths:
+        # exit 0: uno step fallito salterebbe gli step successivi del workflow (email)
+        print("[warn] nessuna mappa da elaborare.")
+        return
+    run(paths, out_dir=args.out_dir, crop=args.crop, box=args.box, lossy=args.lossy,
+        sheet=args.sheet, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urljoin, urlparse
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+from download_maps_from_html import scan_png_urls
+from fetch_pool import CHARTS_ORIGIN, Fetcher, iter_chunks
+from http_cache import slot_from_url
+from run_trace import TRACE
+import streaming_resolver
+
+# Attende la pubblicazione del run di oggi e poi lancia subito la pipeline di cattura.
+# Invece di un cron fisso che presume il base_time già online (strict e check_vt
+# falliscono se non lo è), il workflow parte prima e questo watcher interroga il sito
+# con richieste leggere, con intervallo crescente (backoff con jitter):
+#   1. API JSON del prodotto, con GET condizionale (ETag/Last-Modified: 304 se nulla è cambiato)
+#   2. HEAD sull'URL /streaming/ previsto dal template dell'ultima cattura
+#   3. pagina prodotto letta a chunk fino al primo PNG /streaming/ di oggi
+# Il run è "pubblicato" quando per ogni lead day controllato c'è un PNG con la data
+# del base_time nel path /streaming/. Exit code: quello della pipeline; se entro --until
+# non è comparso nulla, 0 con un warning e published=false in GITHUB_OUTPUT (un run
+# non ancora pubblicato non è un errore del workflow).
+# Ipotesi non verificate sul sito: l'endpoint API (streaming_resolver.API_URL), l'orario
+# abituale di pubblicazione (~07:00 UTC, da cui il cron alle 06:40) e la finestra di
+# 45 minuti sono stime da osservazione, non documentate da ECMWF.
+#
+# Esempio:
+#   python publication_watcher.py --until 2700 -- python download_maps_via_network_strict.py
+
+PAGE_URL = CHARTS_ORIGIN + "/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
+BACKOFF = 1.5
+
+
+def is_published(url: str, base_time: str) -> bool:
+    # solo il path /streaming/<data>-: il base_time compare anche nella query di API e pagina
+    return f"/streaming/{base_time[:8]}-" in urlparse(url).path
+
+
+class PublicationWatcher:
+    def __init__(self, fetcher: Fetcher, base_time: str, days: list[int], templates: dict | None = None):
+        self.fetcher = fetcher
+        self.base_time = base_time
+        self.days = days
+        self.templates = streaming_resolver.load_templates() if templates is None else templates
+        # validatori HTTP per URL, riusati tra un giro e l'altro; per l'API anche
+        # l'ultima risposta ("found"), che resta valida finché il server risponde 304
+        self.validators: dict[str, dict] = {}
+
+    def _conditional_get(self, url: str, accept: str):
+        """GET condizionale; None su 304 (niente di nuovo dall'ultimo giro)."""
+        headers = {"Accept": accept}
+        v = self.validators.get(url, {})
+        if v.get("etag"):
+            headers["If-None-Match"] = v["etag"]
+        if v.get("last_modified"):
+            headers["If-Modified-Since"] = v["last_modified"]
+        r = self.fetcher.get(url, headers=headers)
+        if r.status_code == 304:
+            TRACE.count("watch_not_modified")
+            return None
+        self.validators[url] = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        return r
+
+    def probe_api(self, page_url: str, slot: dict) -> str | None:
+        parsed = urlparse(page_url)
+        api = urljoin(f"{parsed.scheme}://{parsed.netloc}/", streaming_resolver.API_URL.format(product=slot["product"]))
+        query = {k: slot[k] for k in ("area", "base_time", "day", "quantile") if slot.get(k)}
+        url = f"{api}?{urlencode(query)}"
+        r = self._conditional_get(url, "application/json")
+        if r is None:
+            # 304: stessa risposta del giro precedente
+            return self.validators.get(url, {}).get("found")
+        if r.status_code != 200:
+            return None
+        try:
+            urls = streaming_resolver._png_urls_in(r.json(), page_url)
+        except ValueError:
+            return None
+        found = next((u for u in urls if is_published(u, self.base_time)), None)
+        self.validators[url]["found"] = found
+        return found
+
+    def probe_template(self, slot: dict) -> str | None:
+        url = streaming_resolver.predict_from_template(slot, self.templates)
+        if not url:
+            return None
+        r = self.fetcher.head(url)
+        ctype = r.headers.get("Content-Type", "")
+        length = r.headers.get("Content-Length", "")
+        if r.status_code == 200 and "image/png" in ctype and (not length.isdigit()
+                                                               or int(length) >= streaming_resolver.MIN_PNG_SIZE):
+            return url
+        return None
+
+    def probe_page(self, page_url: str) -> str | None:
+        # si chiude la connessione appena compare il PNG di oggi
+        with self.fetcher.stream(page_url) as r:
+            if r.status_code != 200:
+                return None
+            urls = scan_png_urls(iter_chunks(r), page_url, self.base_time)
+        return next((u for u in urls if is_published(u, self.base_time)), None)
+
+    def check(self) -> dict[int, dict] | None:
+        """{day: {"url", "method"}} se tutti i day risultano pubblicati, altrimenti None."""
+        found = {}
+        for day in self.days:
+            page_url = PAGE_URL.format(base=self.base_time, day=day)
+            slot = slot_from_url(page_url)
+            for method, probe in (("api", lambda: self.probe_api(page_url, slot)),
+                                  ("template", lambda: self.probe_template(slot)),
+                                  ("page", lambda: self.probe_page(page_url))):
+                try:
+                    url = probe()
+                except Exception as e:
+                    print(f"[warn] watch day {day}: probe {method} fallita ({e})")
+                    continue
+                if url:
+                    found[day] = {"url": url, "method": method}
+                    break
+            if day not in found:
+                return None
+        return found
+
+
+def watch(watcher: PublicationWatcher, interval: float, max_interval: float, until: float) -> dict | None:
+    deadline = time.monotonic() + until
+    wait = interval
+    attempt = 0
+    while True:
+        attempt += 1
+        with TRACE.span("watch_poll", attempt=attempt) as span:
+            found = watcher.check()
+            span["published"] = bool(found)
+        if found:
+            return found
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        pause = min(remaining, wait * random.uniform(0.8, 1.2))
+        print(f"[watch] giro {attempt}: base_time {watcher.base_time} non ancora pubblicato, riprovo tra {pause:.0f}s",
+              flush=True)
+        time.sleep(pause)
+        wait = min(max_interval, wait * BACKOFF)
+
+
+def github_output(**values):
+    if os.environ.get("GITHUB_OUTPUT"):
+        with open(os.environ["GITHUB_OUTPUT"], "a") as f:
+            for k, v in values.items():
+                f.write(f"{k}={v}\n")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # tutto ciò che segue "--" è il comando della pipeline
+    cmd = []
+    if "--" in argv:
+        cut = argv.index("--")
+        argv, cmd = argv[:cut], argv[cut + 1:]
+    ap = argparse.ArgumentParser(description="Attende la pubblicazione del base_time di oggi, poi lancia la pipeline.")
+    ap.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+    ap.add_argument("--days", default="1", help="lead day da controllare, es. 1,2,3")
+    ap.add_argument("--interval", type=float, default=60, help="secondi tra i primi controlli")
+    ap.add_argument("--max-interval", type=float, default=600)
+    ap.add_argument("--until", type=float, default=45 * 60, help="secondi massimi di attesa")
+    args = ap.parse_args(argv)
+
+    days = [int(d) for d in args.days.split(",") if d.strip()]
+    # la pipeline scrive la sua trace in maps/trace.jsonl: il watcher usa file propri
+    TRACE.prefix = "watch_"
+    t0 = time.monotonic()
+    with Fetcher(concurrency=2) as fetcher:
+        found = watch(PublicationWatcher(fetcher, args.base_time, days), args.interval, args.max_interval, args.until)
+    waited = round(time.monotonic() - t0)
+    if not found:
+        print(f"[warn] base_time {args.base_time} non pubblicato entro {args.until:.0f}s, pipeline non avviata.")
+        if os.environ.get("GITHUB_ACTIONS"):
+            print(f"::warning::base_time {args.base_time} non pubblicato entro {args.until:.0f}s")
+        github_output(published="false", base_time=args.base_time, waited_s=waited)
+        return
+    for day, hit in sorted(found.items()):
+        print(f"[ok] day {day} pubblicato (via {hit['method']}): {hit['url']}")
+    TRACE.event("published", base_time=args.base_time, waited_s=waited)
+    github_output(published="true", base_time=args.base_time, waited_s=waited)
+    if not cmd:
+        return
+    print(f"[watch] pubblicato dopo {waited}s, avvio: {' '.join(cmd)}", flush=True)
+    with TRACE.span("pipeline", cmd=" ".join(cmd)) as span:
+        code = subprocess.run(cmd).returncode
+        span["exit_code"] = code
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
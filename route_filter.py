@@ -0,0 +1,123 @@
+import json
+import os
+import re
+
+# Filtro delle richieste del browser (page.route / context.route) durante la cattura.
+# Alla pagina servono solo l'HTML (per il VT), gli script che caricano il grafico
+# e il PNG della mappa: font, CSS, analytics e immagini non PNG si possono abortire.
+#
+# Configurazione:
+#   MAPS_ROUTE_FILTER = nome preset (network, screenshot) oppure "off"
+#   MAPS_ROUTE_MODE   = block (abortisce) | audit (lascia passare e misura cosa bloccherebbe)
+#   MAPS_ROUTE_POLICY = file JSON con le stesse chiavi dei preset, sovrascrive il preset
+#
+# Default: acceso negli script one-shot (context nuovo, cache del browser vuota in ogni
+# caso), spento in capture_daemon.py, dove il routing annullerebbe la cache HTTP del
+# profilo persistente che è il motivo stesso del daemon.
+
+ANALYTICS_PATTERNS = [
+    r"google-analytics\.com", r"googletagmanager\.com", r"doubleclick\.net",
+    r"matomo", r"piwik", r"hotjar", r"/analytics", r"/collect\?",
+]
+
+PRESETS = {
+    # cattura di rete: basta il DOM, gli script/XHR dell'app e i PNG
+    "network": {
+        "allow_patterns": [r"/streaming/", r"\.png(\?|$)"],
+        "deny_patterns": ANALYTICS_PATTERNS + [r"\.(svg|gif|jpe?g|webp|ico)(\?|$)"],
+        "deny_types": ["font", "stylesheet", "media", "manifest", "texttrack"],
+    },
+    # screenshot: il render ha bisogno di CSS e font, si tagliano solo analytics e media
+    "screenshot": {
+        "allow_patterns": [],
+        "deny_patterns": ANALYTICS_PATTERNS,
+        "deny_types": ["media", "manifest"],
+    },
+}
+
+
+class RouteFilter:
+    """
+    Decide per ogni richiesta: pattern di allow sull'URL > pattern di deny >
+    tipo di risorsa in deny > allow. Tiene i contatori di richieste e byte
+    bloccati/lasciati passare (in modalità audit i byte "bloccati" sono quelli
+    realmente scaricati dalle richieste che sarebbero state abortite).
+    """
+
+    def __init__(self, policy: dict, mode: str = "block", name: str = "custom"):
+        self.name = name
+        self.mode = mode
+        self.allow_patterns = [re.compile(p, re.I) for p in policy.get("allow_patterns", [])]
+        self.deny_patterns = [re.compile(p, re.I) for p in policy.get("deny_patterns", [])]
+        self.deny_types = set(policy.get("deny_types", []))
+        self._would_block = set()
+        self.stats = {
+            "blocked": 0, "blocked_bytes": 0, "blocked_by_type": {},
+            "allowed": 0, "allowed_bytes": 0,
+        }
+
+    def should_block(self, url: str, resource_type: str) -> bool:
+        if any(p.search(url) for p in self.allow_patterns):
+            return False
+        if any(p.search(url) for p in self.deny_patterns):
+            return True
+        return resource_type in self.deny_types
+
+    async def handle(self, route):
+        request = route.request
+        rtype = request.resource_type
+        if not self.should_block(request.url, rtype):
+            self.stats["allowed"] += 1
+            await route.continue_()
+            return
+        self.stats["blocked"] += 1
+        by_type = self.stats["blocked_by_type"]
+        by_type[rtype] = by_type.get(rtype, 0) + 1
+        if self.mode == "audit":
+            self._would_block.add(request)
+            await route.continue_()
+        else:
+            await route.abort("blockedbyclient")
+
+    async def on_request_finished(self, request):
+        try:
+            sizes = await request.sizes()
+        except Exception:
+            return
+        n = sizes.get("responseBodySize", 0) + sizes.get("responseHeadersSize", 0)
+        if request in self._would_block:
+            self._would_block.discard(request)
+            self.stats["blocked_bytes"] += n
+        else:
+            self.stats["allowed_bytes"] += n
+
+    async def attach(self, context):
+        await context.route("**/*", self.handle)
+        context.on("requestfinished", self.on_request_finished)
+
+    def summary(self) -> str:
+        s = self.stats
+        types = ", ".join(f"{k}={v}" for k, v in sorted(s["blocked_by_type"].items())) or "-"
+        verb = "da bloccare (audit)" if self.mode == "audit" else "bloccate"
+        line = (f"[route] filtro '{self.name}': {s['blocked']} richieste {verb} ({types}); "
+                f"lasciate passare {s['allowed']} ({s['allowed_bytes']/1024:.1f} KB)")
+        if self.mode == "audit":
+            line += f"; byte risparmiabili {s['blocked_bytes']/1024:.1f} KB"
+        else:
+            # una richiesta abortita non scarica nulla: i byte si misurano solo in audit
+            line += "; byte risparmiati non misurati (MAPS_ROUTE_MODE=audit per stimarli)"
+        return line
+
+
+def route_filter_from_env(default_preset: str) -> RouteFilter | None:
+    name = os.environ.get("MAPS_ROUTE_FILTER", default_preset)
+    if not name or name == "off":
+        return None
+    policy = dict(PRESETS.get(name, {}))
+    policy_file = os.environ.get("MAPS_ROUTE_POLICY")
+    if policy_file:
+        with open(policy_file, encoding="utf-8") as f:
+            policy.update(json.load(f))
+    elif name not in PRESETS:
+        raise ValueError(f"preset di routing sconosciuto: {name} (validi: {', '.join(PRESETS)}, off)")
+    return RouteFilter(policy, mode=os.environ.get("MAPS_ROUTE_MODE", "block"), name=name)
@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+# Strumentazione dei run: span a fasi, eventi puntuali e contatori, scritti come
+# JSON lines in maps/trace.jsonl (un record per riga, "t" = secondi dall'avvio)
+# più un riepilogo maps/trace_summary.json a fine processo (durate per fase,
+# contatori, istante del primo evento di ogni tipo). Il workflow li carica
+# insieme alle mappe.
+# Override: MAPS_TRACE=0 disattiva, MAPS_TRACE_DIR cambia cartella (default "maps").
+#
+# Uso:
+#   from run_trace import TRACE
+#   with TRACE.span("goto", day=1):
+#       ...
+#   TRACE.event("winning_png", day=1, size=123456)
+#   TRACE.count("bytes_read", len(body))
+
+TRACE_DIR = os.environ.get("MAPS_TRACE_DIR", "maps")
+TRACE_ENABLED = os.environ.get("MAPS_TRACE", "1") != "0"
+
+
+class RunTrace:
+    def __init__(self, out_dir: str = TRACE_DIR, enabled: bool = TRACE_ENABLED):
+        self.out_dir = out_dir
+        self.enabled = enabled
+        # prefisso dei file, per processi che ne lanciano altri tracciati (es. il watcher)
+        self.prefix = ""
+        self.t0 = time.monotonic()
+        self.started_at = time.time()
+        self.counters: dict[str, float] = {}
+        self.spans: dict[str, list[float]] = {}
+        self.first: dict[str, float] = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def now(self) -> float:
+        return round(time.monotonic() - self.t0, 4)
+
+    def _write(self, record: dict):
+        if self._finished:
+            return
+        # il file si apre al primo record: importare il modulo non crea nulla su disco
+        if self._file is None:
+            os.makedirs(self.out_dir, exist_ok=True)
+            self._file = open(os.path.join(self.out_dir, f"{self.prefix}trace.jsonl"), "w", encoding="utf-8")
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+
+    def record(self, kind: str, name: str, **attrs):
+        if not self.enabled:
+            return
+        t = attrs.pop("t", None)
+        record = {"t": self.now() if t is None else t, "type": kind, "name": name, **attrs}
+        with self._lock:
+            self.first.setdefault(name, record["t"])
+            self._write(record)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Misura la durata del blocco; l'errore, se c'è, finisce nel record."""
+        if not self.enabled:
+            yield attrs
+            return
+        start = self.now()
+        error = None
+        try:
+            # il chiamante può aggiungere attributi noti solo a fine blocco (es. byte)
+            yield attrs
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            dur_ms = round((self.now() - start) * 1000, 1)
+            with self._lock:
+                self.spans.setdefault(name, []).append(dur_ms)
+            extra = {"error": error} if error else {}
+            self.record("span", name, t=start, dur_ms=dur_ms, **attrs, **extra)
+
+    def event(self, name: str, **attrs):
+        self.record("event", name, **attrs)
+
+    def count(self, name: str, n: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def log(self, msg: str):
+        self.record("log", "log", msg=msg)
+
+    def summary(self) -> dict:
+        phases = {}
+        for name, durations in self.spans.items():
+            ordered = sorted(durations)
+            phases[name] = {
+                "count": len(ordered),
+                "total_ms": round(sum(ordered), 1),
+                "p50_ms": ordered[len(ordered) // 2],
+                "max_ms": ordered[-1],
+            }
+        return {
+            "script": os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+            "wall_s": self.now(),
+            "phases": dict(sorted(phases.items(), key=lambda kv: -kv[1]["total_ms"])),
+            "counters": self.counters,
+            "first_at_s": {k: v for k, v in self.first.items() if k != "log"},
+        }
+
+    def finish(self):
+        """Chiude la trace e scrive il riepilogo (chiamata anche da atexit)."""
+        if not self.enabled or self._finished or self._file is None:
+            return
+        self._finished = True
+        with self._lock:
+            self._file.close()
+        path = os.path.join(self.out_dir, f"{self.prefix}trace_summary.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+TRACE = RunTrace()
+atexit.register(TRACE.finish)
@@ -0,0 +1,149 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from map_archive import DEFAULT_ARCHIVE, DEFAULT_SLOT, MAP_NAME_RE, MapArchive, vt_for
+from http_cache import file_sha256
+
+# Controllo "mappa vecchia": confronta ogni PNG nuovo con le mappe archiviate per lo
+# stesso valid time (VT = data del base_time + day - 1). Se ECMWF ripubblica
+# l'immagine di ieri sotto un URL nuovo, il controllo sull'URL non se ne accorge,
+# ma l'immagine risulta (quasi) identica a quella già archiviata per quel VT.
+# Due misure, tutte vettoriali in NumPy:
+#   - dHash 64 bit (gradiente orizzontale su 9x8 in scala di grigi) -> distanza di Hamming
+#   - frazione di pixel che differiscono oltre una tolleranza, su una versione ridotta
+# Archivio: map_archive (oggetti per sha256 + indice SQLite); un file identico byte per
+# byte a una mappa già archiviata si riconosce dall'hash senza decodificare nulla.
+# Le prime versioni di questo controllo archiviavano in <archive>/vt<YYYYMMDD>/<base_time>_day<N>.png:
+# a ogni avvio MapArchive.import_legacy() sposta quei file nel nuovo archivio (e li rimuove),
+# quindi un archivio vecchio si migra da solo, senza passi manuali.
+
+HASH_MAX_DISTANCE = 4      # bit diversi su 64 per considerare due mappe "uguali"
+DIFF_MAX_RATIO = 0.002     # frazione massima di pixel diversi
+PIXEL_TOLERANCE = 24       # differenza per canale sotto cui un pixel conta come uguale
+COMPARE_WIDTH = 400        # larghezza di lavoro (circa) per il confronto pixel
+
+
+def load_rgb(path: str, width: int = COMPARE_WIDTH) -> np.ndarray:
+    with Image.open(path) as im:
+        im = im.convert("RGB")
+        # riduzione a fattore intero (box filter), molto più rapida di un resize arbitrario
+        factor = im.width // width
+        if factor > 1:
+            im = im.reduce(factor)
+        return np.asarray(im, dtype=np.int16)
+
+
+def dhash(rgb: np.ndarray) -> np.ndarray:
+    """dHash 64 bit come array di 64 booleani."""
+    gray = Image.fromarray(rgb.astype(np.uint8)).convert("L").resize((9, 8), Image.BILINEAR)
+    g = np.asarray(gray, dtype=np.int16)
+    return (g[:, 1:] > g[:, :-1]).ravel()
+
+
+def compare(a: np.ndarray, b: np.ndarray) -> dict:
+    distance = int(np.count_nonzero(dhash(a) != dhash(b)))
+    if a.shape != b.shape:
+        # dimensioni diverse: confronto pixel sulla griglia della più piccola
+        h, w = min(a.shape[0], b.shape[0]), min(a.shape[1], b.shape[1])
+        a = np.asarray(Image.fromarray(a.astype(np.uint8)).resize((w, h)), dtype=np.int16)
+        b = np.asarray(Image.fromarray(b.astype(np.uint8)).resize((w, h)), dtype=np.int16)
+    changed = np.any(np.abs(a - b) > PIXEL_TOLERANCE, axis=-1)
+    ratio = float(changed.mean())
+    return {
+        "hash_distance": distance,
+        "diff_ratio": ratio,
+        "same": distance <= HASH_MAX_DISTANCE and ratio <= DIFF_MAX_RATIO,
+    }
+
+
+def check_map(path: str, slot: dict, archive: MapArchive) -> dict:
+    """
+    Confronta `path` con tutte le mappe archiviate per lo stesso VT (stessi product/area/quantile).
+    status: fresh | duplicate (già archiviata per questo base_time, es. rerun)
+            | stale (uguale a quella di un base_time precedente)
+    """
+    t0 = time.perf_counter()
+    base_time, day = slot["base_time"], slot["day"]
+    vt = vt_for(base_time, day)
+    report = {"path": path, "day": day, "vt": vt, "status": "fresh", "match": None}
+    rows = archive.lead_times_for_vt(vt, product=slot["product"], area=slot["area"], quantile=slot["quantile"])
+    sha = file_sha256(path)
+    # a parità di hash conta prima la riga dello stesso base_time (rerun)
+    exact = min((r for r in rows if r["sha256"] == sha), key=lambda r: r["base_time"] != base_time, default=None)
+    if exact:
+        report.update({"match": exact["path"], "hash_distance": 0, "diff_ratio": 0.0, "same": True})
+        report["status"] = "duplicate" if exact["base_time"] == base_time else "stale"
+    else:
+        new = load_rgb(path)
+        seen = set()
+        for row in rows:
+            if row["sha256"] in seen:
+                continue
+            seen.add(row["sha256"])
+            result = compare(new, load_rgb(row["path"]))
+            if result["same"]:
+                status = "duplicate" if row["base_time"] == base_time else "stale"
+                report.update({"status": status, "match": row["path"], **result})
+                break
+    report["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return report
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Rileva mappe identiche a quelle già archiviate per lo stesso VT.")
+    ap.add_argument("paths", nargs="+", help="mappe nuove (il lead day si ricava da ...dayN.png)")
+    ap.add_argument("--base-time", default=datetime.now(timezone.utc).strftime("%Y%m%d0000"))
+    ap.add_argument("--archive", default=DEFAULT_ARCHIVE)
+    ap.add_argument("--report", default="maps/stale_report.json")
+    ap.add_argument("--no-archive", action="store_true", help="non archiviare le mappe nuove")
+    ap.add_argument("--product", default=DEFAULT_SLOT["product"])
+    ap.add_argument("--area", default=DEFAULT_SLOT["area"])
+    ap.add_argument("--quantile", default=DEFAULT_SLOT["quantile"])
+    args = ap.parse_args(argv)
+
+    reports = []
+    archive = MapArchive(args.archive)
+    moved = archive.import_legacy()
+    if moved:
+        print(f"[archive] {moved} mappe importate dal vecchio layout vt<YYYYMMDD>/")
+    for path in args.paths:
+        m = MAP_NAME_RE.search(path)
+        if not m or not os.path.exists(path):
+            continue
+        day = int(m.group(1))
+        slot = {"product": args.product, "area": args.area, "quantile": args.quantile,
+                "base_time": args.base_time, "day": day}
+        r = check_map(path, slot, archive)
+        reports.append(r)
+        if r["status"] == "fresh":
+            print(f"[ok] day {day} (VT {r['vt']}): mappa nuova ({r['ms']} ms)")
+            if not args.no_archive:
+                archive.add(path, slot)
+        else:
+            print(f"[{r['status']}] day {day} (VT {r['vt']}): uguale a {r['match']} "
+                  f"(hash {r['hash_distance']}/64, pixel diversi {100*r['diff_ratio']:.2f}%, {r['ms']} ms)")
+
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=1)
+    archive.close()
+
+    # per il workflow: l'email parte solo se nessuna mappa è di un run precedente.
+    # "duplicate" (stesso base_time già archiviato) è un rerun del workflow, magari dopo una
+    # consegna fallita: le mappe si mandano di nuovo
+    fresh = bool(reports) and all(r["status"] in ("fresh", "duplicate") for r in reports)
+    if os.environ.get("GITHUB_OUTPUT"):
+        with open(os.environ["GITHUB_OUTPUT"], "a") as f:
+            f.write(f"fresh={'true' if fresh else 'false'}\n")
+    sys.exit(0 if fresh else 3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urljoin, urlparse
+import json
+import os
+import re
+import sys
+
+from fetch_pool import CHARTS_ORIGIN, DEFAULT_CONCURRENCY, Fetcher, run_all, stream_to_file
+from http_cache import HttpCache, slot_from_url
+from run_trace import TRACE
+
+# Risolve l'URL del PNG /streaming/YYYYMMDD-HHMM senza browser:
+#   1. API JSON che la pagina prodotto usa per ottenere l'immagine
+#   2. template imparato dall'ultima cattura Playwright riuscita (stesso product/area/
+#      quantile/day), con data e base_time sostituiti
+# Il PNG si scarica con un semplice GET; Playwright resta solo come fallback.
+
+API_URL = "/opencharts-api/v1/products/{product}/"
+TEMPLATES_PATH = os.environ.get("MAPS_TEMPLATES", ".cache/maps/streaming_templates.json")
+MIN_PNG_SIZE = 50_000
+
+STREAMING_RE = re.compile(r"/streaming/(\d{8})-(\d{4})")
+PNG_URL_RE = re.compile(r"\.png(\?|$)", re.I)
+
+
+def _template_key(slot: dict) -> str:
+    return "|".join(str(slot[k]) for k in ("product", "area", "quantile", "day"))
+
+
+def load_templates(path: str = TEMPLATES_PATH) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def learn(slot: dict, src_url: str, path: str = TEMPLATES_PATH):
+    """Memorizza l'URL /streaming/ catturato per lo slot, come template per i run successivi."""
+    if not STREAMING_RE.search(src_url):
+        return
+    templates = load_templates(path)
+    templates[_template_key(slot)] = {"url": src_url, "base_time": slot["base_time"]}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(templates, f, indent=1)
+    os.replace(tmp, path)
+
+
+def predict_from_template(slot: dict, templates: dict) -> str | None:
+    t = templates.get(_template_key(slot))
+    if not t:
+        return None
+    url = t["url"]
+    if t["base_time"] == slot["base_time"]:
+        return url
+    # sostituisce la data di streaming (l'orario -HHMM resta quello imparato) e il base_time
+    url = STREAMING_RE.sub(lambda m: f"/streaming/{slot['base_time'][:8]}-{m.group(2)}", url)
+    return url.replace(t["base_time"], slot["base_time"])
+
+
+def _png_urls_in(obj, base_url: str) -> list[str]:
+    # cerca ricorsivamente stringhe che sembrano URL di PNG nel JSON dell'API
+    found = []
+    if isinstance(obj, dict):
+        for v in obj.values():
+            found += _png_urls_in(v, base_url)
+    elif isinstance(obj, list):
+        for v in obj:
+            found += _png_urls_in(v, base_url)
+    elif isinstance(obj, str) and (STREAMING_RE.search(obj) or PNG_URL_RE.search(obj)):
+        found.append(urljoin(base_url, obj))
+    return found
+
+
+def resolve_via_api(fetcher: Fetcher, page_url: str, slot: dict) -> str | None:
+    parsed = urlparse(page_url)
+    # stessa origine della pagina (permette di puntare a uno stand-in locale)
+    api = urljoin(f"{parsed.scheme}://{parsed.netloc}/", API_URL.format(product=slot["product"]))
+    query = {k: slot[k] for k in ("area", "base_time", "day", "quantile") if slot.get(k)}
+    r = fetcher.get(f"{api}?{urlencode(query)}", headers={"Accept": "application/json"})
+    if r.status_code != 200:
+        return None
+    try:
+        data = r.json()
+    except ValueError:
+        return None
+    urls = _png_urls_in(data, page_url)
+    # preferisci gli URL /streaming/ con la data del base_time richiesto
+    urls.sort(key=lambda u: (f"/streaming/{slot['base_time'][:8]}-" not in u, "/streaming/" not in u))
+    return urls[0] if urls else None
+
+
+def fetch_png(fetcher: Fetcher, url: str, out_path: str, min_size: int = MIN_PNG_SIZE) -> int | None:
+    # streaming su file: Content-Length e firma PNG controllati prima di scaricare tutto
+    try:
+        return stream_to_file(fetcher, url, out_path, png=True, min_size=min_size)["size"]
+    except Exception:
+        return None
+
+
+def resolve(fetcher: Fetcher, page_url: str, out_path: str, accept=None, templates: dict | None = None,
+            min_size: int = MIN_PNG_SIZE) -> tuple[str, int, str] | None:
+    """
+    Prova API e template; salva in `out_path` il primo PNG valido che passa anche
+    il filtro `accept(url, ctype)` della strategia e restituisce (url, size, metodo),
+    altrimenti None.
+    """
+    slot = slot_from_url(page_url)
+    templates = load_templates() if templates is None else templates
+    candidates = []
+    try:
+        api_url = resolve_via_api(fetcher, page_url, slot)
+        if api_url:
+            candidates.append((api_url, "api"))
+    except Exception as e:
+        print(f"[warn] resolver API fallito per day {slot['day']}: {e}")
+    predicted = predict_from_template(slot, templates)
+    if predicted:
+        candidates.append((predicted, "template"))
+    for url, method in candidates:
+        if accept and not accept(url, "image/png"):
+            continue
+        size = fetch_png(fetcher, url, out_path, min_size)
+        if size:
+            TRACE.event("winning_png", day=slot["day"], url=url, size=size, method=method)
+            return url, size, method
+    return None
+
+
+def resolve_jobs(items: list, cache: HttpCache | None = None,
+                 concurrency: int = DEFAULT_CONCURRENCY, fetcher: Fetcher | None = None) -> dict[int, dict]:
+    """
+    Versione per capture_engine: `items` = [(indice, CaptureJob)]. Risolve via HTTP
+    i job che non leggono il testo pagina e salva i PNG su disco (con il `fetcher`
+    condiviso del chiamante, se c'è).
+    Restituisce {indice: {"src", "size", "method"}} per i job risolti.
+    """
+    todo = [(i, job) for i, job in items if not job.screenshot_only and not job.read_text]
+    if not todo:
+        return {}
+    templates = load_templates()
+
+    def one(item):
+        i, job = item
+        hit = resolve(fetcher, job.url, job.out_png, accept=job.accepts, templates=templates, min_size=job.min_size)
+        if not hit:
+            return None
+        url, size, method = hit
+        if cache is not None:
+            cache.put_file(slot_from_url(job.url), url, job.out_png)
+        print(f"[resolver] {job.label}: PNG senza browser via {method} (src={url})", flush=True)
+        return {"src": url, "size": size, "method": method}
+
+    served = {}
+    with nullcontext(fetcher) if fetcher is not None else Fetcher() as fetcher:
+        for (i, job), hit, err in run_all(one, todo, concurrency=concurrency):
+            if hit:
+                served[i] = hit
+            elif err:
+                print(f"[warn] resolver {job.label}: {err}")
+    return served
+
+
+def main():
+    base_time = datetime.now(timezone.utc).strftime("%Y%m%d0000")
+    days = [int(d) for d in sys.argv[1:]] or [1, 2, 3]
+    page = CHARTS_ORIGIN + "/products/efi2web_tp?area=Europe&base_time={base}&day={day}&quantile=99"
+    ok = 0
+    os.makedirs("maps", exist_ok=True)
+    with Fetcher() as fetcher:
+        results = run_all(lambda d: resolve(fetcher, page.format(base=base_time, day=d), f"maps/map_day{d}.png"), days)
+    for day, hit, err in results:
+        if not hit:
+            print(f"[fail] Day {day}: URL non risolto senza browser ({err or 'nessun candidato'}).")
+            continue
+        url, size, method = hit
+        print(f"[ok] Day {day}: via {method} {url} ({size/1024:.1f} KB)")
+        ok += 1
+    # exit 2 = serve il fallback Playwright
+    sys.exit(0 if ok == len(days) else 2)
+
+
+if __name__ == "__main__":
+    main()